@@ -78,6 +78,9 @@ setup(
             'udiskie = udiskie.cli:Daemon.main',
             'udiskie-mount = udiskie.cli:Mount.main',
             'udiskie-umount = udiskie.cli:Umount.main',
+            'udiskie-tray = udiskie.cli:Tray.main',
+            'udiskie-info = udiskie.cli:Info.main',
+            'udiskie-monitor = udiskie.cli:Monitor.main',
         ],
     },
     extras_require={
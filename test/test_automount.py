@@ -0,0 +1,68 @@
+"""
+Tests for the udiskie.automount module.
+"""
+import unittest
+
+from udiskie.automount import ReadyLatency
+
+
+class FakeDevice(object):
+
+    def __init__(self, object_path, drive, id_type=''):
+        self.object_path = object_path
+        self.drive = drive
+        self.id_type = id_type
+
+
+class TestReadyLatency(unittest.TestCase):
+
+    """Tests for the udiskie.automount.ReadyLatency class."""
+
+    def setUp(self):
+        self.now = 100.0
+        self.latency = ReadyLatency('udisks2', timeout=60,
+                                    clock=lambda: self.now)
+        self.drive = FakeDevice('/drives/usb', None)
+        self.crypto = FakeDevice('/block/sdb1', self.drive, 'crypto_LUKS')
+        self.cleartext = FakeDevice('/block/dm_0', self.drive, 'ext4')
+
+    def test_latency(self):
+        """Test that the time from first add to mount is recorded."""
+        self.latency.added(self.crypto)
+        self.now += 1
+        self.latency.added(self.cleartext)
+        self.latency.unlocked(self.crypto)
+        self.now += 2
+        self.latency.mounted(self.cleartext)
+        stats = self.latency.as_dict()
+        self.assertEqual(0, stats['pending'])
+        [entry] = stats['latency']
+        self.assertEqual(('udisks2', 'ext4', True),
+                         (entry['backend'], entry['fstype'], entry['unlock']))
+        self.assertEqual(1, entry['count'])
+        self.assertAlmostEqual(3, entry['total'])
+
+    def test_mounted_later(self):
+        """Test that mounts of drives that are not pending are ignored."""
+        self.latency.mounted(self.cleartext)
+        self.assertEqual([], self.latency.as_dict()['latency'])
+
+    def test_never_ready(self):
+        """Test that removed and timed out drives are counted."""
+        other = FakeDevice('/block/sdc1', FakeDevice('/drives/other', None))
+        self.latency.added(self.crypto)
+        self.latency.added(other)
+        self.latency.removed(self.crypto)
+        self.assertEqual(1, self.latency.as_dict()['pending'])
+        self.now += 61
+        stats = self.latency.as_dict()
+        self.assertEqual({'removed': 1, 'timeout': 1}, stats['never_ready'])
+        self.assertEqual(0, stats['pending'])
+
+    def test_removed_unknown(self):
+        """Test that removal events without device are ignored."""
+        self.latency.added(self.crypto)
+        self.latency.removed(None)
+        stats = self.latency.as_dict()
+        self.assertEqual(1, stats['pending'])
+        self.assertEqual(0, stats['never_ready']['removed'])
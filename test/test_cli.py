@@ -0,0 +1,238 @@
+# encoding: utf-8
+"""
+Tests for the udiskie.cli module.
+"""
+from collections import OrderedDict
+import errno
+import json
+import sys
+import unittest
+
+from udiskie.cli import (_daemon_errors, _daemon_mounter, _exit_code,
+                         _idle_iter, Info, Monitor, Mount, StartupProfile)
+from udiskie.ipc import DaemonError
+
+
+class TestStartupProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.stderr = sys.stderr
+        sys.stderr = self.output = Output()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def test_report(self):
+        """Test that all phases are reported in order."""
+        profile = StartupProfile()
+        with profile('imports'):
+            pass
+        profile.mark('udisks')
+        profile.report()
+        self.assertEqual(['imports', 'udisks', 'total'],
+                         [line.split()[0] for line in self.output.lines])
+
+    def test_exception(self):
+        """Test that phases are timed even if they fail."""
+        profile = StartupProfile()
+        def fail():
+            with profile('notify'):
+                raise ImportError('notify2')
+        self.assertRaises(ImportError, fail)
+        profile.report()
+        self.assertEqual('notify', self.output.lines[0].split()[0])
+
+    def test_disabled(self):
+        """Test that nothing is printed unless enabled."""
+        profile = StartupProfile(False)
+        profile.mark('udisks')
+        profile.report()
+        self.assertEqual([], self.output.lines)
+
+
+class TestIdleIter(unittest.TestCase):
+
+    def test_steps(self):
+        """Test that the iterator is advanced one step per call."""
+        steps = []
+        finished = []
+        def work():
+            for i in range(2):
+                steps.append(i)
+                yield
+        step = _idle_iter(work(), lambda: finished.append(True))
+        self.assertTrue(step())
+        self.assertEqual([0], steps)
+        self.assertTrue(step())
+        self.assertEqual([0, 1], steps)
+        self.assertEqual([], finished)
+        self.assertFalse(step())
+        self.assertEqual([True], finished)
+
+    def test_empty(self):
+        """Test that on_finish is optional."""
+        self.assertFalse(_idle_iter([])())
+
+
+class TestDaemonMounter(unittest.TestCase):
+
+    def options(self, argv):
+        parser = Mount.program_options_parser()
+        return parser.parse_args(argv)[0]
+
+    def test_local_options(self):
+        """Test that options the daemon can't honor prevent delegation."""
+        for argv in (['--no-daemon'],
+                     ['-C', '/dev/null'],
+                     ['-P', 'true'],
+                     ['-r']):
+            self.assertIsNone(_daemon_mounter(self.options(argv)))
+
+
+class TestDaemonErrors(unittest.TestCase):
+
+    def test_daemon_error(self):
+        """Test that a failing daemon results in an error exit code."""
+        def run():
+            raise DaemonError(errno.ETIMEDOUT, 'no reply')
+        self.assertEqual(1, _daemon_errors(run))
+        self.assertEqual(2, _daemon_errors(lambda: 2))
+
+    def test_local_error(self):
+        """Test that other errors are not attributed to the daemon."""
+        def run():
+            raise IOError(errno.ENOENT, 'no such batch file')
+        self.assertRaises(IOError, _daemon_errors, run)
+
+
+class TestExitCode(unittest.TestCase):
+
+    def test_exit_code(self):
+        """Test that pending operations have their own exit code."""
+        self.assertEqual(0, _exit_code([True, True]))
+        self.assertEqual(1, _exit_code([True, None, False]))
+        self.assertEqual(2, _exit_code([True, None]))
+
+
+class FakeDevice(object):
+    object_path = '/org/freedesktop/UDisks2/block_devices/sdb1'
+    id_label = 'STICK'
+    mount_paths = []
+    def __getattr__(self, name):
+        if name.startswith('is_') or name.startswith('has_'):
+            return False
+        if name.endswith('_slave'):
+            return None
+        return ''
+
+
+class Output(object):
+    def __init__(self):
+        self.text = ''
+        self.lines = []
+    def write(self, text):
+        self.text += text
+        self.lines.extend(text.splitlines())
+    def flush(self):
+        pass
+
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        # avoid __init__, which needs a main loop and udisks:
+        self.monitor = Monitor.__new__(Monitor)
+        self.stdout = sys.stdout
+        sys.stdout = self.output = Output()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def emit(self, event, *args):
+        handler = self.monitor._handler(event, Monitor.events[event])
+        handler(*args)
+        return json.loads(self.output.lines.pop(),
+                          object_pairs_hook=OrderedDict)
+
+    def test_event(self):
+        """Test the output format of events with parameters."""
+        line = self.emit('label_changed', FakeDevice(), 'OLD', 'STICK')
+        self.assertEqual(['time', 'event', 'object_path', 'old', 'new',
+                          'device'], list(line))
+        self.assertEqual('label_changed', line['event'])
+        self.assertEqual(FakeDevice.object_path, line['object_path'])
+        self.assertEqual(('OLD', 'STICK'), (line['old'], line['new']))
+        self.assertEqual('STICK', line['device']['id_label'])
+
+    def test_device_changed(self):
+        """Test that the new state is printed for device changes."""
+        old, new = FakeDevice(), FakeDevice()
+        new.id_label = 'NEW'
+        line = self.emit('device_changed', old, new)
+        self.assertEqual('NEW', line['device']['id_label'])
+
+    def test_no_device(self):
+        """Test that events without device are printed."""
+        line = self.emit('media_removed', None)
+        self.assertEqual('media_removed', line['event'])
+        self.assertIsNone(line['object_path'])
+        self.assertIsNone(line['device'])
+
+
+class FakeFilter(object):
+    def get_mount_options(self, device):
+        return ['noexec']
+
+
+class FakeMounter(object):
+    _filter = FakeFilter()
+    def is_handleable(self, device):
+        return device.id_label != 'SYSTEM'
+
+
+class TestInfo(unittest.TestCase):
+
+    def setUp(self):
+        stick = FakeDevice()
+        system = FakeDevice()
+        system.object_path = '/org/freedesktop/UDisks2/block_devices/sda1'
+        system.id_label = 'SYSTEM'
+        self.devices = [stick, system]
+        self.stdout = sys.stdout
+        sys.stdout = self.output = Output()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def run_info(self, argv):
+        # avoid _init, which needs udisks:
+        info = Info.__new__(Info)
+        info.options = Info.program_options_parser().parse_args(argv)[0]
+        info.columns = Info._columns(info.options.fields)
+        info.snapshot = self.devices
+        info.mounter = FakeMounter()
+        self.assertEqual(0, info.run())
+        return self.output.text
+
+    def test_fields(self):
+        """Test that only the selected fields are printed, in order."""
+        text = self.run_info(['-o', 'tsv', '-k', 'label, device_file'])
+        self.assertEqual(['label\tdevice_file', 'STICK\t'], text.splitlines())
+        self.assertRaises(ValueError, Info._columns, 'label,nonsense')
+        self.assertEqual([name for name, _ in Info.fields],
+                         [name for name, _ in Info._columns(None)])
+
+    def test_json(self):
+        """Test the JSON output of all devices."""
+        rows = json.loads(self.run_info(['-a']),
+                          object_pairs_hook=OrderedDict)
+        self.assertEqual(['sda1', 'sdb1'],
+                         [row['object_path'].rpartition('/')[2]
+                          for row in rows])
+        self.assertEqual([name for name, _ in Info.fields], list(rows[0]))
+        self.assertEqual('SYSTEM', rows[0]['label'])
+        self.assertIs(False, rows[0]['is_handleable'])
+        self.assertIs(True, rows[1]['is_handleable'])
+        self.assertEqual([], rows[1]['mount_paths'])
+        self.assertEqual(['noexec'], rows[1]['mount_options'])
+        self.assertIsNone(rows[1]['drive'])
@@ -0,0 +1,112 @@
+"""
+Tests for the udisks version detection and background tasks in the
+udiskie.cli module.
+
+The bus daemon and the udisks services are replaced by fakes, but the
+dbus-python exception types and thread support are needed.
+"""
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dbus.exceptions import DBusException
+
+import udiskie.cli
+import udiskie.dbus
+import udiskie.udisks1
+import udiskie.udisks2
+
+
+class FakeBusInfo(object):
+
+    owners = {'org.freedesktop.UDisks2': ':1.7'}
+    available = set(['org.freedesktop.UDisks2'])
+    reachable = True
+    queries = 0
+
+    def __init__(self):
+        if not self.reachable:
+            raise DBusException('no bus')
+
+    def close(self):
+        pass
+
+    def name_owner(self, name):
+        return self.owners.get(name)
+
+    def names(self):
+        FakeBusInfo.queries += 1
+        return set(self.owners)
+
+    def activatable_names(self):
+        FakeBusInfo.queries += 1
+        return self.available
+
+
+class TestDetectUDisksVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.base, 'udiskie', 'udisks_version')
+        self.patch(udiskie.cli, '_udisks_version_cache',
+                   lambda: self.cache_file)
+        self.patch(udiskie.dbus, 'BusInfo', FakeBusInfo)
+        FakeBusInfo.queries = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def test_cache_hit(self):
+        """Test that the bus is not queried if the owners are unchanged."""
+        self.assertEqual(2, udiskie.cli.detect_udisks_version())
+        self.assertEqual(1, FakeBusInfo.queries)
+        self.assertEqual(2, udiskie.cli.detect_udisks_version())
+        self.assertEqual(1, FakeBusInfo.queries)
+
+    def test_stale_cache(self):
+        """Test that a restarted service invalidates the cache."""
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as f:
+            f.write('-,:1.3 1\n')
+        self.assertEqual(2, udiskie.cli.detect_udisks_version())
+        self.assertEqual(1, FakeBusInfo.queries)
+
+    def test_unreachable_bus(self):
+        """Test that the version is undetermined without bus."""
+        self.patch(FakeBusInfo, 'reachable', False)
+        self.assertEqual(0, udiskie.cli.detect_udisks_version())
+
+    def test_fallback(self):
+        """Test that an outdated detection result falls back."""
+        def unavailable():
+            raise DBusException('not available')
+        self.patch(udiskie.cli, 'detect_udisks_version', lambda: 2)
+        self.patch(udiskie.udisks2, 'Sniffer', unavailable)
+        self.patch(udiskie.udisks1, 'Sniffer', lambda: 'udisks1')
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as f:
+            f.write('-,:1.7 2\n')
+        self.assertEqual('udisks1',
+                         udiskie.cli.udisks_service_object('Sniffer'))
+        self.assertFalse(os.path.exists(self.cache_file))
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_result(self):
+        """Test that the function runs in a different thread."""
+        wait = udiskie.cli._background(threading.current_thread)
+        self.assertIsNot(threading.current_thread(), wait())
+
+    def test_exception(self):
+        """Test that exceptions are reraised when waiting."""
+        def fail():
+            raise ImportError('notify2')
+        wait = udiskie.cli._background(fail)
+        self.assertRaises(ImportError, wait)
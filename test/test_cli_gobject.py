@@ -0,0 +1,102 @@
+"""
+Tests for waiting for devices in the udiskie.cli module.
+
+The udisks daemon is replaced by a fake, but the gobject main loop is
+needed.
+"""
+import unittest
+
+from udiskie.cli import Mount
+
+
+class FakeDevice(object):
+    is_filesystem = True
+    is_crypto = False
+    is_unlocked = False
+    is_luks_cleartext = False
+    def __init__(self, object_path, mount_paths=()):
+        self.object_path = object_path
+        self.mount_paths = list(mount_paths)
+        self.is_mounted = bool(mount_paths)
+    def is_file(self, path):
+        return path == '/dev/' + self.object_path
+
+
+class FakeQuery(object):
+    def __init__(self, devices, predicate, callback):
+        self.devices = [d for d in devices if predicate(d)]
+        for device in self.devices:
+            callback(device, True)
+    def __contains__(self, object_path):
+        return object_path in [d.object_path for d in self.devices]
+    def close(self):
+        pass
+
+
+class FakeDaemon(object):
+    def __init__(self, devices, current):
+        self.devices = devices
+        self.current = current
+        self.handlers = []
+    def connect(self, event, handler):
+        self.handlers.append((event, handler))
+    def query(self, predicate, callback):
+        return FakeQuery(self.devices, predicate, callback)
+    def update(self, object_path):
+        return self.current[object_path]
+
+
+class FakeMounter(object):
+    def __init__(self, udisks):
+        self.udisks = udisks
+        self.calls = []
+    def is_handleable(self, device):
+        return True
+    def mount(self, device):
+        self.calls.append(('mount', device.object_path))
+        # mounted by the automounter of a udiskie daemon in the meantime:
+        return False
+
+
+class FakeClient(object):
+    """Connection to a udiskie daemon that mounts the device."""
+    def __init__(self, udisks):
+        self.udisks = udisks
+        self.calls = []
+    def mount(self, object_path):
+        self.calls.append(('mount', object_path))
+        for event, handler in self.udisks.handlers:
+            if event == 'device_mounted':
+                handler(FakeDevice(object_path, ['/media/STICK']))
+        return True
+    def close(self):
+        pass
+
+
+class TestWait(unittest.TestCase):
+
+    def setUp(self):
+        self.stale = FakeDevice('sdb1')
+        self.daemon = FakeDaemon(
+            [self.stale],
+            {'sdb1': FakeDevice('sdb1', ['/media/STICK'])})
+        self.mount = Mount.__new__(Mount)
+        self.mount.mounter = FakeMounter(self.daemon)
+        self.mount.client = None
+
+    def test_mounted_meanwhile(self):
+        """Test that a device mounted by someone else counts as success."""
+        self.assertEqual('/media/STICK', self.mount._wait('/dev/sdb1'))
+        self.assertEqual([('mount', 'sdb1')], self.mount.mounter.calls)
+
+    def test_daemon(self):
+        """Test that a running daemon is asked to mount the device."""
+        client = self.mount.client = FakeClient(self.daemon)
+        self.assertEqual('/media/STICK', self.mount._wait('/dev/sdb1'))
+        self.assertEqual([('mount', 'sdb1')], client.calls)
+        self.assertEqual([], self.mount.mounter.calls)
+
+    def test_failed(self):
+        """Test that a failure is reported if the device is not mounted."""
+        self.daemon.current['sdb1'] = self.stale
+        self.assertIsNone(self.mount._wait('/dev/sdb1'))
@@ -0,0 +1,247 @@
+"""
+Tests for the udiskie.common module.
+
+These tests cover the pure python utilities that do not depend on a
+running DBus service.
+"""
+import unittest
+
+from udiskie.common import (SignalThrottle, PropertyDiff, Toggle, Changed,
+                            Query, Histogram, Emitter)
+
+
+class TestSignalThrottle(unittest.TestCase):
+
+    """Tests for the udiskie.common.SignalThrottle class."""
+
+    def setUp(self):
+        self.handled = []
+        self.reconciled = []
+        self.scheduled = []
+        self.throttle = SignalThrottle(
+            self.reconciled.append,
+            threshold=5,
+            interval=1,
+            schedule=lambda seconds, callback: self.scheduled.append(callback))
+        self.handler = self.throttle.wrap(self.handled.append,
+                                          key=lambda path: path)
+
+    def test_event_mode(self):
+        """Test that signals are passed through below the threshold."""
+        for i in range(5):
+            self.handler(i)
+        self.assertEqual(self.handled, list(range(5)))
+        self.assertFalse(self.throttle.reconciling)
+        self.assertEqual(self.scheduled, [])
+
+    def test_reconcile_mode(self):
+        """Test that signals are dropped and reconciled during storms."""
+        for i in range(300):
+            self.handler(i % 10)
+        self.assertTrue(self.throttle.reconciling)
+        self.assertEqual(len(self.handled), 5)
+        self.assertEqual(len(self.scheduled), 1)
+        self.assertEqual(self.throttle.stats['reconcile_mode'], 1)
+        # storm still going on:
+        self.assertTrue(self.scheduled[0]())
+        self.assertEqual(self.reconciled, [set(range(10))])
+        # storm has calmed down:
+        self.assertFalse(self.scheduled[0]())
+        self.assertEqual(self.reconciled[-1], set())
+        self.assertFalse(self.throttle.reconciling)
+        self.assertEqual(self.throttle.stats['event_mode'], 1)
+        self.handler('x')
+        self.assertEqual(self.handled[-1], 'x')
+
+
+class TestPropertyDiff(unittest.TestCase):
+
+    """Tests for the udiskie.common.PropertyDiff class."""
+
+    def setUp(self):
+        self.diff = PropertyDiff([
+            ('media', Toggle('media_added', 'media_removed')),
+            ('label', Changed('label_changed')),
+            ('hint', Changed('device_changed', 'states')),
+            ('usage', Changed('device_changed', 'states')),
+        ])
+
+    def changes(self, old, new):
+        return self.diff(set(old) | set(new), old.get, new.get)
+
+    def test_toggle(self):
+        """Test that toggles trigger only when the truth value flips."""
+        self.assertEqual(
+            [c.event for c in self.changes({'media': False}, {'media': True})],
+            ['media_added'])
+        self.assertEqual(
+            [c.event for c in self.changes({'media': True}, {})],
+            ['media_removed'])
+        self.assertEqual(self.changes({'media': 1}, {'media': 2}), [])
+
+    def test_changed(self):
+        """Test that value changes carry old and new values."""
+        change, = self.changes({'label': 'a'}, {'label': 'b'})
+        self.assertEqual(change, ('label_changed', 'values', 'a', 'b'))
+        self.assertEqual(self.changes({'label': 'a'}, {'label': 'a'}), [])
+
+    def test_unique(self):
+        """Test that each event is reported only once."""
+        changes = self.changes({'hint': 0, 'usage': 'x'},
+                               {'hint': 1, 'usage': 'y'})
+        self.assertEqual([c.event for c in changes], ['device_changed'])
+        self.assertEqual(changes[0].signature, 'states')
+
+    def test_unrelated(self):
+        """Test that unknown keys are ignored."""
+        self.assertEqual(self.changes({'foo': 1}, {'foo': 2}), [])
+
+
+class FakeDevice(object):
+
+    def __init__(self, object_path, mounted):
+        self.object_path = object_path
+        self.mounted = mounted
+
+    def __str__(self):
+        return self.object_path
+
+
+class FakeUDisks(dict):
+
+    def paths(self):
+        return self.keys()
+
+    def __getitem__(self, object_path):
+        return self.get(object_path)
+
+
+class TestQuery(unittest.TestCase):
+
+    """Tests for the udiskie.common.Query class."""
+
+    def setUp(self):
+        self.udisks = FakeUDisks(a=FakeDevice('a', True),
+                                 b=FakeDevice('b', False))
+        self.calls = []
+        self.query = Query(self.udisks, lambda device: device.mounted,
+                           lambda device, matched: self.calls.append(
+                               (str(device), matched)))
+
+    def test_initial(self):
+        """Test that the initial matches are reported."""
+        self.assertEqual(self.calls, [('a', True)])
+        self.assertEqual(len(self.query), 1)
+        self.assertTrue('a' in self.query)
+        self.assertFalse('b' in self.query)
+
+    def test_update(self):
+        """Test that only membership changes are reported."""
+        del self.calls[:]
+        self.udisks['b'] = FakeDevice('b', True)
+        self.query.update(['a', 'b'])
+        self.assertEqual(self.calls, [('b', True)])
+        old = self.udisks.pop('a')
+        self.query.update(['a'])
+        self.assertEqual(self.calls[-1], ('a', False))
+        self.assertEqual([str(d) for d in self.query], ['b'])
+        self.assertFalse(old in self.query)
+
+
+class TestHistogram(unittest.TestCase):
+
+    """Tests for the udiskie.common.Histogram class."""
+
+    def test_empty(self):
+        """Test that an empty histogram has no percentiles."""
+        hist = Histogram()
+        self.assertEqual(0, hist.count)
+        self.assertIsNone(hist.percentile(50))
+
+    def test_percentile(self):
+        """Test that percentiles are estimated by bucket upper bounds."""
+        hist = Histogram(bounds=(1, 2, 5))
+        for value in [0.5] * 90 + [3] * 9 + [7]:
+            hist.add(value)
+        self.assertEqual([90, 0, 9, 1], hist.buckets)
+        self.assertEqual(100, hist.count)
+        self.assertAlmostEqual(79, hist.total)
+        self.assertEqual(7, hist.max)
+        self.assertEqual(1, hist.percentile(50))
+        self.assertEqual(1, hist.percentile(90))
+        self.assertEqual(5, hist.percentile(99))
+        self.assertEqual(7, hist.percentile(100))
+
+    def test_percentile_capped_by_max(self):
+        """Test that percentiles never exceed the largest value."""
+        hist = Histogram(bounds=(1, 2, 5))
+        hist.add(0.25)
+        self.assertEqual(0.25, hist.percentile(50))
+
+
+class TestEmitter(unittest.TestCase):
+
+    """Tests for the udiskie.common.Emitter class."""
+
+    def setUp(self):
+        self.emitter = Emitter(['event'])
+        self.calls = []
+
+    def handler(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+    def test_priority(self):
+        """Test that handlers are called in order of priority."""
+        self.emitter.connect('event', self.handler('default'))
+        self.emitter.connect('event', self.handler('low'),
+                             Emitter.PRIORITY_LOW)
+        self.emitter.connect('event', self.handler('high'),
+                             Emitter.PRIORITY_HIGH)
+        self.emitter.connect('event', self.handler('default2'))
+        self.emitter.trigger('event', 1)
+        self.assertEqual([('high', 1), ('default', 1), ('default2', 1),
+                          ('low', 1)], self.calls)
+
+    def test_exception(self):
+        """Test that failing handlers don't abort the dispatch."""
+        def fail(arg):
+            raise ValueError(arg)
+        self.emitter.connect('event', fail)
+        self.emitter.connect('event', self.handler('ok'))
+        self.emitter.trigger('event', 1)
+        self.assertEqual([('ok', 1)], self.calls)
+
+    def test_defer(self):
+        """Test that low priority handlers can be called when idle."""
+        scheduled = []
+        self.emitter._schedule_idle = scheduled.append
+        self.emitter.defer_low_priority = True
+        self.emitter.connect('event', self.handler('low'),
+                             Emitter.PRIORITY_LOW)
+        self.emitter.connect('event', self.handler('default'))
+        self.emitter.trigger('event', 1)
+        self.emitter.trigger('event', 2)
+        self.assertEqual([('default', 1), ('default', 2)], self.calls)
+        self.assertEqual(1, len(scheduled))
+        self.assertFalse(scheduled[0]())
+        self.assertEqual([('default', 1), ('default', 2),
+                          ('low', 1), ('low', 2)], self.calls)
+
+    def test_timing(self):
+        """Test that calls and time are recorded per handler."""
+        self.emitter.enable_timing()
+        self.emitter.connect('event', self.calls.append)
+        self.emitter.trigger('event', 1)
+        self.emitter.trigger('event', 2)
+        [(name, (count, total, max_))] = self.emitter.handler_stats.items()
+        self.assertIn('append', name)
+        self.assertEqual(2, count)
+        self.assertGreaterEqual(total, max_)
+
+    def test_disconnect(self):
+        """Test that disconnected handlers are not called anymore."""
+        handler = self.handler('low')
+        self.emitter.connect('event', handler, Emitter.PRIORITY_LOW)
+        self.emitter.disconnect('event', handler)
+        self.emitter.trigger('event', 1)
+        self.assertEqual([], self.calls)
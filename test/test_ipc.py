@@ -0,0 +1,231 @@
+# encoding: utf-8
+"""
+Tests for the udiskie.ipc module.
+"""
+import errno
+import json
+import logging
+import os
+import os.path
+import stat
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from udiskie.ipc import (_listen, DaemonError, device_record, RemoteDevice,
+                         Server, SyncClient)
+
+
+class FakeDevice(object):
+    object_path = '/org/freedesktop/UDisks2/block_devices/sdb1'
+    device_presentation = '/dev/sdb1'
+    id_label = 'STICK'
+    id_uuid = 'abcd-ef01'
+    id_type = 'vfat'
+    is_block = True
+    is_external = True
+    is_filesystem = True
+    is_mounted = True
+    is_partition = True
+    partition_slave = None
+    luks_cleartext_slave = None
+    mount_paths = ['/media/STICK']
+    def __getattr__(self, name):
+        if name.startswith('is_') or name.startswith('has_'):
+            return False
+        raise AttributeError(name)
+
+
+class FakeUDisks(object):
+    def __getitem__(self, object_path):
+        return object_path
+
+
+class TestDeviceRecord(unittest.TestCase):
+
+    def test_roundtrip(self):
+        """Test that device records survive JSON serialization."""
+        record = json.loads(json.dumps(device_record(FakeDevice())))
+        device = RemoteDevice(FakeUDisks(), record)
+        self.assertEqual(FakeDevice.object_path, device.object_path)
+        self.assertEqual('STICK', device.id_label)
+        self.assertEqual(['/media/STICK'], device.mount_paths)
+        self.assertTrue(device.is_mounted)
+        self.assertFalse(device.is_crypto)
+        self.assertEqual(None, device.partition_slave)
+        self.assertRaises(AttributeError, lambda: device.unknown)
+
+
+class TestSyncClient(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'udiskie.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join()
+        self.server.close()
+        shutil.rmtree(self.base)
+
+    def serve(self):
+        conn, addr = self.server.accept()
+        f = conn.makefile('rb')
+        for line in iter(f.readline, b''):
+            request = json.loads(line.decode('utf-8'))
+            self.requests.append(request)
+            # unrelated messages must be skipped by the client:
+            conn.sendall(b'{"type": "remove", "object_path": "/x"}\n')
+            if request['type'] == 'stats':
+                reply = {'type': 'stats', 'stats': {'dbus': {}}}
+            elif request['method'] == 'unlock':
+                # waiting for a password:
+                reply = {'type': 'result', 'id': request['id'],
+                         'result': None}
+            else:
+                reply = {'type': 'result', 'id': request['id'],
+                         'result': request['method'] == 'mount'}
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        f.close()
+        conn.close()
+
+    def test_call(self):
+        """Test that operations are forwarded to the daemon."""
+        client = SyncClient(self.path)
+        self.assertTrue(client.mount('/dev/sdb1'))
+        self.assertIs(False, client.unmount('/dev/sdb1', force=True))
+        self.assertIsNone(client.unlock('/dev/sdb2'))
+        self.assertRaises(AttributeError, lambda: client.format)
+        client.close()
+        self.thread.join()
+        self.assertEqual(['mount', 'unmount', 'unlock'],
+                         [r['method'] for r in self.requests])
+        self.assertEqual({'force': True}, self.requests[1]['kwargs'])
+
+    def test_stats(self):
+        """Test that statistics can be queried from the daemon."""
+        client = SyncClient(self.path)
+        self.assertEqual({'dbus': {}}, client.stats())
+        client.close()
+        self.thread.join()
+        self.assertEqual([{'type': 'stats'}], self.requests)
+
+
+class TestSyncClientFailure(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'udiskie.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.base)
+
+    def test_timeout(self):
+        """Test that a stalled daemon doesn't block the client forever."""
+        client = SyncClient(self.path, timeout=0.05)
+        # the daemon accepts, but never replies:
+        self.assertRaises(DaemonError, client.mount, '/dev/sdb1')
+
+    def test_closed(self):
+        """Test that a daemon exiting during a call is reported."""
+        client = SyncClient(self.path)
+        conn, addr = self.server.accept()
+        conn.close()
+        try:
+            client.mount('/dev/sdb1')
+        except DaemonError as e:
+            self.assertIn(e.errno, (errno.ECONNRESET, errno.EPIPE))
+        else:
+            self.fail('no error')
+
+
+class TestListen(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.dir = os.path.join(self.base, 'udiskie-1000')
+        self.path = os.path.join(self.dir, 'udiskie.sock')
+        self.getuid = os.getuid
+
+    def tearDown(self):
+        os.getuid = self.getuid
+        shutil.rmtree(self.base)
+
+    def test_private_dir(self):
+        """Test that the socket is created in a private directory."""
+        sock = _listen(self.path)
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(self.dir).st_mode))
+        # the daemon is running:
+        try:
+            _listen(self.path)
+        except socket.error as e:
+            self.assertEqual(errno.EADDRINUSE, e.errno)
+        else:
+            self.fail('second daemon started')
+        # stale socket is replaced:
+        sock.close()
+        _listen(self.path).close()
+
+    def test_other_user(self):
+        """Test that sockets of other users are neither used nor removed."""
+        _listen(self.path).close()
+        uid = os.getuid()
+        os.getuid = lambda: uid + 1
+        self.assertRaises(socket.error, _listen, self.path)
+        self.assertRaises(socket.error, SyncClient, self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.sent = []
+    def send(self, message):
+        self.sent.append(message)
+
+
+class FakeMounter(object):
+    udisks = FakeUDisks()
+    def mount(self, device):
+        return True
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        # avoid __init__, which needs a gobject main loop and a socket:
+        self.server = Server.__new__(Server)
+        self.server._log = logging.getLogger(__name__)
+        self.server._mounter = FakeMounter()
+        self.server._records = {FakeDevice.object_path: {}}
+        self.server._subscribers = []
+        self.client = FakeClient()
+
+    def call(self, **message):
+        message['type'] = 'call'
+        self.server._on_message(self.client, message)
+        return self.client.sent.pop()
+
+    def test_call(self):
+        """Test that results are sent back to the client."""
+        reply = self.call(id=1, method='mount', device=FakeDevice.object_path)
+        self.assertEqual({'type': 'result', 'id': 1, 'result': True}, reply)
+
+    def test_bad_kwargs(self):
+        """Test that a reply is sent even if the call fails."""
+        for kwargs in (['force'], {'force': True}):
+            reply = self.call(id=2, method='mount',
+                              device=FakeDevice.object_path, kwargs=kwargs)
+            self.assertEqual(2, reply['id'])
+            self.assertIs(False, reply['result'])
+            self.assertIn('error', reply)
@@ -13,7 +13,7 @@ import shutil
 import os.path
 import gc
 
-from udiskie.config import OptionFilter, Config
+from udiskie.config import OptionFilter, Config, InvalidFilter
 
 class TestDev(object):
     def __init__(self, object_path, id_type, id_uuid):
@@ -81,3 +81,38 @@ fstype.vfat = ro,nouser''')
             self.filter_matcher.get_mount_options(
                 TestDev('/nomatch', 'ext', 'no-matching-id')))
 
+
+
+class TestKeyfiles(unittest.TestCase):
+    """
+    Tests for the udiskie.config.Config.keyfiles property.
+
+    """
+    def setUp(self):
+        """Create a temporary config file."""
+        self.base = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.base, 'filters.conf')
+
+    def tearDown(self):
+        """Remove the config file."""
+        gc.collect()
+        shutil.rmtree(self.base)
+
+    def _config(self, text):
+        with open(self.config_file, 'wt') as f:
+            f.write(text)
+        return Config.from_file(self.config_file)
+
+    def test_keyfiles(self):
+        """Test that keyfiles are mapped by lowercase UUID."""
+        config = self._config('''
+[keyfiles]
+uuid.ABCD-ef01 = /keys/backup.key''')
+        self.assertEqual({'abcd-ef01': '/keys/backup.key'}, config.keyfiles)
+
+    def test_invalid(self):
+        """Test that invalid keys are rejected."""
+        config = self._config('''
+[keyfiles]
+fstype.vfat = /keys/backup.key''')
+        self.assertRaises(InvalidFilter, lambda: config.keyfiles)
@@ -0,0 +1,288 @@
+# encoding: utf-8
+"""
+Tests for the udiskie.mount module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from udiskie.mount import Mounter, device_spec
+
+
+class FakeDevice(object):
+    def __init__(self, id_uuid='', id_label='', paths=()):
+        self.id_uuid = id_uuid
+        self.id_label = id_label
+        self.paths = paths
+    def is_file(self, path):
+        return path in self.paths
+
+
+class TestDeviceSpec(unittest.TestCase):
+
+    def test_uuid(self):
+        """Test that UUIDs are matched case insensitively."""
+        match = device_spec('uuid=abcd-EF01')
+        self.assertTrue(match(FakeDevice(id_uuid='ABCD-ef01')))
+        self.assertFalse(match(FakeDevice(id_uuid='abcd')))
+
+    def test_label(self):
+        """Test that labels are matched exactly."""
+        match = device_spec('label=BACKUP')
+        self.assertTrue(match(FakeDevice(id_label='BACKUP')))
+        self.assertFalse(match(FakeDevice(id_label='backup')))
+
+    def test_path(self):
+        """Test that anything else is matched as path."""
+        match = device_spec('/dev/sdb1')
+        self.assertTrue(match(FakeDevice(paths=['/dev/sdb1'])))
+        self.assertFalse(match(FakeDevice(paths=['/dev/sdc1'])))
+
+
+class FakeBatchDevice(FakeDevice):
+    def __init__(self, object_path, drive, **kwargs):
+        super(FakeBatchDevice, self).__init__(**kwargs)
+        self.object_path = object_path
+        self.drive = drive
+
+
+class FakeUDisks(object):
+    def __init__(self, devices):
+        self.devices = devices
+        self.snapshots = 0
+    def snapshot(self):
+        self.snapshots += 1
+        return list(self.devices)
+
+
+class BatchMounter(Mounter):
+    """Mounter that records calls instead of executing them."""
+    def __init__(self, udisks):
+        super(BatchMounter, self).__init__(udisks)
+        self.calls = []
+    def is_handleable(self, device):
+        return True
+    def mount(self, device):
+        self.calls.append(('mount', device.object_path))
+        return True
+    def detach(self, device):
+        self.calls.append(('detach', device.object_path))
+        return False
+    def unlock(self, device):
+        self.calls.append(('unlock', device.object_path))
+        # the cleartext device appears:
+        self.udisks.devices.append(FakeBatchDevice(
+            'dm0', device.drive, id_label='CLEAR'))
+        return True
+
+
+class TestRunBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.sdb = FakeBatchDevice('sdb', None, paths=['/dev/sdb'])
+        self.sdb.drive = self.sdb
+        self.sdb1 = FakeBatchDevice('sdb1', self.sdb, id_label='DATA')
+        self.mounter = BatchMounter(FakeUDisks([self.sdb, self.sdb1]))
+
+    def test_same_drive(self):
+        """Test that operations on the same drive are executed in order."""
+        reported = []
+        results = self.mounter.run_batch([('mount', 'label=DATA'),
+                                          ('detach', '/dev/sdb')],
+                                         lambda i, r: reported.append(i))
+        self.assertEqual([True, False], results)
+        self.assertEqual([0, 1], reported)
+        self.assertEqual([('mount', 'sdb1'), ('detach', 'sdb')],
+                         self.mounter.calls)
+
+    def test_not_found(self):
+        """Test that unknown devices are reported as failed."""
+        results = self.mounter.run_batch([('mount', 'uuid=1234')])
+        self.assertEqual([False], results)
+        self.assertEqual([], self.mounter.calls)
+
+    def test_dependent(self):
+        """Test that devices created by previous operations are found."""
+        results = self.mounter.run_batch([('unlock', 'label=DATA'),
+                                          ('mount', 'label=CLEAR'),
+                                          ('detach', '/dev/sdb')])
+        self.assertEqual([True, True, False], results)
+        self.assertEqual([('unlock', 'sdb1'), ('mount', 'dm0'),
+                          ('detach', 'sdb')],
+                         self.mounter.calls)
+        # operations on the same drive are executed in separate stages:
+        self.assertEqual(3, self.mounter.udisks.snapshots)
+
+
+class FakeError(Exception):
+    @property
+    def message(self):
+        return self.args[0]
+
+
+class FakeCryptoDevice(object):
+    Exception = FakeError
+    is_block = True
+    is_external = True
+    is_ignored = False
+    is_crypto = True
+    def __init__(self, object_path, password):
+        self.object_path = object_path
+        self.id_uuid = object_path
+        self.is_unlocked = False
+        self._password = password
+        self.attempts = []
+    def unlock(self, password):
+        self.attempts.append(password)
+        if password != self._password:
+            raise FakeError('wrong password')
+        self.is_unlocked = True
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.passwords = {}
+    def get(self, device):
+        return self.passwords.get(device.id_uuid)
+    def put(self, device, password):
+        self.passwords[device.id_uuid] = password
+    def discard(self, device):
+        self.passwords.pop(device.id_uuid, None)
+
+
+class TestUnlock(unittest.TestCase):
+
+    """Tests for unlocking with a non-blocking password prompt."""
+
+    def setUp(self):
+        self.prompts = []
+        self.cache = FakeCache()
+        self.mounter = Mounter(
+            FakeUDisks([]),
+            prompt=lambda device, callback: self.prompts.append(
+                (device, callback)),
+            cache=self.cache)
+        self.device = FakeCryptoDevice('sdb1', 'secret')
+
+    def counts(self, name):
+        return {outcome: num
+                for (span, outcome), num in self.mounter.tracer.counts.items()
+                if span == name}
+
+    def test_cancelled(self):
+        """Test that nothing is unlocked if the prompt is cancelled."""
+        self.assertIsNone(self.mounter.unlock(self.device))
+        [(device, callback)] = self.prompts
+        self.assertIs(self.device, device)
+        callback(None)
+        self.assertEqual([], self.device.attempts)
+        self.assertEqual({'cancelled': 1}, self.counts('prompt'))
+        self.assertEqual({'pending': 1}, self.counts('unlock'))
+        # the user may try again:
+        self.assertIsNone(self.mounter.unlock(self.device))
+        self.assertEqual(2, len(self.prompts))
+
+    def test_success(self):
+        """Test that the device is unlocked when the password arrives."""
+        self.assertIsNone(self.mounter.unlock(self.device))
+        self.prompts[0][1]('secret')
+        self.assertEqual(['secret'], self.device.attempts)
+        self.assertTrue(self.device.is_unlocked)
+        self.assertEqual({'ok': 1}, self.counts('prompt'))
+        self.assertEqual('secret', self.cache.get(self.device))
+        self.assertTrue(self.mounter.unlock(self.device))
+        self.assertEqual(1, len(self.prompts))
+
+    def test_wrong_password(self):
+        """Test that a rejected password is not cached."""
+        self.assertIsNone(self.mounter.unlock(self.device))
+        self.prompts[0][1]('guess')
+        self.assertFalse(self.device.is_unlocked)
+        self.assertIsNone(self.cache.get(self.device))
+
+    def test_pending(self):
+        """Test that a device is not prompted for twice at the same time."""
+        self.assertIsNone(self.mounter.unlock(self.device))
+        self.assertIsNone(self.mounter.unlock(self.device))
+        self.assertIsNone(self.mounter.unlock_all([self.device]))
+        self.assertEqual(1, len(self.prompts))
+        self.prompts[0][1]('secret')
+        self.assertEqual(['secret'], self.device.attempts)
+        self.assertTrue(self.mounter.unlock_all([self.device]))
+        self.assertEqual(1, len(self.prompts))
+
+    def test_blocking(self):
+        """Test that blocking prompts return the result immediately."""
+        self.mounter._prompt = lambda device, callback: callback('secret')
+        self.assertTrue(self.mounter.unlock(self.device))
+        self.assertFalse(self.mounter._prompting)
+
+    def test_prompt_error(self):
+        """Test that a failing prompt doesn't leave the device pending."""
+        def prompt(device, callback):
+            raise OSError('zenity not found')
+        self.mounter._prompt = prompt
+        self.assertRaises(OSError, self.mounter.unlock, self.device)
+        self.assertEqual({'error': 1}, self.counts('prompt'))
+        self.assertFalse(self.mounter._prompting)
+
+
+class FakeKeyfileDevice(FakeCryptoDevice):
+    """Locked device whose state is not updated by unlocking."""
+    is_filesystem = False
+    is_partition_table = False
+    def __init__(self, object_path, udisks):
+        super(FakeKeyfileDevice, self).__init__(object_path, None)
+        self._udisks = udisks
+    def unlock_keyfile(self, keyfile_contents):
+        self.attempts.append(keyfile_contents)
+        # udisks replaces the device state and adds the cleartext device:
+        unlocked = FakeCryptoDevice(self.object_path, None)
+        unlocked.is_unlocked = True
+        unlocked.is_filesystem = unlocked.is_partition_table = False
+        cleartext = FakeCryptoDevice('dm-' + self.object_path, None)
+        cleartext.is_crypto = cleartext.is_partition_table = False
+        cleartext.is_filesystem = True
+        devices = self._udisks.devices
+        devices[devices.index(self)] = unlocked
+        devices.append(cleartext)
+
+
+class AddAllMounter(Mounter):
+    """Mounter that records mount calls instead of executing them."""
+    def __init__(self, udisks, **kwargs):
+        super(AddAllMounter, self).__init__(udisks, **kwargs)
+        self.mounted = []
+    def mount(self, device):
+        self.mounted.append(device.object_path)
+        return True
+
+
+class TestAddAll(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        keyfile = os.path.join(self.tmpdir, 'keyfile')
+        with open(keyfile, 'wb') as f:
+            f.write(b'key')
+        self.prompts = []
+        self.udisks = FakeUDisks([])
+        self.devices = [FakeKeyfileDevice('sdb1', self.udisks),
+                        FakeKeyfileDevice('sdc1', self.udisks)]
+        self.udisks.devices.extend(self.devices)
+        self.mounter = AddAllMounter(
+            self.udisks,
+            prompt=lambda device, callback: self.prompts.append(device),
+            keyfiles={'sdb1': keyfile, 'sdc1': keyfile})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_keyfiles(self):
+        """Test that devices unlocked by keyfile are not unlocked again."""
+        self.assertTrue(self.mounter.add_all())
+        self.assertEqual([], self.prompts)
+        self.assertEqual([[b'key'], [b'key']],
+                         [device.attempts for device in self.devices])
+        self.assertEqual(['dm-sdb1', 'dm-sdc1'], self.mounter.mounted)
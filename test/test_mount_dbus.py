@@ -0,0 +1,65 @@
+"""
+Tests for running mount operations in worker threads.
+
+The worker threads need dbus-python and the gobject main loop.
+"""
+import unittest
+
+import gobject
+
+from udiskie.mount import _parallel, Mounter
+
+from test.test_mount import FakeCryptoDevice, FakeUDisks
+
+
+def check(item):
+    if item < 0:
+        raise ValueError(item)
+    return item > 0
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_results(self):
+        """Test that the results are returned in the order of the items."""
+        self.assertEqual([True, False, True], _parallel(check, [1, 0, 2]))
+
+    def test_exception(self):
+        """Test that exceptions of the workers are re-raised."""
+        self.assertRaises(ValueError, _parallel, check, [1, -1])
+
+    def test_callback(self):
+        """Test that results are delivered to the main loop."""
+        loop = gobject.MainLoop()
+        results = []
+        def callback(unlocked):
+            results.append(unlocked)
+            loop.quit()
+        self.assertIsNone(_parallel(check, [1, -1, 0], callback))
+        self.assertEqual([], results)
+        loop.run()
+        self.assertEqual([[True, False, False]], results)
+
+
+class TestUnlockAll(unittest.TestCase):
+
+    def test_retry(self):
+        """Test that failed devices are prompted for again."""
+        loop = gobject.MainLoop()
+        prompts = []
+        def prompt(devices, callback):
+            prompts.append((devices, callback))
+            loop.quit()
+        mounter = Mounter(FakeUDisks([]), prompt=prompt)
+        sdb1 = FakeCryptoDevice('sdb1', 'secret')
+        sdc1 = FakeCryptoDevice('sdc1', 'other')
+        self.assertIsNone(mounter.unlock_all([sdb1, sdc1]))
+        # the password arrives from the main loop:
+        prompts.pop()[1]('secret')
+        self.assertEqual(set(['sdb1', 'sdc1']), mounter._prompting)
+        loop.run()
+        self.assertTrue(sdb1.is_unlocked)
+        self.assertFalse(sdc1.is_unlocked)
+        [(devices, callback)] = prompts
+        self.assertEqual([sdc1], devices)
+        self.assertEqual(set(['sdc1']), mounter._prompting)
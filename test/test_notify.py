@@ -0,0 +1,129 @@
+# encoding: utf-8
+"""
+Tests for the udiskie.notify module.
+"""
+import unittest
+
+from udiskie.notify import Notify
+
+
+class FakeNotification(object):
+    def __init__(self, summary, text, icon):
+        self.summary = summary
+        self.text = text
+        self.shown = 0
+        self.actions = []
+        self.closed = None
+    def update(self, summary, text, icon):
+        self.summary = summary
+        self.text = text
+    def connect(self, signal, callback):
+        self.closed = callback
+    def set_timeout(self, timeout):
+        pass
+    def add_action(self, name, label, callback):
+        self.actions.append(name)
+    def clear_actions(self):
+        del self.actions[:]
+    def show(self):
+        self.shown += 1
+
+
+class FakeNotifyService(object):
+    def __init__(self):
+        self.created = []
+    def Notification(self, summary, text, icon):
+        notification = FakeNotification(summary, text, icon)
+        self.created.append(notification)
+        return notification
+
+
+class FakeDevice(object):
+    def __init__(self, object_path, drive=None):
+        self.object_path = object_path
+        self.drive = drive
+        self.id_label = object_path
+        self.device_presentation = '/dev/' + object_path
+        self.mount_paths = ['/media/' + object_path]
+
+
+class FakeUDisks(object):
+    def connect(self, event, handler, priority=0):
+        pass
+
+
+class FakeMounter(object):
+    udisks = FakeUDisks()
+    _browser = None
+
+
+class BrowsingMounter(FakeMounter):
+    _browser = 'xdg-open'
+    def browse(self, device):
+        pass
+
+
+class TestNotify(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeNotifyService()
+        self.scheduled = []
+        self.notify = Notify(self.service, FakeMounter(),
+                             schedule=lambda t, f: self.scheduled.append(f))
+
+    def flush(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+    def test_deferred(self):
+        """Test that notifications are shown from the main loop."""
+        self.notify.device_unmounted(FakeDevice('a'))
+        self.assertEqual([], self.service.created)
+        self.assertEqual(1, len(self.scheduled))
+        self.flush()
+        self.assertEqual(1, len(self.service.created))
+
+    def test_coalesce(self):
+        """Test that messages for the same drive are merged."""
+        drive = FakeDevice('sdb')
+        for name in ('sdb1', 'sdb2', 'sdb3'):
+            self.notify.device_mounted(FakeDevice(name, drive))
+        self.notify.device_mounted(FakeDevice('sdc1', FakeDevice('sdc')))
+        self.assertEqual(1, len(self.scheduled))
+        self.flush()
+        self.assertEqual(2, len(self.service.created))
+        merged = self.service.created[0]
+        self.assertEqual('3 device events', merged.summary)
+        self.assertEqual(3, len(merged.text.split('\n')))
+
+    def test_update(self):
+        """Test that an open notification is updated."""
+        drive = FakeDevice('sdb')
+        self.notify.device_mounted(FakeDevice('sdb1', drive))
+        self.flush()
+        self.notify.device_unmounted(FakeDevice('sdb1', drive))
+        self.flush()
+        self.assertEqual(1, len(self.service.created))
+        notification = self.service.created[0]
+        self.assertEqual('Device unmounted', notification.summary)
+        self.assertEqual(2, notification.shown)
+        notification.closed(notification)
+        self.notify.device_unmounted(FakeDevice('sdb1', drive))
+        self.flush()
+        self.assertEqual(2, len(self.service.created))
+
+    def test_coalesce_actions(self):
+        """Test that actions of merged messages are kept."""
+        self.notify = Notify(self.service, BrowsingMounter(),
+                             schedule=lambda t, f: self.scheduled.append(f))
+        drive = FakeDevice('sdb')
+        sdb1 = FakeDevice('sdb1', drive)
+        self.notify.device_unmounted(sdb1)
+        self.notify.device_mounted(sdb1)
+        sdc = FakeDevice('sdc')
+        self.notify.device_mounted(FakeDevice('sdc1', sdc))
+        self.notify.device_mounted(FakeDevice('sdc2', sdc))
+        self.flush()
+        same, different = self.service.created
+        self.assertEqual(['browse'], same.actions)
+        self.assertEqual(['browse-0', 'browse-1'], different.actions)
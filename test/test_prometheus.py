@@ -0,0 +1,166 @@
+"""
+Tests for the udiskie.prometheus module.
+"""
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from udiskie.common import Histogram
+from udiskie.prometheus import TextfileExporter, format_metric
+from udiskie.trace import Tracer
+
+
+class FakeDevice(object):
+
+    is_filesystem = True
+    is_crypto = False
+
+    def __init__(self, is_mounted):
+        self.is_mounted = is_mounted
+
+
+class FakeMounter(object):
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.udisks = object()
+        self.tracer = Tracer()
+
+    def get_all_handleable(self):
+        return self.devices
+
+
+class TestFormatMetric(unittest.TestCase):
+
+    """Tests for the udiskie.prometheus.format_metric function."""
+
+    def test_gauge(self):
+        """Test that labels are escaped."""
+        lines = format_metric('x', 'gauge', 'Help.',
+                              [([('a', 'say "hi"\n')], 2)])
+        self.assertEqual(['# HELP x Help.',
+                          '# TYPE x gauge',
+                          'x{a="say \\"hi\\"\\n"} 2.0'], lines)
+
+    def test_histogram(self):
+        """Test that histogram buckets are cumulative."""
+        hist = Histogram(bounds=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            hist.add(value)
+        lines = format_metric('t', 'histogram', 'Help.', [([], hist)])
+        self.assertEqual(['t_bucket{le="1.0"} 1.0',
+                          't_bucket{le="2.0"} 3.0',
+                          't_bucket{le="+Inf"} 4.0',
+                          't_sum 6.5',
+                          't_count 4.0'], lines[2:])
+
+
+class TestTextfileExporter(unittest.TestCase):
+
+    """Tests for the udiskie.prometheus.TextfileExporter class."""
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'udiskie.prom')
+        self.ticks = []
+        self.mounter = FakeMounter([FakeDevice(True), FakeDevice(False)])
+        self.exporter = TextfileExporter(
+            self.path, self.mounter,
+            schedule=lambda seconds, callback: self.ticks.append(callback))
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_write(self):
+        """Test that the file is written on startup."""
+        text = self.read()
+        self.assertIn('udiskie_devices{state="mounted"} 1.0\n', text)
+        self.assertIn('udiskie_devices{state="unmounted"} 1.0\n', text)
+        self.assertIn('process_cpu_seconds_total ', text)
+        self.assertEqual(['udiskie.prom'], os.listdir(self.base))
+        self.assertEqual(1, len(self.ticks))
+
+    def test_unchanged(self):
+        """Test that the file is only rewritten after changes."""
+        self.assertFalse(self.exporter.update())
+        with self.mounter.tracer.span('mount') as span:
+            span.outcome = 'ok'
+        self.assertTrue(self.exporter.update())
+        self.assertIn('udiskie_operations_total{operation="mount",'
+                      'result="ok"} 1.0\n', self.read())
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, devices, version):
+        self.devices = devices
+        self.version = version
+
+    def __iter__(self):
+        return iter(self.devices)
+
+
+class FakeDaemon(object):
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.version = 1
+
+    def snapshot(self):
+        return FakeSnapshot(self.devices, self.version)
+
+
+class CountingMounter(FakeMounter):
+
+    def __init__(self, devices):
+        super(CountingMounter, self).__init__(devices)
+        self.udisks = FakeDaemon(devices)
+        self.collected = 0
+
+    def get_all_handleable(self):
+        self.collected += 1
+        return self.udisks.snapshot()
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    """Tests for the change detection of the TextfileExporter."""
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'udiskie.prom')
+        self.ticks = []
+        self.mounter = CountingMounter([FakeDevice(True)])
+        self.exporter = TextfileExporter(
+            self.path, self.mounter, interval=15,
+            schedule=lambda seconds, callback: self.ticks.append(callback))
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_counters(self):
+        """Test that metrics are only collected if a counter has moved."""
+        self.assertEqual(1, self.mounter.collected)
+        self.assertFalse(self.exporter.update())
+        self.assertEqual(1, self.mounter.collected)
+        self.mounter.udisks.version += 1
+        self.assertTrue(self.exporter.update())
+        self.assertEqual(2, self.mounter.collected)
+
+    def test_lag(self):
+        """Test that a main loop lag spike is written."""
+        # the timer fired 5 seconds late:
+        self.exporter._last_tick -= 20
+        self.assertTrue(self.ticks[0]())
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        lag = [line for line in lines
+               if line.startswith('udiskie_main_loop_lag_seconds ')]
+        self.assertEqual(1, len(lag))
+        self.assertGreaterEqual(float(lag[0].split()[1]), 5.0)
+        self.assertFalse(self.exporter.update())
@@ -0,0 +1,60 @@
+"""
+Tests for the udiskie.prompt module.
+"""
+import unittest
+
+from udiskie.prompt import PasswordCache
+
+
+class FakeDevice(object):
+
+    def __init__(self, id_uuid):
+        self.id_uuid = id_uuid
+
+
+class TestPasswordCache(unittest.TestCase):
+
+    """Tests for the udiskie.prompt.PasswordCache class."""
+
+    def setUp(self):
+        self.now = 100.0
+        self.timers = []
+        self.cache = PasswordCache(
+            60, clock=lambda: self.now,
+            schedule=lambda seconds, callback: self.timers.append(
+                (seconds, callback)))
+        self.a = FakeDevice('a')
+        self.b = FakeDevice('b')
+
+    def test_expire(self):
+        """Test that passwords are forgotten after the timeout."""
+        self.cache.put(self.a, 'secret')
+        self.assertEqual('secret', self.cache.get(self.a))
+        self.now += 60
+        self.assertIsNone(self.cache.get(self.a))
+
+    def test_purge(self):
+        """Test that all expired passwords are purged on access."""
+        self.cache.put(self.a, 'secret')
+        self.now += 61
+        self.cache.put(self.b, 'other')
+        self.assertEqual(['b'], list(self.cache._passwords))
+
+    def test_timer(self):
+        """Test that passwords expire without access."""
+        self.cache.put(self.a, 'secret')
+        self.now += 30
+        self.cache.put(self.b, 'other')
+        # only one timer at a time:
+        [(seconds, callback)] = self.timers
+        self.assertEqual(60, seconds)
+        self.now += 30
+        self.assertFalse(callback())
+        self.assertEqual(['b'], list(self.cache._passwords))
+        # rescheduled for the remaining password:
+        seconds, callback = self.timers[-1]
+        self.assertEqual(30, seconds)
+        self.now += 30
+        callback()
+        self.assertEqual({}, self.cache._passwords)
+        self.assertEqual(2, len(self.timers))
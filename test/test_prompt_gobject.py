@@ -0,0 +1,40 @@
+"""
+Tests for running password programs from the gobject main loop.
+"""
+import sys
+import unittest
+
+import gobject
+
+from udiskie.prompt import _spawn_async
+
+
+class TestSpawnAsync(unittest.TestCase):
+
+    def spawn(self, argv):
+        loop = gobject.MainLoop()
+        outputs = []
+        def callback(output):
+            outputs.append(output)
+            loop.quit()
+        _spawn_async(argv, callback)
+        # the callback is only invoked from the main loop:
+        self.assertEqual([], outputs)
+        loop.run()
+        return outputs
+
+    def test_output(self):
+        """Test that the output is passed to the callback."""
+        self.assertEqual([b'secret\n'],
+                         self.spawn(['/bin/sh', '-c', 'echo secret']))
+
+    def test_large_output(self):
+        """Test that output exceeding the pipe buffer is read completely."""
+        code = "import sys; sys.stdout.write('x' * 100000)"
+        self.assertEqual([b'x' * 100000],
+                         self.spawn([sys.executable, '-c', code]))
+
+    def test_cancelled(self):
+        """Test that a non-zero exit status counts as cancellation."""
+        self.assertEqual([None],
+                         self.spawn(['/bin/sh', '-c', 'echo secret; exit 1']))
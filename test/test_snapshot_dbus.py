@@ -0,0 +1,129 @@
+"""
+Tests for the snapshots of the udisks1 and udisks2 daemons.
+
+The daemons are created without connecting to udisks, but the backends
+need dbus-python to be importable.
+"""
+import unittest
+
+import udiskie.udisks1
+import udiskie.udisks2
+from udiskie.udisks2 import Interface
+
+
+class FakeObject(object):
+    def __init__(self, bus, object_path):
+        self._bus = bus
+        self.object_path = object_path
+
+
+class FakeBus(object):
+    def get_object(self, bus_name, object_path):
+        return FakeObject(self, object_path)
+
+
+class FakeProxy(object):
+    _bus = FakeBus()
+
+
+def udisks1_daemon(devices):
+    # avoid __init__, which connects to udisks:
+    daemon = udiskie.udisks1.Daemon.__new__(udiskie.udisks1.Daemon)
+    daemon._devices = {}
+    daemon._children = {}
+    daemon._queries = []
+    daemon._version = 0
+    daemon._snapshot = None
+    for object_path, attrs in devices.items():
+        daemon._set_state(object_path, udisks1_device(daemon, attrs))
+    return daemon
+
+
+def udisks1_device(daemon, attrs):
+    device = udiskie.udisks1.CachedDevice.__new__(udiskie.udisks1.CachedDevice)
+    device._device = None
+    device._daemon = daemon
+    device.is_valid = True
+    vars(device).update(attrs)
+    return device
+
+
+class TestUDisks1Snapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = udisks1_daemon({
+            '/drive': {'object_path': '/drive', 'id_label': 'OLD',
+                       '_drive': '/drive'},
+            '/part': {'object_path': '/part', '_drive': '/drive',
+                      '_partition_slave': '/drive'},
+        })
+
+    def test_related(self):
+        """Test that related devices are resolved within the snapshot."""
+        snapshot = self.daemon.snapshot()
+        self.daemon._set_state('/drive', udisks1_device(
+            self.daemon, {'object_path': '/drive', 'id_label': 'NEW'}))
+        part = snapshot['/part']
+        self.assertIs(snapshot, part.drive._daemon)
+        self.assertEqual('OLD', part.drive.id_label)
+        self.assertEqual('OLD', part.partition_slave.id_label)
+        self.assertEqual('NEW', self.daemon['/drive'].id_label)
+
+    def test_reuse(self):
+        """Test that snapshots are reused until the state changes."""
+        snapshot = self.daemon.snapshot()
+        self.assertIs(snapshot, self.daemon.snapshot())
+        self.assertIs(snapshot['/part'], snapshot['/part'])
+        self.daemon._set_state('/part', None)
+        self.assertIsNot(snapshot, self.daemon.snapshot())
+        self.assertEqual(['/drive', '/part'], sorted(snapshot.paths()))
+
+
+class TestUDisks2Snapshot(unittest.TestCase):
+
+    drive = '/org/freedesktop/UDisks2/drives/stick'
+    part = '/org/freedesktop/UDisks2/block_devices/sdb1'
+
+    def setUp(self):
+        # avoid __init__, which connects to udisks:
+        daemon = udiskie.udisks2.Daemon.__new__(udiskie.udisks2.Daemon)
+        daemon._proxy = FakeProxy()
+        daemon._objects = {}
+        daemon._children = {}
+        daemon._queries = []
+        daemon._version = 0
+        daemon._snapshot = None
+        daemon._set_state(self.drive, {Interface['Drive']: {}})
+        daemon._set_state(self.part, {Interface['Block']: {
+            'Drive': self.drive,
+            'CryptoBackingDevice': '/',
+            'IdLabel': 'STICK'}})
+        self.daemon = daemon
+
+    def test_related(self):
+        """Test that related devices are resolved within the snapshot."""
+        snapshot = self.daemon.snapshot()
+        self.daemon._set_state(self.drive, None)
+        self.daemon._set_state(self.part, {Interface['Block']: {
+            'Drive': '/', 'CryptoBackingDevice': '/', 'IdLabel': 'NEW'}})
+        part = snapshot[self.part]
+        self.assertEqual('STICK', part.id_label)
+        self.assertEqual(self.drive, part.drive.object_path)
+        self.assertEqual('NEW', self.daemon[self.part].id_label)
+        self.assertIsNone(self.daemon[self.drive])
+
+    def test_freeze(self):
+        """Test that the sniffer takes a snapshot with a single call."""
+        calls = []
+        objects = dict(self.daemon._objects)
+        class Method(object):
+            def GetManagedObjects(self):
+                calls.append('GetManagedObjects')
+                return objects
+        proxy = FakeProxy()
+        proxy.method = Method()
+        snapshot = udiskie.udisks2.Sniffer(proxy).freeze()
+        self.assertEqual(['GetManagedObjects'], calls)
+        self.assertEqual('STICK', snapshot[self.part].id_label)
+        self.assertEqual(self.drive, snapshot[self.part].drive.object_path)
+        self.assertEqual(['GetManagedObjects'], calls)
@@ -0,0 +1,68 @@
+"""
+Tests for the udiskie.trace module.
+"""
+import unittest
+
+from udiskie.trace import Tracer, span
+
+
+class TestTracer(unittest.TestCase):
+
+    """Tests for the udiskie.trace.Tracer class."""
+
+    def test_nested(self):
+        """Test that spans opened within other spans are nested."""
+        tracer = Tracer()
+        with tracer.span('add', '/dev/sdb') as outer:
+            with span('unlock', '/dev/sdb') as inner:
+                inner.outcome = 'ok'
+            outer.set_result(None)
+        self.assertEqual([inner, outer], list(tracer.spans))
+        self.assertEqual(outer.id, inner.parent)
+        self.assertIsNone(outer.parent)
+        self.assertEqual('pending', outer.outcome)
+        self.assertGreaterEqual(outer.duration, inner.duration)
+
+    def test_error(self):
+        """Test that exceptions are recorded as outcome."""
+        tracer = Tracer()
+        def fail():
+            with tracer.span('mount'):
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual('error', tracer.spans[0].outcome)
+
+    def test_ring_buffer(self):
+        """Test that only the latest spans are kept."""
+        tracer = Tracer(size=3)
+        for i in range(5):
+            with tracer.span(str(i)):
+                pass
+        self.assertEqual(['2', '3', '4'], [s.name for s in tracer.spans])
+
+    def test_detached(self):
+        """Test spans that finish in a different call stack."""
+        tracer = Tracer()
+        with tracer.span('unlock') as outer:
+            prompt = tracer.begin('prompt', '/dev/sdb')
+        tracer.end(prompt, 'cancelled')
+        self.assertEqual(outer.id, prompt.parent)
+        self.assertEqual('cancelled', prompt.outcome)
+
+    def test_inactive(self):
+        """Test that the span function does nothing outside of traces."""
+        with span('cleartext') as s:
+            self.assertIsNone(s)
+
+    def test_chrome_trace(self):
+        """Test the export as Chrome trace events."""
+        tracer = Tracer()
+        with tracer.span('mount', '/dev/sdb1') as s:
+            s.outcome = 'ok'
+        events = tracer.chrome_trace()['traceEvents']
+        self.assertEqual(1, len(events))
+        event = events[0]
+        self.assertEqual('mount', event['name'])
+        self.assertEqual('X', event['ph'])
+        self.assertEqual({'id': s.id, 'parent': None, 'outcome': 'ok',
+                          'device': '/dev/sdb1'}, event['args'])
@@ -0,0 +1,84 @@
+"""
+Tests for the udiskie.watchdog module.
+"""
+import sys
+import threading
+import time
+import unittest
+
+from udiskie.common import Emitter
+from udiskie.watchdog import Watchdog, blame
+
+
+class Handler(object):
+
+    def __init__(self):
+        self.culprits = []
+
+    def device_added(self, device):
+        self.culprits.append(blame(sys._getframe()))
+
+
+class TestBlame(unittest.TestCase):
+
+    """Tests for the udiskie.watchdog.blame function."""
+
+    def test_handler(self):
+        """Test that the running event handler is blamed."""
+        emitter = Emitter(['device_added'])
+        handler = Handler()
+        emitter.connect_all(handler)
+        emitter.trigger('device_added', None)
+        self.assertEqual([__name__ + '.Handler.device_added'],
+                         handler.culprits)
+
+    def test_innermost(self):
+        """Test that the innermost frame is blamed outside of handlers."""
+        culprit = blame(sys._getframe())
+        self.assertTrue(culprit.startswith(
+            __name__ + '.TestBlame.test_innermost ('))
+
+
+class TestWatchdog(unittest.TestCase):
+
+    """Tests for the udiskie.watchdog.Watchdog class."""
+
+    def setUp(self):
+        self.timers = []
+        self.watchdog = Watchdog(
+            threshold=1.0,
+            schedule=lambda seconds, callback: self.timers.append(
+                (seconds, callback)))
+
+    def tearDown(self):
+        self.watchdog.close()
+
+    def check_while_waiting(self, heartbeat=False):
+        """Check from another thread while this thread waits in C code."""
+        if heartbeat:
+            # this frame runs the "main loop":
+            self.watchdog._heartbeat()
+        self.watchdog._beat -= 10
+        thread = threading.Timer(0.05, self.watchdog.check)
+        thread.start()
+        time.sleep(0.2)
+        thread.join()
+
+    def test_interval(self):
+        """Test that the heartbeat interval is derived from the threshold."""
+        [(seconds, callback)] = self.timers
+        self.assertEqual(0.5, seconds)
+        self.assertTrue(callback())
+
+    def test_stall(self):
+        """Test that a lag is counted if the main thread is busy."""
+        self.watchdog._heartbeat()
+        self.check_while_waiting()
+        self.assertEqual(1, sum(self.watchdog.stalls.values()))
+        self.assertGreater(self.watchdog.max_lag, 5)
+
+    def test_idle(self):
+        """Test that a lag is ignored while the main loop waits."""
+        self.check_while_waiting(heartbeat=True)
+        self.assertEqual({}, self.watchdog.stalls)
+        self.assertEqual(0, self.watchdog.max_lag)
@@ -2,7 +2,12 @@
 Automount utility.
 """
 
-__all__ = ['AutoMounter']
+import time
+
+from udiskie.common import Emitter, Histogram, drive_key
+
+
+__all__ = ['AutoMounter', 'ReadyLatency']
 
 
 class AutoMounter(object):
@@ -15,6 +20,9 @@ class AutoMounter(object):
     a Mounter object, like so:
 
     >>> AutoMounter(Mounter(udisks=Daemon()))
+
+    :ivar ReadyLatency latency: time from plugging in a drive until it is
+                                mounted
     """
 
     def __init__(self, mounter):
@@ -24,7 +32,10 @@ class AutoMounter(object):
         :param Mounter mounter: mounter object
         """
         self._mounter = mounter
-        mounter.udisks.connect_all(self)
+        self.latency = ReadyLatency(
+            backend=type(mounter.udisks).__module__.rpartition('.')[2])
+        # mounting is what users are waiting for, so it goes first:
+        mounter.udisks.connect_all(self, Emitter.PRIORITY_HIGH)
 
     def device_added(self, device):
         """
@@ -33,6 +44,7 @@ class AutoMounter(object):
         :param Device device: newly added device
         """
         if self._mounter.is_handleable(device):
+            self.latency.added(device)
             self._mounter.add(device)
 
     def media_added(self, device):
@@ -42,6 +54,7 @@ class AutoMounter(object):
         :param Device device: device with newly added media
         """
         if self._mounter.is_handleable(device):
+            self.latency.added(device)
             self._mounter.add(device)
 
     def device_changed(self, old_state, new_state):
@@ -54,4 +67,121 @@ class AutoMounter(object):
         # udisks2 sometimes adds empty devices and later updates them which
         # makes is_external become true not at device_added time:
         if self._mounter.is_handleable(new_state) and not self._mounter.is_handleable(old_state):
+            self.latency.added(new_state)
             self._mounter.add(new_state)
+
+    def device_unlocked(self, device):
+        """Remember that the drive needed to be unlocked."""
+        self.latency.unlocked(device)
+
+    def device_mounted(self, device):
+        """Record the hotplug latency of the drive."""
+        self.latency.mounted(device)
+
+    def device_removed(self, device):
+        """Count drives that were removed without being mounted."""
+        self.latency.removed(device)
+
+    def media_removed(self, device):
+        """Count media that were removed without being mounted."""
+        self.latency.removed(device)
+
+    def stats(self):
+        """
+        Return the hotplug latency statistics.
+
+        :rtype: dict
+        """
+        return self.latency.as_dict()
+
+
+class ReadyLatency(object):
+
+    """
+    Measure the time from plugging in a drive until it is ready.
+
+    Events are correlated by the drive containing the device. A drive is
+    pending from the first time one of its devices is added until one of
+    its filesystems is mounted. Drives that are removed before, or that
+    stay pending longer than the timeout, are counted as never ready.
+
+    :ivar dict never_ready: number of drives that were not mounted, by
+                            reason ('removed' or 'timeout')
+    """
+
+    def __init__(self, backend, timeout=300, clock=time.time):
+        """
+        Initialize empty statistics.
+
+        :param str backend: udisks backend name, used as label
+        :param float timeout: time in seconds after which pending drives
+                              are counted as never ready
+        :param callable clock: returns the current time in seconds
+        """
+        self._backend = backend
+        self._timeout = timeout
+        self._clock = clock
+        # {drive: [start time, whether a device was unlocked]}
+        self._pending = {}
+        # {(backend, fstype, unlocked): Histogram}
+        self._latency = {}
+        self.never_ready = {'removed': 0, 'timeout': 0}
+
+    def added(self, device):
+        """Start tracking the drive of a newly added device."""
+        self._expire()
+        self._pending.setdefault(drive_key(device), [self._clock(), False])
+
+    def unlocked(self, device):
+        """Mark the drive of the device as requiring an unlock."""
+        pending = self._pending.get(drive_key(device))
+        if pending:
+            pending[1] = True
+
+    def mounted(self, device):
+        """Record the latency if the drive of the device is pending."""
+        self._expire()
+        pending = self._pending.pop(drive_key(device), None)
+        if pending is None:
+            return
+        start, unlocked = pending
+        key = (self._backend, str(device.id_type), unlocked)
+        hist = self._latency.get(key)
+        if hist is None:
+            hist = self._latency[key] = Histogram()
+        hist.add(self._clock() - start)
+
+    def removed(self, device):
+        """Count a drive as never ready if it is removed while pending."""
+        # udisks2 reports media removal of drives that are already gone:
+        if device is None:
+            return
+        if self._pending.pop(drive_key(device), None) is not None:
+            self.never_ready['removed'] += 1
+
+    def _expire(self):
+        """Count drives that have been pending for too long."""
+        deadline = self._clock() - self._timeout
+        for drive, (start, unlocked) in list(self._pending.items()):
+            if start < deadline:
+                del self._pending[drive]
+                self.never_ready['timeout'] += 1
+
+    def as_dict(self):
+        """
+        Return the statistics.
+
+        :returns: ``{'latency': [...], 'never_ready': {...}, 'pending': N}``
+                  where each latency entry contains the labels ``backend``,
+                  ``fstype`` and ``unlock`` and the histogram summary
+        :rtype: dict
+        """
+        self._expire()
+        latency = []
+        for (backend, fstype, unlocked), hist in sorted(self._latency.items()):
+            entry = hist.as_dict()
+            entry.update(backend=backend, fstype=fstype, unlock=unlocked)
+            latency.append(entry)
+        return {'latency': latency,
+                'never_ready': dict(self.never_ready),
+                'pending': len(self._pending)}
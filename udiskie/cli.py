@@ -5,13 +5,17 @@ The application classes in this module are installed as executables via
 setuptools entry points.
 """
 
+from contextlib import contextmanager
 import logging
 import optparse
+import os
 import sys
+import threading
+import time
 import warnings
 
 
-__all__ = ['Daemon', 'Mount', 'Umount']
+__all__ = ['Daemon', 'Mount', 'Umount', 'Tray', 'Info', 'Monitor']
 
 
 warnings.filterwarnings("ignore", ".*could not open display.*", Warning)
@@ -28,8 +32,12 @@ def udisks_service_object(clsname, version=None):
     :raises dbus.DBusException: if unable to connect to UDisks dbus service.
     :raises ValueError: if the version is invalid
 
-    If ``version`` has a false truth value, try to connect to UDisks1 and
-    fall back to UDisks2 if not available.
+    If ``version`` has a false truth value, the version is detected from
+    the names on the system bus, see :func:`detect_udisks_version`. If
+    the detected version is not available (e.g. because the cached result
+    is outdated), the cache is cleared and the other version is tried.
+    Without detection result, try to connect to UDisks1 and fall back to
+    UDisks2 if not available.
     """
     def udisks1():
         import udiskie.udisks1
@@ -39,11 +47,21 @@ def udisks_service_object(clsname, version=None):
         return getattr(udiskie.udisks2, clsname)()
     if not version:
         from udiskie.dbus import DBusException
+        log = logging.getLogger(__name__)
+        version = detect_udisks_version()
+        if version:
+            try:
+                return udisks_service_object(clsname, version)
+            except DBusException:
+                msg = sys.exc_info()[1].get_dbus_message()
+                log.warning('Failed to connect UDisks%d dbus service: %s.\n'
+                            'Trying UDisks%d.' % (version, msg, 3 - version))
+                _clear_udisks_version_cache()
+                return udisks_service_object(clsname, 3 - version)
         try:
             return udisks1()
         except DBusException:
             msg = sys.exc_info()[1].get_dbus_message()
-            log = logging.getLogger(__name__)
             log.warning('Failed to connect UDisks1 dbus service: %s.\n'
                         'Falling back to UDisks2 [experimental].' % (msg,))
             return udisks2()
@@ -55,6 +73,312 @@ def udisks_service_object(clsname, version=None):
         raise ValueError("UDisks version not supported: %s!" % (version,))
 
 
+# bus names of the supported udisks versions in order of preference:
+_udisks_bus_names = [(1, 'org.freedesktop.UDisks'),
+                     (2, 'org.freedesktop.UDisks2')]
+
+
+def detect_udisks_version():
+    """
+    Detect the available udisks version without activating any service.
+
+    :returns: udisks version, ``0`` if undetermined
+    :rtype: int
+
+    A running udisks service is preferred over an activatable one. The
+    result is cached in the user's cache directory as long as the owners
+    of the udisks bus names don't change.
+    """
+    from udiskie.dbus import BusInfo, DBusException
+    log = logging.getLogger(__name__)
+    try:
+        bus_info = BusInfo()
+    except DBusException:
+        log.debug('failed to connect system bus: %s' % (sys.exc_info()[1],))
+        return 0
+    cache_file = _udisks_version_cache()
+    try:
+        owners = ','.join(bus_info.name_owner(name) or '-'
+                          for version, name in _udisks_bus_names)
+        try:
+            with open(cache_file) as f:
+                cached_owners, cached_version = f.read().split()
+            if cached_owners == owners:
+                return int(cached_version)
+        except (IOError, ValueError):
+            pass
+        version = 0
+        for list_names in (bus_info.names, bus_info.activatable_names):
+            names = list_names()
+            available = [v for v, name in _udisks_bus_names if name in names]
+            if available:
+                version = available[0]
+                break
+    except DBusException:
+        log.debug('failed to query system bus: %s' % (sys.exc_info()[1],))
+        return 0
+    finally:
+        bus_info.close()
+    if version:
+        log.debug('detected UDisks%d' % (version,))
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            with open(cache_file, 'w') as f:
+                f.write('%s %d\n' % (owners, version))
+        except (IOError, OSError):
+            pass
+    return version
+
+
+def _udisks_version_cache():
+    """Return the path of the udisks version cache file."""
+    try:
+        from xdg.BaseDirectory import xdg_cache_home as cache_home
+    except ImportError:
+        cache_home = os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'udiskie', 'udisks_version')
+
+
+def _clear_udisks_version_cache():
+    """Remove the udisks version cache file."""
+    try:
+        os.unlink(_udisks_version_cache())
+    except OSError:
+        pass
+
+
+class StartupProfile(object):
+
+    """
+    Measure the time spent in the startup phases of the daemon.
+
+    Phases are either timed with the context manager returned by calling
+    the profile, or marked as finished at a certain point in time with
+    :meth:`mark`. The latter measures the time since the previous mark.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        Start measuring.
+
+        :param bool enabled: if false, :meth:`report` does nothing
+        """
+        self._enabled = enabled
+        self._start = self._last = time.time()
+        self._phases = []
+
+    @contextmanager
+    def __call__(self, name):
+        """Time the enclosed block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._phases.append((name, time.time() - start))
+
+    def mark(self, name):
+        """Finish a phase at the current point in time."""
+        now = time.time()
+        self._phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self):
+        """Print the duration of all phases to stderr."""
+        if not self._enabled:
+            return
+        for name, duration in self._phases:
+            sys.stderr.write('%-12s %8.3f s\n' % (name, duration))
+        sys.stderr.write('%-12s %8.3f s\n' % ('total',
+                                               time.time() - self._start))
+
+
+def _background(func):
+    """
+    Run the function in a separate thread.
+
+    :param callable func: zero-parameter function
+    :returns: function that waits for and returns the result, or reraises
+              the exception raised by ``func``
+    :rtype: callable
+
+    Enables thread support in gobject and dbus-python, since the function
+    runs concurrently with the main loop.
+    """
+    import gobject
+    import udiskie.dbus
+    gobject.threads_init()
+    udiskie.dbus.threads_init()
+    result = []
+    def run():
+        try:
+            result.append((func(), None))
+        except Exception:
+            result.append((None, sys.exc_info()[1]))
+    thread = threading.Thread(target=run)
+    thread.start()
+    def wait():
+        thread.join()
+        value, error = result[0]
+        if error is not None:
+            raise error
+        return value
+    return wait
+
+
+def _idle_iter(iterable, on_finish=None):
+    """
+    Create an idle callback that advances the iterator one step per call.
+
+    :param iterable iterable: work items
+    :param callable on_finish: invoked when the iterator is exhausted
+    :returns: callback for ``gobject.idle_add``
+    :rtype: callable
+    """
+    iterator = iter(iterable)
+    def step():
+        try:
+            next(iterator)
+        except StopIteration:
+            if on_finish:
+                on_finish()
+            return False
+        return True
+    return step
+
+
+def _daemon_mounter(options):
+    """
+    Connect to the control socket of a running udiskie daemon.
+
+    :param options: program options as returned by optparse
+    :returns: mounter that delegates to the daemon, ``None`` if the daemon
+              is not running, disabled with ``--no-daemon`` or if options
+              were given that the daemon can't honor
+    :rtype: udiskie.ipc.SyncClient
+
+    The daemon uses its own config file, filters and password prompt and
+    doesn't mount recursively on request. Operations are executed locally
+    if any of ``--config``, ``--password-prompt`` or ``--recursive`` is
+    given.
+    """
+    if not options.use_daemon:
+        return None
+    log = logging.getLogger(__name__)
+    if (options.config_file is not None or
+            getattr(options, 'recursive', False) or
+            getattr(options, 'password_prompt', 'zenity') != 'zenity'):
+        log.debug('not using udiskie daemon due to local options')
+        return None
+    import socket
+    import udiskie.ipc
+    try:
+        mounter = udiskie.ipc.SyncClient()
+    except socket.error:
+        return None
+    log.debug('using udiskie daemon')
+    return mounter
+
+
+def _daemon_errors(run):
+    """
+    Execute the operations, report if the udiskie daemon fails to reply.
+
+    :param callable run: zero-parameter function returning the exit code
+    :returns: the exit code, 1 if the connection to the daemon is lost
+    :rtype: int
+
+    The daemon may still execute the pending operation, so it is not
+    retried locally.
+    """
+    from udiskie.ipc import DaemonError
+    try:
+        return run()
+    except DaemonError:
+        logging.getLogger(__name__).error(
+            'udiskie daemon failed: %s' % (sys.exc_info()[1],))
+        return 1
+
+
+def _exit_code(results):
+    """
+    Return the program exit code for the results of mount operations.
+
+    :param list results: return values of the operations
+    :returns: 0 if all succeeded, 1 if any failed, 2 if operations are
+              still waiting for a password in the udiskie daemon
+    :rtype: int
+    """
+    if any(result is False for result in results):
+        return 1
+    if any(result is None for result in results):
+        logging.getLogger(__name__).info(
+            'waiting for password in udiskie daemon')
+        return 2
+    return 0
+
+
+# operations allowed in batch files:
+_batch_methods = ['mount', 'unmount', 'unlock', 'lock',
+                  'add', 'remove', 'eject', 'detach']
+
+
+def _run_batch(mounter, filename):
+    """
+    Execute operations read from a file and print a status line for each.
+
+    :param mounter: Mounter or :class:`udiskie.ipc.SyncClient`
+    :param str filename: file name, '-' for stdin
+    :returns: results of the operations, ``False`` for invalid lines
+    :rtype: list
+
+    Each line of the file consists of a method name and a device
+    specification (see :func:`udiskie.mount.device_spec`). Empty lines and
+    comments starting with '#' are ignored. The status lines have the form
+    ``LINE<TAB>ok|failed|pending|invalid<TAB>OPERATION``, where 'pending'
+    means that the daemon is still waiting for a password.
+    """
+    if filename == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(filename) as f:
+            lines = f.readlines()
+    operations = []
+    invalid = []
+    def report(lineno, outcome, text):
+        sys.stdout.write('%d\t%s\t%s\n' % (lineno, outcome, text))
+        sys.stdout.flush()
+    def status(result):
+        if result is None:
+            return 'pending'
+        return 'ok' if result else 'failed'
+    for lineno, line in enumerate(lines, 1):
+        text = line.split('#', 1)[0].strip()
+        if not text:
+            continue
+        words = text.split(None, 1)
+        if words[0] not in _batch_methods or len(words) != 2:
+            report(lineno, 'invalid', text)
+            invalid.append(False)
+            continue
+        operations.append((lineno, words[0], words[1], text))
+    run_batch = getattr(mounter, 'run_batch', None)
+    if run_batch:
+        # direct mode: serialized per drive, parallel across drives
+        results = run_batch(
+            [(method, spec) for lineno, method, spec, text in operations],
+            lambda index, result: report(operations[index][0],
+                                         status(result),
+                                         operations[index][3]))
+    else:
+        # the daemon executes the requests one after another
+        results = []
+        for lineno, method, spec, text in operations:
+            results.append(getattr(mounter, method)(spec))
+            report(lineno, status(results[-1]), text)
+    return invalid + list(results)
+
+
 class _EntryPoint(object):
 
     """
@@ -86,6 +410,13 @@ class _EntryPoint(object):
         parser.add_option('-C', '--config', dest='config_file',
                           action='store', default=None,
                           metavar='FILE', help='config file')
+        parser.add_option('--stats', dest='stats',
+                          action='store_true', default=False,
+                          help='print DBus statistics on exit')
+        parser.add_option('--trace', dest='trace',
+                          action='store', default=None, metavar='FILE',
+                          help='write a Chrome trace of all operations '
+                               'to FILE on exit')
         return parser
 
     def __init__(self, argv=None):
@@ -109,6 +440,10 @@ class _EntryPoint(object):
         config = udiskie.config.Config.from_file(options.config_file)
         parser.set_defaults(**config.program_options)
         options, posargs = parser.parse_args(argv)
+        # instrumentation must be enabled before connecting to DBus:
+        if options.stats:
+            import udiskie.dbus
+            udiskie.dbus.enable_stats()
         # initialize instance variables
         self.config = config
         self.options = options
@@ -124,7 +459,47 @@ class _EntryPoint(object):
         :returns: program exit code
         :rtype: int
         """
-        return cls(argv).run()
+        program = cls(argv)
+        try:
+            return program.run()
+        finally:
+            if program.options.stats:
+                program.print_stats()
+            if program.options.trace:
+                program.write_trace(program.options.trace)
+
+    def stats(self):
+        """
+        Return runtime statistics.
+
+        :returns: JSON serializable statistics, grouped by component
+        :rtype: dict
+        """
+        import udiskie.dbus
+        stats = {}
+        if udiskie.dbus.stats is not None:
+            stats['dbus'] = udiskie.dbus.stats.as_dict()
+        return stats
+
+    def print_stats(self):
+        """Print statistics to stderr."""
+        import json
+        import udiskie.dbus
+        stats = self.stats()
+        if stats.pop('dbus', None) is not None:
+            sys.stderr.write(udiskie.dbus.stats.format() + '\n')
+        if stats:
+            sys.stderr.write(json.dumps(stats, indent=2, sort_keys=True)
+                             + '\n')
+
+    def write_trace(self, filename):
+        """Write the spans recorded by the mounter to a trace file."""
+        tracer = getattr(getattr(self, 'mounter', None), 'tracer', None)
+        if tracer is None:
+            logging.getLogger(__name__).warning(
+                'No trace recorded: operations were executed by the daemon')
+            return
+        tracer.dump(filename)
 
     def _init(self, config, options, posargs):
         """
@@ -159,6 +534,9 @@ class Daemon(_EntryPoint):
     - :class:`automount.AutoMounter`
     - :class:`notify.Notify`
     - :class:`tray.TrayIcon`
+    - :class:`ipc.Server` (to run the tray icon in a separate process)
+    - :class:`prometheus.TextfileExporter`
+    - :class:`watchdog.Watchdog`
     """
 
     @classmethod
@@ -184,66 +562,191 @@ class Daemon(_EntryPoint):
         parser.add_option('-N', '--no-automount', action='store_false',
                           dest='automount', default=True,
                           help="do not automount new devices")
+        parser.add_option('--password-cache', dest='password_cache',
+                          action='store', default=None, metavar='SECONDS',
+                          help="remember passwords for the given time")
+        parser.add_option('-S', '--serve', dest='serve',
+                          action='store_true', default=True,
+                          help="accept requests on the control socket "
+                               "(default)")
+        parser.add_option('--no-serve', dest='serve',
+                          action='store_false', default=True,
+                          help="disable the control socket")
+        parser.add_option('--profile-startup', dest='profile_startup',
+                          action='store_true', default=False,
+                          help="print time spent in each startup phase")
+        parser.add_option('--prometheus-file', dest='prometheus_file',
+                          action='store', default=None, metavar='FILE',
+                          help="write metrics in the Prometheus text format "
+                               "to FILE")
+        parser.add_option('--prometheus-interval', dest='prometheus_interval',
+                          action='store', default=15, metavar='SECONDS',
+                          help="update interval for --prometheus-file")
+        parser.add_option('--watchdog', dest='watchdog',
+                          action='store', default=None, metavar='SECONDS',
+                          help="log main loop stalls longer than SECONDS")
         return parser
 
     def _init(self, config, options, posargs):
 
-        """Implements _EntryPoint._init."""
+        """
+        Implements _EntryPoint._init.
 
-        import gobject
-        import udiskie.mount
-        import udiskie.prompt
+        The notification service is initialized in a background thread
+        while connecting to udisks. The tray icon is created (and gtk
+        imported) only after the main loop has started.
+        """
+
+        profile = StartupProfile(options.profile_startup)
+        self.profile = profile
+
+        with profile('imports'):
+            import gobject
+            import udiskie.mount
+            import udiskie.prompt
+
+        # notifications (optional):
+        notify = None
+        if not options.suppress_notify:
+            def init_notify_service():
+                with profile('notify'):
+                    try:
+                        import notify2 as notify_service
+                    except ImportError:
+                        import pynotify as notify_service
+                    notify_service.init('udiskie.mount')
+                    return notify_service
+            notify_service = _background(init_notify_service)
+
+        if options.prometheus_file:
+            # DBus latency is part of the exported metrics:
+            import udiskie.dbus
+            udiskie.dbus.enable_stats()
 
         mainloop = gobject.MainLoop()
-        daemon = udisks_service_object('Daemon', int(options.udisks_version))
+        with profile('udisks'):
+            daemon = udisks_service_object('Daemon',
+                                           int(options.udisks_version))
+        # run notifications and tray updates after the automounter:
+        daemon.defer_low_priority = True
+        if options.stats:
+            daemon.enable_timing()
         browser = udiskie.prompt.browser(options.file_manager)
+        if options.password_cache:
+            cache = udiskie.prompt.PasswordCache(float(options.password_cache))
+        else:
+            cache = None
         mounter = udiskie.mount.Mounter(
             filter=config.filter_options,
-            prompt=udiskie.prompt.password(options.password_prompt),
+            prompt=udiskie.prompt.password(options.password_prompt,
+                                           blocking=False),
             browser=browser,
+            keyfiles=config.keyfiles,
+            cache=cache,
             udisks=daemon)
 
-        # notifications (optional):
         if not options.suppress_notify:
             import udiskie.notify
-            try:
-                import notify2 as notify_service
-            except ImportError:
-                import pynotify as notify_service
-            notify_service.init('udiskie.mount')
-            notify = udiskie.notify.Notify(notify_service,
+            notify = udiskie.notify.Notify(notify_service(),
                                            mounter=mounter,
                                            timeout=config.notifications)
 
         # tray icon (optional):
         if options.tray:
-            import udiskie.tray
-            tray_classes = {'TrayIcon': udiskie.tray.TrayIcon,
-                            'AutoTray': udiskie.tray.AutoTray}
-            if options.tray not in tray_classes:
+            if options.tray not in ('TrayIcon', 'AutoTray'):
                 raise ValueError("Invalid tray: %s" % (options.tray,))
-            menu_maker = udiskie.tray.SmartUdiskieMenu(
-                mounter,
-                {'quit': mainloop.quit})
-            TrayIcon = tray_classes[options.tray]
-            statusicon = TrayIcon(menu_maker)
-        else:
-            statusicon = None
+            gobject.idle_add(self._init_tray)
 
         # automounter
+        automounter = None
         if options.automount:
             import udiskie.automount
-            udiskie.automount.AutoMounter(mounter)
+            automounter = udiskie.automount.AutoMounter(mounter)
+
+        # control socket (optional):
+        server = None
+        if options.serve:
+            import socket
+            import udiskie.ipc
+            try:
+                server = udiskie.ipc.Server(mounter, stats=self.stats)
+            except socket.error:
+                logging.getLogger(__name__).warning(
+                    'Failed to open control socket: %s' % (sys.exc_info()[1],))
 
-        # Note: mounter and statusicon are saved so these are kept alive:
+        # metrics export (optional):
+        exporter = None
+        if options.prometheus_file:
+            import udiskie.dbus
+            import udiskie.prometheus
+            exporter = udiskie.prometheus.TextfileExporter(
+                options.prometheus_file,
+                mounter,
+                notify=notify,
+                dbus_stats=udiskie.dbus.stats,
+                interval=float(options.prometheus_interval))
+
+        # Note: mounter, statusicon, server and exporter are saved so these
+        # are kept alive:
         self.mainloop = mainloop
         self.mounter = mounter
-        self.statusicon = statusicon
+        self.automounter = automounter
+        self.statusicon = None
+        self.server = server
+        self.exporter = exporter
+        self.watchdog = None
+
+    def stats(self):
+        """Extends _EntryPoint.stats."""
+        stats = super(Daemon, self).stats()
+        if self.automounter:
+            stats['automount'] = self.automounter.stats()
+        if self.watchdog:
+            stats['watchdog'] = self.watchdog.as_dict()
+        handler_stats = self.mounter.udisks.handler_stats
+        if handler_stats is not None:
+            stats['handlers'] = dict(
+                (name, {'count': count, 'total': total, 'max': max_})
+                for name, (count, total, max_) in handler_stats.items())
+        return stats
+
+    def _init_tray(self):
+        """Create the tray icon from the main loop."""
+        with self.profile('tray'):
+            import udiskie.tray
+            tray_classes = {'TrayIcon': udiskie.tray.TrayIcon,
+                            'AutoTray': udiskie.tray.AutoTray}
+            menu_maker = udiskie.tray.SmartUdiskieMenu(
+                self.mounter,
+                {'quit': self.mainloop.quit})
+            TrayIcon = tray_classes[self.options.tray]
+            self.statusicon = TrayIcon(menu_maker)
+        return False
 
     def run(self):
-        """Implements _EntryPoint.run."""
+        """
+        Implements _EntryPoint.run.
+
+        The initial automount is executed from idle callbacks, one device
+        at a time, so that events can be handled in between.
+        """
+        import gobject
+        profile = self.profile
+        profile.mark('init')
+        def on_startup_complete():
+            profile.mark('automount')
+            profile.report()
         if self.options.automount:
-            self.mounter.add_all()
+            gobject.idle_add(_idle_iter(self.mounter.iter_add_all(),
+                                        on_startup_complete))
+        else:
+            gobject.idle_add(_idle_iter([], profile.report))
+        if self.options.watchdog:
+            import udiskie.watchdog
+            self.watchdog = udiskie.watchdog.Watchdog(
+                float(self.options.watchdog))
+            if self.exporter:
+                self.exporter.watchdog = self.watchdog
         try:
             return self.mainloop.run()
         except KeyboardInterrupt:
@@ -269,36 +772,172 @@ class Mount(_EntryPoint):
         parser.add_option('-r', '--recursive', dest='recursive',
                           action='store_true', default=False,
                           help='recursively mount LUKS partitions (if the automount daemon is running, this is not necessary)')
+        parser.add_option('--no-daemon', dest='use_daemon',
+                          action='store_false', default=True,
+                          help="don't use a running udiskie daemon")
+        parser.add_option('-w', '--wait', dest='wait',
+                          action='store_true', default=False,
+                          help="wait for the device to appear, mount it "
+                               "and print the mount path. The device is "
+                               "specified as uuid=UUID, label=LABEL or path")
+        parser.add_option('--timeout', dest='timeout',
+                          action='store', default=None, metavar='SECONDS',
+                          help="maximum time to wait (with --wait)")
+        parser.add_option('--batch', dest='batch',
+                          action='store', default=None, metavar='FILE',
+                          help="read operations from FILE ('-' for stdin), "
+                               "one per line: METHOD DEVICE")
         return parser
 
     def _init(self, config, options, posargs):
-        """Implements _EntryPoint._init."""
+        """
+        Implements _EntryPoint._init.
+
+        Uses the running udiskie daemon if available. Waiting for devices
+        needs udisks signals and always connects udisks directly, but the
+        device is still mounted by the daemon, see :meth:`_wait`.
+        """
+        self.client = _daemon_mounter(options)
+        if self.client and not options.wait:
+            self.mounter = self.client
+            return
         import udiskie.mount
         import udiskie.prompt
+        clsname = 'Daemon' if options.wait else 'Sniffer'
         self.mounter = udiskie.mount.Mounter(
             filter=config.filter_options,
             prompt=udiskie.prompt.password(options.password_prompt),
-            udisks=udisks_service_object('Sniffer', int(options.udisks_version)))
+            keyfiles=config.keyfiles,
+            udisks=udisks_service_object(clsname, int(options.udisks_version)))
 
     def run(self):
         """Implements _EntryPoint.run."""
+        return _daemon_errors(self._run)
+
+    def _run(self):
         options = self.options
         posargs = self.posargs
         mounter = self.mounter
         recursive = options.recursive
+        # execute operations from file
+        if options.batch:
+            return _exit_code(_run_batch(mounter, options.batch))
+        # wait for a device to appear
+        elif options.wait and len(posargs) == 1:
+            timeout = float(options.timeout) if options.timeout else None
+            mount_path = self._wait(posargs[0], timeout)
+            if mount_path:
+                sys.stdout.write(mount_path + '\n')
+            results = [bool(mount_path)]
         # mount all present devices
-        if options.all:
-            success = mounter.add_all(recursive=recursive)
+        elif options.all:
+            results = [mounter.add_all(recursive=recursive)]
         # only mount the desired devices
         elif len(posargs) > 0:
-            success = True
+            results = []
             for path in posargs:
-                success = success and mounter.add(path, recursive=recursive)
+                results.append(mounter.add(path, recursive=recursive))
+                if results[-1] is False:
+                    break
         # print command line options
         else:
             self.program_options_parser().print_help()
-            success = False
-        return 0 if success else 1
+            results = [False]
+        return _exit_code(results)
+
+    def _wait(self, spec, timeout=None):
+        """
+        Wait until the specified device is present and mount it.
+
+        :param str spec: device specification, see
+                         :func:`udiskie.mount.device_spec`
+        :param float timeout: maximum time to wait in seconds
+        :returns: mount path, ``None`` on failure or timeout
+        :rtype: str
+
+        If the device is a LUKS container, it is unlocked and its cleartext
+        device is mounted. The current state is checked after subscribing
+        to udisks events, so no device can be missed.
+
+        If a udiskie daemon is running, the operations are delegated to it,
+        so the user is not prompted twice for the same device. Otherwise,
+        if an operation fails, it is checked whether somebody else has
+        done it in the meantime.
+        """
+        import gobject
+        import udiskie.ipc
+        import udiskie.mount
+        mounter = self.mounter
+        client = self.client
+        daemon = mounter.udisks
+        log = logging.getLogger(__name__)
+        matches = udiskie.mount.device_spec(spec)
+        def predicate(device):
+            if not mounter.is_handleable(device):
+                return False
+            if matches(device):
+                return True
+            return (device.is_luks_cleartext and
+                    matches(device.luks_cleartext_slave))
+        mainloop = gobject.MainLoop()
+        result = []
+        def finish(mount_path):
+            if not result:
+                result.append(mount_path)
+                mainloop.quit()
+            return False
+        def operation(method, device):
+            if client:
+                return getattr(client, method)(device.object_path)
+            return getattr(mounter, method)(device)
+        def recheck(device):
+            # the state from the query may be outdated:
+            try:
+                device = daemon.update(device.object_path)
+            except KeyError:
+                device = None
+            if device and device.is_mounted:
+                finish(device.mount_paths[0])
+            elif not (device and device.is_crypto and device.is_unlocked):
+                finish(None)
+        def handle(device):
+            try:
+                if device.is_mounted:
+                    finish(device.mount_paths[0])
+                elif device.is_filesystem:
+                    # the path is reported by the 'device_mounted' event:
+                    if not operation('mount', device):
+                        recheck(device)
+                elif device.is_crypto and not device.is_unlocked:
+                    # the cleartext device will be matched by the query,
+                    # ``None`` means the daemon is prompting for a password:
+                    if operation('unlock', device) is False:
+                        recheck(device)
+            except udiskie.ipc.DaemonError:
+                log.error('udiskie daemon failed: %s' % (sys.exc_info()[1],))
+                finish(None)
+            return False
+        def on_match(device, matched):
+            if matched:
+                gobject.idle_add(handle, device)
+        def on_mounted(device):
+            if device.object_path in query:
+                finish(device.mount_paths[0])
+        daemon.connect('device_mounted', on_mounted)
+        query = daemon.query(predicate, on_match)
+        if timeout is not None:
+            def on_timeout():
+                log.error('timeout waiting for device: %s' % (spec,))
+                return finish(None)
+            gobject.timeout_add(int(timeout * 1000), on_timeout)
+        try:
+            mainloop.run()
+        except KeyboardInterrupt:
+            pass
+        query.close()
+        if client:
+            client.close()
+        return result[0] if result else None
 
 
 class Umount(_EntryPoint):
@@ -317,29 +956,359 @@ class Umount(_EntryPoint):
                           action='store_true', help='Eject media from drive (CDROM etc)')
         parser.add_option('-d', '--detach', dest='detach', default=False,
                           action='store_true', help='Detach drive (power off)')
+        parser.add_option('--no-daemon', dest='use_daemon',
+                          action='store_false', default=True,
+                          help="don't use a running udiskie daemon")
+        parser.add_option('--batch', dest='batch',
+                          action='store', default=None, metavar='FILE',
+                          help="read operations from FILE ('-' for stdin), "
+                               "one per line: METHOD DEVICE")
         return parser
 
     def _init(self, config, options, posargs):
-        """Implements _EntryPoint._init."""
+        """
+        Implements _EntryPoint._init.
+
+        Uses the running udiskie daemon if available.
+        """
+        self.mounter = _daemon_mounter(options)
+        if self.mounter:
+            return
         import udiskie.mount
         self.mounter = udiskie.mount.Mounter(
-            udisks=udisks_service_object('Sniffer', int(options.udisks_version)))
+            udisks=udisks_service_object('Sniffer',
+                                         int(options.udisks_version)))
 
     def run(self):
         """Implements _EntryPoint.run."""
+        return _daemon_errors(self._run)
+
+    def _run(self):
         options = self.options
         posargs = self.posargs
         mounter = self.mounter
-        if options.all:
-            success = mounter.remove_all(detach=options.detach,
-                                         eject=options.eject, lock=True)
+        if options.batch:
+            return _exit_code(_run_batch(mounter, options.batch))
+        elif options.all:
+            results = [mounter.remove_all(detach=options.detach,
+                                          eject=options.eject, lock=True)]
         elif len(posargs) > 0:
-            success = True
+            results = []
             for path in posargs:
-                success = (success and
-                           mounter.remove(path, detach=options.detach,
-                                          eject=options.eject, lock=True))
+                results.append(mounter.remove(path, detach=options.detach,
+                                              eject=options.eject, lock=True))
+                if results[-1] is False:
+                    break
         else:
             self.program_options_parser().print_help()
-            success = False
-        return 0 if success else 1
+            results = [False]
+        return _exit_code(results)
+
+
+class Tray(_EntryPoint):
+
+    """
+    Show the tray icon for a udiskie daemon running in another process.
+
+    The daemon must not be started with the ``--no-serve`` option. All
+    device operations are executed by the daemon, so the tray icon stays
+    responsive while the daemon is busy and vice versa.
+    """
+
+    @classmethod
+    def program_options_parser(cls):
+        """Extends _EntryPoint._program_options_parser."""
+        parser = _EntryPoint.program_options_parser()
+        parser.add_option('-t', '--tray', dest='tray',
+                          action='store_const', default='TrayIcon',
+                          const='TrayIcon', help='show tray icon')
+        parser.add_option('-T', '--auto-tray', dest='tray',
+                          action='store_const', default='TrayIcon',
+                          const='AutoTray', help='show tray icon')
+        parser.add_option('-F', '--file-manager', action='store',
+                          dest='file_manager', default='xdg-open',
+                          metavar='PROGRAM',
+                          help="to open mount pathes [deprecated]")
+        parser.add_option('--socket', dest='socket', action='store',
+                          default=None, metavar='PATH',
+                          help="control socket of the daemon")
+        return parser
+
+    def _init(self, config, options, posargs):
+        """Implements _EntryPoint._init."""
+        import gobject
+        import udiskie.ipc
+        import udiskie.prompt
+        import udiskie.tray
+
+        mainloop = gobject.MainLoop()
+        udisks = udiskie.ipc.RemoteDaemon(options.socket)
+        mounter = udiskie.ipc.RemoteMounter(
+            udisks,
+            browser=udiskie.prompt.browser(options.file_manager))
+        tray_classes = {'TrayIcon': udiskie.tray.TrayIcon,
+                        'AutoTray': udiskie.tray.AutoTray}
+        if options.tray not in tray_classes:
+            raise ValueError("Invalid tray: %s" % (options.tray,))
+        menu_maker = udiskie.tray.SmartUdiskieMenu(
+            mounter,
+            {'quit': mainloop.quit})
+        TrayIcon = tray_classes[options.tray]
+
+        # Note: statusicon is saved so it is kept alive:
+        self.mainloop = mainloop
+        self.statusicon = TrayIcon(menu_maker)
+
+    def run(self):
+        """Implements _EntryPoint.run."""
+        try:
+            return self.mainloop.run()
+        except KeyboardInterrupt:
+            return 0
+
+
+def _object_path(device):
+    return device.object_path if device else None
+
+
+class Info(_EntryPoint):
+
+    """
+    Print the properties of all devices known to udisks.
+
+    All information is taken from a single snapshot of the udisks state,
+    so this is fast and consistent.
+    """
+
+    # available fields: (name, getter(mounter, device))
+    fields = [
+        ('object_path', lambda m, d: d.object_path),
+        ('device_file', lambda m, d: d.device_presentation),
+        ('label', lambda m, d: d.id_label),
+        ('uuid', lambda m, d: d.id_uuid),
+        ('type', lambda m, d: d.id_type),
+        ('usage', lambda m, d: d.id_usage),
+        ('mount_paths', lambda m, d: d.mount_paths),
+        ('is_handleable', lambda m, d: m.is_handleable(d)),
+        ('is_external', lambda m, d: d.is_external),
+        ('is_filesystem', lambda m, d: d.is_filesystem),
+        ('is_mounted', lambda m, d: d.is_mounted),
+        ('is_crypto', lambda m, d: d.is_crypto),
+        ('is_unlocked', lambda m, d: d.is_unlocked),
+        ('is_drive', lambda m, d: d.is_drive),
+        ('is_partition', lambda m, d: d.is_partition),
+        ('is_partition_table', lambda m, d: d.is_partition_table),
+        ('partition_slave', lambda m, d: _object_path(d.partition_slave)),
+        ('luks_cleartext_slave',
+         lambda m, d: _object_path(d.luks_cleartext_slave)),
+        ('drive', lambda m, d: _object_path(d.drive)),
+        ('mount_options', lambda m, d: m._filter.get_mount_options(d)),
+    ]
+
+    @classmethod
+    def program_options_parser(cls):
+        """Extends _EntryPoint._program_options_parser."""
+        parser = _EntryPoint.program_options_parser()
+        parser.add_option('-o', '--output', dest='output',
+                          action='store', default='json',
+                          metavar='FORMAT',
+                          help="output format: 'json' (default) or 'tsv'")
+        parser.add_option('-k', '--fields', dest='fields',
+                          action='store', default=None,
+                          metavar='FIELDS',
+                          help="comma separated list of fields, available: "
+                               + ', '.join(name for name, _ in cls.fields))
+        parser.add_option('-a', '--all', dest='all',
+                          action='store_true', default=False,
+                          help="include devices not handled by udiskie")
+        parser.add_option('--daemon-stats', dest='daemon_stats',
+                          action='store_true', default=False,
+                          help="print statistics of the running daemon")
+        return parser
+
+    def _init(self, config, options, posargs):
+        """Implements _EntryPoint._init."""
+        import udiskie.mount
+        if options.daemon_stats:
+            return
+        if options.output not in ('json', 'tsv'):
+            raise ValueError("Invalid output format: %s" % (options.output,))
+        self.columns = self._columns(options.fields)
+        # one-shot enumeration, no need to listen to changes:
+        sniffer = udisks_service_object('Sniffer', int(options.udisks_version))
+        self.snapshot = sniffer.freeze()
+        self.mounter = udiskie.mount.Mounter(
+            filter=config.filter_options,
+            udisks=self.snapshot)
+
+    @classmethod
+    def _columns(cls, fields):
+        """
+        Return the selected fields.
+
+        :param str fields: comma separated field names, ``None`` for all
+        :returns: list of ``(name, getter)`` pairs
+        :rtype: list
+        :raises ValueError: if a field name is unknown
+        """
+        if not fields:
+            return list(cls.fields)
+        getters = dict(cls.fields)
+        names = [name.strip() for name in fields.split(',')]
+        for name in names:
+            if name not in getters:
+                raise ValueError("Invalid field: %s" % (name,))
+        return [(name, getters[name]) for name in names]
+
+    def run(self):
+        """Implements _EntryPoint.run."""
+        if self.options.daemon_stats:
+            return self._print_daemon_stats()
+        mounter = self.mounter
+        devices = sorted(self.snapshot, key=lambda device: device.object_path)
+        if not self.options.all:
+            devices = [device for device in devices
+                       if mounter.is_handleable(device)]
+        rows = [[(name, _json_value(name, getter(mounter, device)))
+                 for name, getter in self.columns]
+                for device in devices]
+        if self.options.output == 'json':
+            import json
+            from collections import OrderedDict
+            json.dump([OrderedDict(row) for row in rows], sys.stdout,
+                      indent=2)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.write('\t'.join(name for name, _ in self.columns))
+            sys.stdout.write('\n')
+            for row in rows:
+                sys.stdout.write('\t'.join(_tsv_value(value)
+                                           for name, value in row))
+                sys.stdout.write('\n')
+        return 0
+
+    def _print_daemon_stats(self):
+        """Query the statistics of the running daemon and print as JSON."""
+        import json
+        import socket
+        import udiskie.ipc
+        try:
+            client = udiskie.ipc.SyncClient()
+        except socket.error:
+            logging.getLogger(__name__).error('udiskie daemon is not running')
+            return 1
+        try:
+            stats = client.stats()
+        except udiskie.ipc.DaemonError:
+            logging.getLogger(__name__).error(
+                'udiskie daemon failed: %s' % (sys.exc_info()[1],))
+            return 1
+        finally:
+            client.close()
+        json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return 0
+
+
+def _json_value(name, value):
+    """Convert DBus values of the named field to plain python types."""
+    from udiskie.compat import unicode
+    if name.startswith('is_'):
+        return bool(value)
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [unicode(item) for item in value]
+    return unicode(value)
+
+
+def _tsv_value(value):
+    """Format a value as tab separated field."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, list):
+        return ','.join(map(_tsv_value, value))
+    return '%s' % (value,)
+
+
+class Monitor(_EntryPoint):
+
+    """
+    Print udisks events as JSON lines.
+
+    Each line is a JSON object with the keys 'time' (seconds since the
+    epoch), 'event', 'object_path' and 'device' (the device properties,
+    see :func:`udiskie.ipc.device_record`), the latter two are ``null``
+    if the device is not known anymore. Events with additional
+    parameters carry them in further keys. Output is flushed after every
+    line.
+    """
+
+    # event name => names of the additional event parameters
+    events = {
+        'device_added': (),
+        'device_removed': (),
+        'device_mounted': (),
+        'device_unmounted': (),
+        'device_locked': (),
+        'device_unlocked': (),
+        'media_added': (),
+        'media_removed': (),
+        'device_changed': (),
+        'label_changed': ('old', 'new'),
+        'size_changed': ('old', 'new'),
+        'job_failed': ('action', 'message'),
+    }
+
+    def _init(self, config, options, posargs):
+        """Implements _EntryPoint._init."""
+        import gobject
+        self.mainloop = gobject.MainLoop()
+        self.daemon = udisks_service_object('Daemon',
+                                            int(options.udisks_version))
+        for event, params in self.events.items():
+            self.daemon.connect(event, self._handler(event, params))
+
+    def _handler(self, event, params):
+        """Create the handler for an event."""
+        def handler(device, *args):
+            if event == 'device_changed':
+                # called with (old_state, new_state):
+                device = args[0]
+                args = ()
+            self._write(event, device, zip(params, args))
+        return handler
+
+    def _write(self, event, device, params):
+        """Print a single event."""
+        import json
+        import udiskie.ipc
+        from collections import OrderedDict
+        from udiskie.compat import unicode
+        # udisks2 triggers media_removed without device for removed drives:
+        if device is None:
+            object_path = None
+        else:
+            object_path = unicode(device.object_path)
+        line = OrderedDict([('time', time.time()),
+                            ('event', event),
+                            ('object_path', object_path)])
+        for name, value in params:
+            line[name] = value if value is None else unicode(value)
+        try:
+            line['device'] = (None if device is None
+                              else udiskie.ipc.device_record(device))
+        except Exception:
+            # e.g. removed devices with partial state
+            line['device'] = None
+        sys.stdout.write(json.dumps(line) + '\n')
+        sys.stdout.flush()
+
+    def run(self):
+        """Implements _EntryPoint.run."""
+        try:
+            return self.mainloop.run()
+        except KeyboardInterrupt:
+            return 0
@@ -2,10 +2,21 @@
 Common DBus utilities.
 """
 
+from bisect import bisect_left
+from collections import namedtuple
+import logging
 import os.path
+import time
 
 
 __all__ = ['Emitter',
+           'Histogram',
+           'Toggle',
+           'Changed',
+           'PropertyDiff',
+           'Query',
+           'SignalThrottle',
+           'drive_key',
            'samefile',
            'setdefault',
            'wraps']
@@ -23,8 +34,24 @@ class Emitter(object):
     Event emitter class.
 
     Provides a simple event engine featuring a known finite set of events.
+
+    Handlers are called in order of decreasing priority, handlers with the
+    same priority in the order they were connected. Exceptions raised by a
+    handler are logged and don't prevent the remaining handlers from being
+    called.
+
+    :ivar dict handler_stats: ``{handler name: [count, total, max]}`` with
+                              the time spent in each handler (in seconds),
+                              ``None`` unless enabled by :meth:`enable_timing`
+    :ivar bool defer_low_priority: if true, handlers with negative priority
+                                   are called from an idle callback after
+                                   the event has been dispatched
     """
 
+    PRIORITY_HIGH = 10
+    PRIORITY_DEFAULT = 0
+    PRIORITY_LOW = -10
+
     def __init__(self, event_names=(), *args, **kwargs):
         """
         Initialize with empty lists of event handlers.
@@ -33,8 +60,19 @@ class Emitter(object):
         """
         super(Emitter, self).__init__(*args, **kwargs)
         self._event_handlers = {}
+        self._priorities = {}
         for evt in event_names:
             self._event_handlers[evt] = []
+            self._priorities[evt] = []
+        self._deferred = []
+        self._schedule_idle = _idle_add
+        self.handler_stats = None
+        self.defer_low_priority = False
+
+    def enable_timing(self):
+        """Start recording the time spent in each handler."""
+        if self.handler_stats is None:
+            self.handler_stats = {}
 
     def trigger(self, event, *args):
         """
@@ -43,18 +81,53 @@ class Emitter(object):
         :param str event: event name
         :param *args: event parameters
         """
-        for handler in self._event_handlers[event]:
+        handlers = zip(self._event_handlers[event], self._priorities[event])
+        for handler, priority in list(handlers):
+            if priority < 0 and self.defer_low_priority:
+                self._defer(handler, args)
+            else:
+                self._call_handler(handler, args)
+
+    def _call_handler(self, handler, args):
+        """Call a single handler, record its time and log exceptions."""
+        stats = self.handler_stats
+        if stats is not None:
+            start = time.time()
+        try:
             handler(*args)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'exception in event handler %s' % (_handler_name(handler),))
+        if stats is not None:
+            duration = time.time() - start
+            entry = stats.setdefault(_handler_name(handler), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+    def _defer(self, handler, args):
+        """Call the handler from an idle callback."""
+        self._deferred.append((handler, args))
+        if len(self._deferred) == 1:
+            self._schedule_idle(self._run_deferred)
+
+    def _run_deferred(self):
+        """Call all deferred handlers."""
+        deferred, self._deferred = self._deferred, []
+        for handler, args in deferred:
+            self._call_handler(handler, args)
+        return False
 
-    def connect_all(self, obj):
+    def connect_all(self, obj, priority=PRIORITY_DEFAULT):
         """
         Connect all handlers of a multi-slot object.
 
         :param obj: multi-slot
+        :param int priority: priority of the handlers
         """
         for event in self._event_handlers:
             if hasattr(obj, event):
-                self.connect(event, getattr(obj, event))
+                self.connect(event, getattr(obj, event), priority)
 
     def disconnect_all(self, obj):
         """
@@ -66,14 +139,21 @@ class Emitter(object):
             if hasattr(obj, event):
                 self.disconnect(event, getattr(obj, event))
 
-    def connect(self, event, handler):
+    def connect(self, event, handler, priority=PRIORITY_DEFAULT):
         """
         Connect an event handler.
 
         :param str event: event name
         :param callable handler: event handler
+        :param int priority: handlers with higher priority are called
+                             first, see :attr:`defer_low_priority`
         """
-        self._event_handlers[event].append(handler)
+        priorities = self._priorities[event]
+        index = len(priorities)
+        while index > 0 and priorities[index-1] < priority:
+            index -= 1
+        self._event_handlers[event].insert(index, handler)
+        priorities.insert(index, priority)
 
     def disconnect(self, event, handler):
         """
@@ -82,7 +162,370 @@ class Emitter(object):
         :param str event: event name
         :param callable handler: event handler
         """
-        self._event_handlers[event].remove(handler)
+        index = self._event_handlers[event].index(handler)
+        del self._event_handlers[event][index]
+        del self._priorities[event][index]
+
+
+def _handler_name(handler):
+    """Return a readable name for an event handler."""
+    name = getattr(handler, '__name__', None) or type(handler).__name__
+    owner = getattr(handler, '__self__', None)
+    if owner is not None:
+        name = type(owner).__name__ + '.' + name
+    module = getattr(handler, '__module__', None)
+    return module + '.' + name if module else name
+
+
+class Toggle(namedtuple('Toggle', ['on', 'off'])):
+
+    """
+    Diff rule for properties that switch something on or off.
+
+    Triggers ``on`` when the truth value of the property becomes true and
+    ``off`` when it becomes false. Either event name may be ``None``.
+    Events are called with the device as only argument.
+    """
+
+    signature = 'device'
+
+    def __call__(self, old, new):
+        if new and not old:
+            return self.on
+        if old and not new:
+            return self.off
+        return None
+
+
+class Changed(namedtuple('Changed', ['event', 'signature'])):
+
+    """
+    Diff rule for properties whose value is of interest.
+
+    Triggers the event whenever the value of the property changes. The
+    signature determines the arguments the event is called with:
+
+        - 'values': device, old value, new value
+        - 'states': old device state, new device state
+    """
+
+    def __new__(cls, event, signature='values'):
+        return super(Changed, cls).__new__(cls, event, signature)
+
+    def __call__(self, old, new):
+        return self.event if old != new else None
+
+
+# Change detected by PropertyDiff:
+Change = namedtuple('Change', ['event', 'signature', 'old', 'new'])
+
+
+class PropertyDiff(object):
+
+    """
+    Translate property changes into semantic events.
+
+    The diff is based on a declarative table that maps property keys to
+    rules (see :class:`Toggle` and :class:`Changed`). Only the rules for
+    the changed keys are evaluated, so no device objects are needed to
+    detect changes.
+    """
+
+    def __init__(self, rules):
+        """
+        Initialize from the rules table.
+
+        :param iterable rules: (key, rule) pairs
+        """
+        self._rules = {}
+        for key, rule in rules:
+            self._rules.setdefault(key, []).append(rule)
+
+    def keys(self):
+        """Return all property keys with associated rules."""
+        return self._rules.keys()
+
+    def __call__(self, keys, old, new):
+        """
+        Detect events for changed properties.
+
+        :param iterable keys: keys of the changed properties
+        :param callable old: returns the old value of a property key
+        :param callable new: returns the new value of a property key
+        :returns: detected changes, each event occurs at most once
+        :rtype: list of Change
+        """
+        changes = []
+        seen = set()
+        for key in keys:
+            for rule in self._rules.get(key, ()):
+                old_value, new_value = old(key), new(key)
+                event = rule(old_value, new_value)
+                if event and event not in seen:
+                    seen.add(event)
+                    changes.append(Change(event, rule.signature,
+                                          old_value, new_value))
+        return changes
+
+
+class Query(object):
+
+    """
+    Incrementally maintained set of devices matching a predicate.
+
+    Queries are created via the ``query`` method of the udisks daemons.
+    The daemon notifies the query about changed objects so only those are
+    reevaluated. The callback is invoked only when a device enters or
+    leaves the result set.
+    """
+
+    def __init__(self, udisks, predicate, callback=None):
+        """
+        Initialize the result set with the current devices.
+
+        :param udisks: udisks daemon object
+        :param callable predicate: ``predicate(device) -> bool``
+        :param callable callback: ``callback(device, matched)``
+
+        The callback is invoked for the initial matches as well.
+        """
+        self._udisks = udisks
+        self._predicate = predicate
+        self._callback = callback
+        self._matches = {}
+        self.update(list(udisks.paths()))
+
+    def update(self, object_paths):
+        """
+        Reevaluate the predicate for the given objects.
+
+        :param iterable object_paths: object paths of changed objects
+        """
+        for object_path in object_paths:
+            device = self._udisks[object_path]
+            matched = bool(device) and bool(self._predicate(device))
+            was_matched = object_path in self._matches
+            if matched:
+                self._matches[object_path] = device
+            else:
+                # report the last matching state of removed devices:
+                device = self._matches.pop(object_path, device)
+            if self._callback and matched != was_matched:
+                self._callback(device, matched)
+
+    def __len__(self):
+        """Return the number of matching devices."""
+        return len(self._matches)
+
+    def __contains__(self, device):
+        """Check if the device (or object path) is matched."""
+        return str(device) in self._matches
+
+    def __iter__(self):
+        """Iterate over the matching devices."""
+        return iter(list(self._matches.values()))
+
+    def close(self):
+        """Stop receiving updates from the daemon."""
+        self._udisks.cancel_query(self)
+
+
+class SignalThrottle(object):
+
+    """
+    Backpressure for DBus signal handlers.
+
+    Signal handlers are wrapped using :meth:`wrap`. While the incoming
+    signal rate stays below ``threshold`` signals per second, every signal
+    is passed on to its handler (event mode). When the rate exceeds the
+    threshold, individual signals are dropped and the ``reconcile``
+    callback is invoked every ``interval`` seconds instead (reconcile
+    mode). Event mode is resumed when the rate falls below half the
+    threshold.
+
+    :ivar bool reconciling: whether signals are currently being dropped
+    :ivar dict stats: signal and mode switch counters
+    """
+
+    def __init__(self, reconcile, threshold=50, interval=1.0, schedule=None):
+        """
+        Initialize in event mode.
+
+        :param callable reconcile: called with the set of dirty keys
+        :param float threshold: maximum signal rate (per second)
+        :param float interval: reconciliation period (seconds)
+        :param callable schedule: ``schedule(seconds, callback)`` runs the
+                                  callback periodically until it returns
+                                  False. Defaults to ``gobject.timeout_add``.
+        """
+        self._reconcile = reconcile
+        self.threshold = threshold
+        self.interval = interval
+        self._schedule = schedule or _timeout_add
+        self._log = logging.getLogger(__name__)
+        self._window_start = time.time()
+        self._window_count = 0
+        self.dirty = set()
+        self.reconciling = False
+        self.stats = {'signals': 0,
+                      'dropped': 0,
+                      'reconcile_mode': 0,
+                      'event_mode': 0,
+                      'reconciliations': 0}
+
+    def wrap(self, handler, key=None):
+        """
+        Wrap a signal handler.
+
+        :param callable handler: signal handler
+        :param callable key: maps the signal arguments of dropped signals
+                             to a key that is added to the dirty set
+        :returns: wrapped signal handler
+        :rtype: callable
+        """
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if self._count():
+                return handler(*args, **kwargs)
+            if key is not None:
+                self.dirty.add(key(*args, **kwargs))
+        return wrapper
+
+    def _count(self):
+        """Count a signal and return whether it should be handled."""
+        self.stats['signals'] += 1
+        self._window_count += 1
+        if self.reconciling:
+            self.stats['dropped'] += 1
+            return False
+        now = time.time()
+        if now - self._window_start >= self.interval:
+            self._window_start = now
+            self._window_count = 1
+        elif self._window_count > self.threshold * self.interval:
+            self.stats['dropped'] += 1
+            self._enter_reconcile_mode()
+            return False
+        return True
+
+    def _enter_reconcile_mode(self):
+        """Stop handling signals and start periodic reconciliation."""
+        self._log.info('signal rate exceeds %s/s: switching to reconcile mode'
+                       % (self.threshold,))
+        self.stats['reconcile_mode'] += 1
+        self.reconciling = True
+        self._window_start = time.time()
+        self._window_count = 0
+        self._schedule(self.interval, self._tick)
+
+    def _tick(self):
+        """Reconcile state and check whether to resume event mode."""
+        now = time.time()
+        rate = self._window_count / max(now - self._window_start, 1e-3)
+        self._window_start = now
+        self._window_count = 0
+        dirty, self.dirty = self.dirty, set()
+        self._reconcile(dirty)
+        self.stats['reconciliations'] += 1
+        if rate < self.threshold / 2.0:
+            self._log.info('signal rate down to %.1f/s: switching to event mode'
+                           % (rate,))
+            self.stats['event_mode'] += 1
+            self.reconciling = False
+            return False
+        return True
+
+
+class Histogram(object):
+
+    """
+    Latency histogram with fixed buckets.
+
+    Recording a value is cheap and needs constant memory. Percentiles are
+    estimated as the upper bound of the bucket that contains them.
+
+    :ivar int count: number of recorded values
+    :ivar float total: sum of all recorded values
+    :ivar float max: largest recorded value
+    """
+
+    # bucket upper bounds in seconds:
+    default_bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                      0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=None):
+        """
+        Initialize empty buckets.
+
+        :param tuple bounds: ascending bucket upper bounds
+        """
+        self.bounds = tuple(bounds or self.default_bounds)
+        # the last bucket holds values above the largest bound:
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Record a value."""
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile.
+
+        :param float percent: percentage between 0 and 100
+        :returns: bucket upper bound, ``max`` for the overflow bucket and
+                  ``None`` if no values have been recorded
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, num in zip(self.bounds, self.buckets):
+            seen += num
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Return a summary suitable for JSON serialization."""
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+def _timeout_add(seconds, callback):
+    """Run callback periodically from the gobject main loop."""
+    import gobject
+    gobject.timeout_add(int(seconds * 1000), callback)
+
+
+def _idle_add(callback):
+    """Run callback from the gobject main loop when idle."""
+    import gobject
+    gobject.idle_add(callback)
+
+
+def drive_key(device):
+    """
+    Get the object path of the drive containing the device.
+
+    Falls back to the object path of the device itself if the drive can not
+    be determined, e.g. because it has already been removed.
+    """
+    try:
+        drive = device.drive
+    except Exception:
+        drive = None
+    return drive.object_path if drive else device.object_path
 
 
 def samefile(a, b):
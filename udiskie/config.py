@@ -155,6 +155,7 @@ class Config(object):
     MOUNT_OPTIONS_SECTION = 'mount_options'
     PROGRAM_OPTIONS_SECTION = 'program_options'
     NOTIFICATIONS_SECTION = 'notifications'
+    KEYFILES_SECTION = 'keyfiles'
 
     def __init__(self, data):
         """
@@ -223,6 +224,10 @@ class Config(object):
             device_locked=-1
             job_failed=-1
 
+            [keyfiles]
+            # Unlock LUKS devices without password prompt:
+            uuid.8f1cf8a6-5d8d-4a6b-9f2b-2e9e1b0d8c52=/root/keys/backup.key
+
         The left hand side consists of either the property key to match and
         the value to search for separated by a dot: 'key.value'. Currently,
         the only possible keys are 'fstype' and 'uuid'. The right hand side
@@ -254,6 +259,23 @@ class Config(object):
         """Get the notification timeouts dictionary from the config file."""
         return self._get_section(self.NOTIFICATIONS_SECTION)
 
+    @property
+    def keyfiles(self):
+        """
+        Get the keyfile paths for LUKS devices from the config file.
+
+        :returns: mapping of lowercase device UUIDs to keyfile paths
+        :rtype: dict
+        :raises InvalidFilter: if a key does not have the form 'uuid.<uuid>'
+        """
+        keyfiles = {}
+        for expr, path in self._get_section(self.KEYFILES_SECTION).items():
+            match = re.match(r'uuid\.(\S+)$', expr)
+            if not match:
+                raise InvalidFilter('Invalid keyfile entry: %s' % expr)
+            keyfiles[match.group(1).lower()] = os.path.expanduser(path)
+        return keyfiles
+
     def _get_section(self, name):
         """
         Get a section as dictionary from the config file. Internal method.
@@ -4,15 +4,205 @@ Common DBus utilities.
 
 from __future__ import absolute_import
 
-from dbus import Interface, SystemBus
+import sys
+import threading
+import time
+
+from dbus import ByteArray, Interface, SystemBus
 from dbus.exceptions import DBusException
-from dbus.mainloop.glib import DBusGMainLoop
+from dbus.mainloop.glib import DBusGMainLoop, threads_init
+
+from udiskie.common import Histogram
 
 
-__all__ = ['DBusProperties',
+__all__ = ['ByteArray',
+           'DBusProperties',
            'DBusProxy',
            'DBusService',
-           'DBusException']
+           'DBusException',
+           'BusInfo',
+           'CallStats',
+           'add_signal_receiver',
+           'enable_stats',
+           'threads_init']
+
+
+# Call statistics, see enable_stats():
+stats = None
+
+
+class CallStats(object):
+
+    """
+    Counters and latency histograms for DBus traffic.
+
+    Method calls, property reads and signal handlers are recorded per
+    interface and member. All methods are thread safe.
+
+    :ivar int num_calls: number of recorded method calls and property reads
+    """
+
+    def __init__(self):
+        """Initialize empty statistics."""
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._signals = {}
+        self.num_calls = 0
+
+    def add_call(self, interface, member, duration, failed=False):
+        """
+        Record a method call or property read.
+
+        :param str interface: DBus interface name
+        :param str member: method or property name
+        :param float duration: latency in seconds
+        :param bool failed: whether the call raised an exception
+        """
+        with self._lock:
+            entry = self._calls.get((interface, member))
+            if entry is None:
+                entry = self._calls[(interface, member)] = [0, Histogram()]
+            entry[1].add(duration)
+            if failed:
+                entry[0] += 1
+            self.num_calls += 1
+
+    def add_signal(self, interface, member, duration):
+        """
+        Record a handled signal.
+
+        :param str interface: DBus interface name
+        :param str member: signal name
+        :param float duration: time spent in the handler (seconds)
+        """
+        with self._lock:
+            entry = self._signals.get((interface, member))
+            if entry is None:
+                entry = self._signals[(interface, member)] = Histogram()
+            entry.add(duration)
+
+    def histograms(self):
+        """
+        Return the latency histograms of all calls.
+
+        :returns: ``((interface, member), (errors, histogram))`` pairs
+        :rtype: list
+        """
+        with self._lock:
+            return sorted((key, tuple(entry))
+                          for key, entry in self._calls.items())
+
+    def as_dict(self):
+        """
+        Return a snapshot of the statistics.
+
+        :returns: ``{'calls': [...], 'signals': [...]}``, where each entry
+                  is a dict with ``interface``, ``member`` and the summary
+                  of :meth:`Histogram.as_dict`. Calls have an additional
+                  ``errors`` count.
+        :rtype: dict
+        """
+        with self._lock:
+            calls = []
+            for (interface, member), entry in sorted(self._calls.items()):
+                errors, hist = entry
+                entry = hist.as_dict()
+                entry.update(interface=interface, member=member, errors=errors)
+                calls.append(entry)
+            signals = []
+            for (interface, member), hist in sorted(self._signals.items()):
+                entry = hist.as_dict()
+                entry.update(interface=interface, member=member)
+                signals.append(entry)
+        return {'calls': calls, 'signals': signals}
+
+    def format(self):
+        """Return a human readable table of the statistics."""
+        def ms(seconds):
+            return '-' if seconds is None else '%.1f' % (seconds * 1000)
+        data = self.as_dict()
+        lines = ['%-8s %6s %6s %9s %7s %7s %7s  %s' % (
+            'kind', 'count', 'errors', 'total/ms',
+            'p50/ms', 'p99/ms', 'max/ms', 'member')]
+        for kind in ('calls', 'signals'):
+            for entry in data[kind]:
+                lines.append('%-8s %6d %6s %9s %7s %7s %7s  %s.%s' % (
+                    kind, entry['count'], entry.get('errors', '-'),
+                    ms(entry['total']), ms(entry['p50']), ms(entry['p99']),
+                    ms(entry['max']), entry['interface'], entry['member']))
+        return '\n'.join(lines)
+
+
+def enable_stats():
+    """
+    Start recording DBus statistics.
+
+    Only proxies created and signal receivers added afterwards are
+    instrumented, so this should be called before connecting to any
+    service.
+
+    :returns: the global statistics object
+    :rtype: CallStats
+    """
+    global stats
+    if stats is None:
+        stats = CallStats()
+    return stats
+
+
+def _timed_call(method, interface, member):
+    """Wrap a DBus method to record its latency in :data:`stats`."""
+    def call(*args, **kwargs):
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            stats.add_call(interface, member, time.time() - start, True)
+            raise
+        stats.add_call(interface, member, time.time() - start)
+        return result
+    return call
+
+
+class _TimedInterface(object):
+
+    """DBus interface wrapper that records the latency of method calls."""
+
+    def __init__(self, interface, name):
+        self._interface = interface
+        self._name = name
+
+    def __getattr__(self, member):
+        return _timed_call(getattr(self._interface, member),
+                           self._name, member)
+
+
+def add_signal_receiver(bus, handler, signal_name, dbus_interface=None,
+                        **kwargs):
+    """
+    Add a signal receiver to the bus.
+
+    Same as ``bus.add_signal_receiver``, but records the time spent in the
+    handler if statistics are enabled.
+
+    :param dbus.Bus bus: connection to the bus
+    :param callable handler: signal handler
+    :param str signal_name: signal name
+    :param str dbus_interface: interface name
+    """
+    if stats is not None:
+        interface = dbus_interface or kwargs.get('bus_name') or ''
+        receive = handler
+        def handler(*args, **kw):
+            start = time.time()
+            try:
+                return receive(*args, **kw)
+            finally:
+                stats.add_signal(interface, signal_name, time.time() - start)
+    return bus.add_signal_receiver(handler,
+                                   signal_name=signal_name,
+                                   dbus_interface=dbus_interface,
+                                   **kwargs)
 
 
 class DBusProperties(object):
@@ -42,7 +232,10 @@ class DBusProperties(object):
         :param str property: name of the dbus property
         :returns: the property
         """
-        return self.__proxy.Get(self.__interface, property)
+        if stats is None:
+            return self.__proxy.Get(self.__interface, property)
+        return _timed_call(self.__proxy.Get, self.__interface, property)(
+            self.__interface, property)
 
 
 class DBusProxy(object):
@@ -70,6 +263,8 @@ class DBusProxy(object):
         self.object_path = proxy.object_path
         self.property = DBusProperties(proxy, interface)
         self.method = Interface(proxy, interface)
+        if stats is not None:
+            self.method = _TimedInterface(self.method, interface)
         self._bus = proxy._bus
 
 
@@ -105,3 +300,45 @@ class DBusService(object):
             bus = SystemBus(mainloop=mainloop)
         obj = bus.get_object(cls.BusName, cls.ObjectPath)
         return DBusProxy(obj, cls.Interface)
+
+
+class BusInfo(DBusService):
+
+    """
+    Information about the system bus provided by the bus daemon itself.
+
+    None of the methods activates any service. A private connection is
+    used, so that the main loop setting of the shared system bus connection
+    is not affected.
+    """
+
+    BusName = 'org.freedesktop.DBus'
+    ObjectPath = '/org/freedesktop/DBus'
+    Interface = 'org.freedesktop.DBus'
+
+    def __init__(self):
+        """Open a private connection to the system bus."""
+        self._bus = SystemBus(private=True)
+        self._proxy = self.connect_service(bus=self._bus)
+
+    def close(self):
+        """Close the connection."""
+        self._bus.close()
+
+    def name_owner(self, name):
+        """Return the unique name of the owner of a name or ``None``."""
+        try:
+            return str(self._proxy.method.GetNameOwner(name))
+        except DBusException:
+            if (sys.exc_info()[1].get_dbus_name() ==
+                    'org.freedesktop.DBus.Error.NameHasNoOwner'):
+                return None
+            raise
+
+    def names(self):
+        """Return the set of currently owned names."""
+        return set(map(str, self._proxy.method.ListNames()))
+
+    def activatable_names(self):
+        """Return the set of names that can be activated on demand."""
+        return set(map(str, self._proxy.method.ListActivatableNames()))
@@ -0,0 +1,783 @@
+"""
+Local control socket for udiskie.
+
+The udiskie daemon can publish the state of all handleable devices on a
+UNIX socket and execute mount operations on behalf of its clients. This
+allows to run the tray icon in a separate process, so that the user
+interface and the device handling don't block each other.
+
+Messages are JSON objects, one per line. The client sends:
+
+- ``{"type": "subscribe"}`` to receive device state updates
+- ``{"type": "call", "id": 1, "method": "mount", "device": "...",
+  "kwargs": {}}`` where device is an object path, device file, mount
+  path, ``uuid=<UUID>`` or ``label=<LABEL>``
+- ``{"type": "stats"}`` to query runtime statistics of the daemon
+
+The server sends:
+
+- ``{"type": "update", "device": {...}}`` for every new or changed device
+  (the current state of all devices is sent on subscription)
+- ``{"type": "remove", "object_path": "..."}`` when a device disappears
+  or is no longer handled by udiskie
+- ``{"type": "result", "id": 1, "result": true}`` in reply to a ``call``,
+  failed calls have an additional ``"error"`` message
+- ``{"type": "stats", "stats": {...}}`` in reply to a ``stats`` request
+
+Command line utilities use the :class:`SyncClient` to delegate operations
+to a running daemon. They don't subscribe, so a mount request takes a
+single round trip.
+
+This module must not import gtk.
+"""
+
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import tempfile
+
+from udiskie.common import Emitter
+from udiskie.compat import basestring, unicode
+from udiskie.mount import device_spec
+
+
+__all__ = ['socket_path',
+           'DaemonError',
+           'Server',
+           'Client',
+           'SyncClient',
+           'RemoteDevice',
+           'RemoteDaemon',
+           'RemoteMounter']
+
+
+# device properties published to clients:
+_bool_fields = [
+    'is_block',
+    'is_drive',
+    'is_toplevel',
+    'is_external',
+    'is_filesystem',
+    'is_mounted',
+    'is_crypto',
+    'is_unlocked',
+    'is_luks_cleartext',
+    'is_partition',
+    'is_partition_table',
+    'is_ejectable',
+    'is_detachable',
+    'has_media',
+]
+
+_text_fields = [
+    'device_presentation',
+    'id_label',
+    'id_uuid',
+    'id_type',
+]
+
+_slave_fields = [
+    'partition_slave',
+    'luks_cleartext_slave',
+]
+
+# operations that can be requested by clients:
+_methods = [
+    'browse',
+    'mount',
+    'unmount',
+    'unlock',
+    'lock',
+    'add',
+    'remove',
+    'eject',
+    'detach',
+    'add_all',
+    'remove_all',
+]
+
+
+class DaemonError(socket.error):
+
+    """The daemon didn't reply in time or closed the connection."""
+
+
+def socket_path():
+    """
+    Return the path of the control socket for the current user.
+
+    :rtype: str
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'udiskie.sock')
+    # the temp directory is shared with other users, so use a private
+    # subdirectory (created by the daemon, see :func:`_listen`):
+    return os.path.join(tempfile.gettempdir(),
+                        'udiskie-%d' % (os.getuid(),),
+                        'udiskie.sock')
+
+
+def _check_owner(path):
+    """
+    Make sure that the file belongs to the current user.
+
+    :param str path: file path
+    :raises socket.error: if the file does not exist or is owned by
+                          another user
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        err = sys.exc_info()[1]
+        raise socket.error(err.errno, '%s: %s' % (err.strerror, path))
+    if st.st_uid != os.getuid():
+        raise socket.error(errno.EPERM,
+                           '%s is owned by another user' % (path,))
+
+
+def _connect(path, timeout=None):
+    """
+    Connect to the control socket of a daemon of the current user.
+
+    :param str path: socket path
+    :param float timeout: timeout in seconds for blocking operations on
+                          the socket, ``None`` to wait forever
+    :returns: the connected socket
+    :raises socket.error: if the daemon is not running or the socket is
+                          owned by another user
+    """
+    _check_owner(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def device_record(device):
+    """
+    Serialize the properties of a device.
+
+    :param device: device object
+    :returns: JSON compatible device properties
+    :rtype: dict
+    """
+    record = {'object_path': unicode(device.object_path)}
+    for name in _bool_fields:
+        record[name] = bool(getattr(device, name, False))
+    for name in _text_fields:
+        record[name] = unicode(getattr(device, name) or '')
+    for name in _slave_fields:
+        slave = getattr(device, name)
+        record[name] = unicode(slave.object_path) if slave else None
+    record['mount_paths'] = [unicode(path) for path in device.mount_paths]
+    return record
+
+
+class Connection(object):
+
+    """
+    Non-blocking line based JSON connection.
+
+    Reading and writing is driven by the gobject main loop, so a slow peer
+    never blocks the process.
+    """
+
+    def __init__(self, sock, on_message, on_close=None):
+        """
+        Start watching the socket.
+
+        :param socket.socket sock: connected socket
+        :param callable on_message: ``on_message(connection, message)``
+        :param callable on_close: ``on_close(connection)``
+        """
+        import gobject
+        self._gobject = gobject
+        self._sock = sock
+        self._sock.setblocking(False)
+        self._on_message = on_message
+        self._on_close = on_close
+        self._rbuf = b''
+        self._wbuf = b''
+        self._write_watch = None
+        self._read_watch = gobject.io_add_watch(
+            sock.fileno(),
+            gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+            self._on_readable)
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def closed(self):
+        """Check if the connection has been closed."""
+        return self._sock is None
+
+    def send(self, message):
+        """
+        Queue a message to be sent as soon as the socket is writable.
+
+        :param dict message: JSON compatible message
+        """
+        if self.closed:
+            return
+        self._wbuf += json.dumps(message).encode('utf-8') + b'\n'
+        if self._write_watch is None:
+            self._write_watch = self._gobject.io_add_watch(
+                self._sock.fileno(), self._gobject.IO_OUT,
+                self._on_writable)
+
+    def close(self):
+        """Close the connection."""
+        if self.closed:
+            return
+        if self._read_watch is not None:
+            self._gobject.source_remove(self._read_watch)
+            self._read_watch = None
+        if self._write_watch is not None:
+            self._gobject.source_remove(self._write_watch)
+            self._write_watch = None
+        self._sock.close()
+        self._sock = None
+        if self._on_close:
+            self._on_close(self)
+
+    def _on_writable(self, fd, condition):
+        try:
+            sent = self._sock.send(self._wbuf)
+        except socket.error:
+            if sys.exc_info()[1].errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            self._write_watch = None
+            self.close()
+            return False
+        self._wbuf = self._wbuf[sent:]
+        if self._wbuf:
+            return True
+        self._write_watch = None
+        return False
+
+    def _on_readable(self, fd, condition):
+        try:
+            data = self._sock.recv(65536)
+        except socket.error:
+            if sys.exc_info()[1].errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = b''
+        if not data:
+            self._read_watch = None
+            self.close()
+            return False
+        self._rbuf += data
+        lines = self._rbuf.split(b'\n')
+        self._rbuf = lines.pop()
+        for line in lines:
+            if self.closed:
+                break
+            try:
+                message = json.loads(line.decode('utf-8'))
+            except ValueError:
+                self._log.error('invalid message: %r' % (line,))
+                continue
+            self._on_message(self, message)
+        return not self.closed
+
+
+class Server(object):
+
+    """
+    Publish device state and accept mount operations on a UNIX socket.
+
+    The server is driven by the gobject main loop of the daemon.
+    """
+
+    def __init__(self, mounter, path=None, stats=None):
+        """
+        Start listening.
+
+        :param Mounter mounter: mounter object, its udisks member must be a
+                                Daemon
+        :param str path: socket path, see :func:`socket_path`
+        :param callable stats: returns the statistics for ``stats``
+                               requests as JSON serializable dict
+        """
+        import gobject
+        self._log = logging.getLogger(__name__)
+        self._mounter = mounter
+        self._stats = stats
+        self._path = path or socket_path()
+        self._clients = []
+        self._subscribers = []
+        self._records = {}
+        self._sock = _listen(self._path)
+        self._watch = gobject.io_add_watch(self._sock.fileno(),
+                                           gobject.IO_IN, self._on_accept)
+        for device in mounter.get_all_handleable():
+            self._records[device.object_path] = device_record(device)
+        udisks = mounter.udisks
+        for event in ['device_added', 'device_mounted', 'device_unmounted',
+                      'device_unlocked', 'device_locked', 'media_added',
+                      'media_removed', 'label_changed', 'size_changed']:
+            udisks.connect(event, self._on_event)
+        udisks.connect('device_changed', self._on_device_changed)
+        udisks.connect('device_removed', self._on_device_removed)
+        self._log.debug('listening on %s' % (self._path,))
+
+    def close(self):
+        """Stop listening and disconnect all clients."""
+        import gobject
+        gobject.source_remove(self._watch)
+        for client in list(self._clients):
+            client.close()
+        self._sock.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def _on_accept(self, fd, condition):
+        sock, addr = self._sock.accept()
+        client = Connection(sock, self._on_message, self._on_close)
+        self._clients.append(client)
+        return True
+
+    def _on_close(self, client):
+        self._clients.remove(client)
+        if client in self._subscribers:
+            self._subscribers.remove(client)
+
+    def _on_message(self, client, message):
+        kind = message.get('type')
+        if kind == 'subscribe':
+            if client not in self._subscribers:
+                self._subscribers.append(client)
+                for record in self._records.values():
+                    client.send({'type': 'update', 'device': record})
+            return
+        if kind == 'stats':
+            stats = self._stats() if self._stats else {}
+            client.send({'type': 'stats', 'stats': stats})
+            return
+        if kind != 'call':
+            self._log.error('unknown message: %r' % (message,))
+            return
+        reply = {'type': 'result', 'id': message.get('id')}
+        try:
+            reply['result'] = self._call(message.get('method'),
+                                         message.get('device'),
+                                         message.get('kwargs') or {})
+        except Exception:
+            # the client is waiting for the reply, so always send one:
+            err = sys.exc_info()[1]
+            self._log.error('failed to execute %r: %s' % (message, err))
+            reply['result'] = False
+            reply['error'] = str(err)
+        client.send(reply)
+
+    def _call(self, method, device, kwargs):
+        """
+        Execute a mount operation.
+
+        :param str method: name of the Mounter method
+        :param str device: object path, device file or mount path
+        :param dict kwargs: keyword arguments for the method
+        :returns: result of the operation, ``None`` if pending
+        """
+        if method not in _methods:
+            self._log.error('invalid method: %r' % (method,))
+            return False
+        kwargs = dict((str(k), v) for k, v in kwargs.items())
+        func = getattr(self._mounter, method)
+        if method in ('add_all', 'remove_all'):
+            return func(**kwargs)
+        if not isinstance(device, basestring):
+            self._log.error('invalid device: %r' % (device,))
+            return False
+        if device in self._records:
+            device = self._mounter.udisks[device] or device
+        elif device.startswith(('uuid=', 'label=')):
+            match = device_spec(device)
+            matching = [self._mounter.udisks[object_path]
+                        for object_path in self._records]
+            matching = [dev for dev in matching if dev and match(dev)]
+            if not matching:
+                self._log.error('no device found matching %s' % (device,))
+                return False
+            device = matching[0]
+        return func(device, **kwargs)
+
+    def _on_event(self, device, *args):
+        self._update(device)
+
+    def _on_device_changed(self, old_state, new_state):
+        self._update(new_state)
+
+    def _on_device_removed(self, device):
+        self._remove(device.object_path)
+
+    def _update(self, device):
+        """Send the device state if it has changed."""
+        if not self._mounter.is_handleable(device):
+            self._remove(device.object_path)
+            return
+        record = device_record(device)
+        if self._records.get(device.object_path) == record:
+            return
+        self._records[device.object_path] = record
+        self._broadcast({'type': 'update', 'device': record})
+
+    def _remove(self, object_path):
+        """Send removal notice if the device was known."""
+        if self._records.pop(object_path, None) is not None:
+            self._broadcast({'type': 'remove', 'object_path': object_path})
+
+    def _broadcast(self, message):
+        for client in self._subscribers:
+            client.send(message)
+
+
+class Client(object):
+
+    """
+    Connection to the control socket of a udiskie daemon.
+
+    Runs in the gobject main loop of the client process.
+    """
+
+    def __init__(self, on_message, path=None):
+        """
+        Connect to the daemon.
+
+        :param callable on_message: invoked for state messages
+        :param str path: socket path, see :func:`socket_path`
+        :raises socket.error: if the daemon is not running
+        """
+        self._log = logging.getLogger(__name__)
+        self._on_state = on_message
+        self._next_id = 0
+        self._pending = {}
+        sock = _connect(path or socket_path())
+        self._conn = Connection(sock, self._on_message)
+        self._conn.send({'type': 'subscribe'})
+
+    def call(self, method, device=None, callback=None, **kwargs):
+        """
+        Request a mount operation without waiting for the result.
+
+        :param str method: name of the Mounter method
+        :param str device: object path, device file or mount path
+        :param callable callback: invoked with the result
+        """
+        self._next_id += 1
+        if callback:
+            self._pending[self._next_id] = callback
+        self._conn.send({'type': 'call',
+                         'id': self._next_id,
+                         'method': method,
+                         'device': device,
+                         'kwargs': kwargs})
+
+    def close(self):
+        """Close the connection."""
+        self._conn.close()
+
+    def _on_message(self, conn, message):
+        if message.get('type') == 'result':
+            callback = self._pending.pop(message.get('id'), None)
+            if callback:
+                callback(message.get('result'))
+        else:
+            self._on_state(message)
+
+
+class SyncClient(object):
+
+    """
+    Blocking connection to the control socket of a udiskie daemon.
+
+    Provides the mount operations of :class:`udiskie.mount.Mounter` as
+    methods that wait for the daemon to finish the operation. Doesn't need
+    a main loop. Operations that wait for a password prompt in the daemon
+    return ``None``, the final outcome of these is not reported.
+
+    If the daemon doesn't reply in time (e.g. because its main loop is
+    stalled) or the connection is lost, :class:`socket.error` is raised
+    and the connection is closed.
+    """
+
+    def __init__(self, path=None, timeout=30):
+        """
+        Connect to the daemon.
+
+        :param str path: socket path, see :func:`socket_path`
+        :param float timeout: maximum time in seconds to wait for the
+                              connection and for each reply
+        :raises socket.error: if the daemon is not running
+        """
+        self._timeout = timeout
+        self._sock = _connect(path or socket_path(), timeout)
+        self._file = self._sock.makefile('rb')
+        self._next_id = 0
+
+    def close(self):
+        """Close the connection."""
+        self._file.close()
+        self._sock.close()
+
+    def call(self, method, device=None, **kwargs):
+        """
+        Execute a mount operation in the daemon.
+
+        :param str method: name of the Mounter method
+        :param str device: object path, device file or mount path
+        :returns: result of the operation, ``None`` if the daemon is still
+                  waiting for a password
+        :raises DaemonError: if the connection was closed or timed out
+        """
+        self._next_id += 1
+        message = {'type': 'call',
+                   'id': self._next_id,
+                   'method': method,
+                   'device': device,
+                   'kwargs': kwargs}
+        reply = self._request(message, lambda reply: (
+            reply.get('type') == 'result' and
+            reply.get('id') == self._next_id))
+        return reply.get('result')
+
+    def stats(self):
+        """
+        Query runtime statistics of the daemon.
+
+        :returns: statistics grouped by component
+        :rtype: dict
+        :raises DaemonError: if the connection was closed or timed out
+        """
+        reply = self._request({'type': 'stats'},
+                              lambda reply: reply.get('type') == 'stats')
+        return reply.get('stats')
+
+    def _request(self, message, is_reply):
+        """
+        Send a message and wait for the reply.
+
+        :param dict message: request
+        :param callable is_reply: ``is_reply(message) -> bool``
+        :returns: the reply
+        :rtype: dict
+        :raises DaemonError: if the connection was closed or timed out
+        """
+        try:
+            self._sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            for line in iter(self._file.readline, b''):
+                reply = json.loads(line.decode('utf-8'))
+                if is_reply(reply):
+                    return reply
+        except socket.timeout:
+            self.close()
+            raise DaemonError(errno.ETIMEDOUT,
+                              'no reply from udiskie daemon within %g s'
+                              % (self._timeout,))
+        except socket.error:
+            self.close()
+            raise DaemonError(*sys.exc_info()[1].args)
+        self.close()
+        raise DaemonError(errno.ECONNRESET, 'connection closed by daemon')
+
+    def __getattr__(self, method):
+        if method not in _methods:
+            raise AttributeError(method)
+        def call(device=None, **kwargs):
+            # the daemon may have a different working directory:
+            if (isinstance(device, basestring) and
+                    not device.startswith(('uuid=', 'label='))):
+                device = os.path.abspath(device)
+            return self.call(method, device, **kwargs)
+        return call
+
+
+class RemoteDevice(object):
+
+    """
+    Device state received from the daemon.
+
+    Provides the device attributes that are used by the tray menu.
+    """
+
+    def __init__(self, udisks, record):
+        self._udisks = udisks
+        self._record = record
+
+    def __getattr__(self, name):
+        try:
+            return self._record[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __str__(self):
+        return self.object_path
+
+    @property
+    def partition_slave(self):
+        return self._udisks[self._record['partition_slave']]
+
+    @property
+    def luks_cleartext_slave(self):
+        return self._udisks[self._record['luks_cleartext_slave']]
+
+
+class RemoteDaemon(Emitter):
+
+    """
+    Mirror of the handleable devices of a udiskie daemon.
+
+    Triggers 'device_added', 'device_removed' and 'device_changed' events
+    when receiving updates.
+    """
+
+    def __init__(self, path=None):
+        """
+        Connect to the daemon.
+
+        :param str path: socket path, see :func:`socket_path`
+        :raises socket.error: if the daemon is not running
+        """
+        super(RemoteDaemon, self).__init__(['device_added',
+                                            'device_removed',
+                                            'device_changed'])
+        self._devices = {}
+        self.client = Client(self._on_message, path)
+
+    def __iter__(self):
+        """Iterate over all handleable devices."""
+        return iter(list(self._devices.values()))
+
+    def __getitem__(self, object_path):
+        """Get a device by object path, or a placeholder if unknown."""
+        if not object_path:
+            return None
+        try:
+            return self._devices[object_path]
+        except KeyError:
+            return _UnknownDevice(object_path)
+
+    def _on_message(self, message):
+        kind = message.get('type')
+        if kind == 'update':
+            record = message['device']
+            object_path = record['object_path']
+            new_state = RemoteDevice(self, record)
+            old_state = self._devices.get(object_path)
+            self._devices[object_path] = new_state
+            if old_state is None:
+                self.trigger('device_added', new_state)
+            else:
+                self.trigger('device_changed', old_state, new_state)
+        elif kind == 'remove':
+            old_state = self._devices.pop(message['object_path'], None)
+            if old_state is not None:
+                self.trigger('device_removed', old_state)
+
+
+class _UnknownDevice(object):
+    """Reference to a device that is not handled by the daemon."""
+    def __init__(self, object_path):
+        self.object_path = object_path
+
+
+class RemoteMounter(object):
+
+    """
+    Mounter that forwards all operations to a udiskie daemon.
+
+    Operations return immediately. Only browsing is done locally.
+    """
+
+    def __init__(self, udisks, browser=None):
+        """
+        Initialize the mounter.
+
+        :param RemoteDaemon udisks: connection to the daemon
+        :param callable browser: open devices
+        """
+        self.udisks = udisks
+        self._browser = browser
+        self._log = logging.getLogger(__name__)
+
+    def is_handleable(self, device):
+        """The daemon sends only handleable devices."""
+        return True
+
+    def get_all_handleable(self):
+        """Get all handleable devices."""
+        return list(self.udisks)
+
+    def browse(self, device):
+        """Browse device."""
+        if not device.is_mounted or not self._browser:
+            return False
+        self._browser(device.mount_paths[0])
+        return True
+
+    def __getattr__(self, method):
+        if method not in _methods:
+            raise AttributeError(method)
+        def call(device=None, **kwargs):
+            if device is not None and not isinstance(device, basestring):
+                device = device.object_path
+            self.udisks.client.call(method, device, **kwargs)
+        return call
+
+
+def _listen(path):
+    """
+    Create the listening socket, removing a stale socket file.
+
+    :param str path: socket path
+    :returns: the listening socket
+    :raises socket.error: if another daemon is listening on the path, or
+                          the socket could be replaced by another user
+
+    The directory is created with permissions 0700 if it doesn't exist.
+    Directories of other users are only accepted if they are sticky (like
+    ``/tmp``), so other users can't remove the socket.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError:
+        if sys.exc_info()[1].errno != errno.EEXIST:
+            raise socket.error(*sys.exc_info()[1].args)
+    st = os.stat(dirname)
+    if (not stat.S_ISDIR(st.st_mode) or
+            st.st_uid != os.getuid() and not st.st_mode & stat.S_ISVTX):
+        raise socket.error(errno.EPERM,
+                           '%s is owned by another user' % (dirname,))
+    if os.path.lexists(path):
+        _check_owner(path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            try:
+                os.unlink(path)
+            except OSError:
+                raise socket.error(*sys.exc_info()[1].args)
+        else:
+            probe.close()
+            raise socket.error(errno.EADDRINUSE,
+                               'udiskie already running on %s' % (path,))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    sock.listen(5)
+    return sock
@@ -4,39 +4,142 @@ Mount utilities.
 
 import logging
 import sys
+import threading
 
 from udiskie.common import wraps
 from udiskie.compat import filter, basestring
 from udiskie.locale import _
+from udiskie.trace import Tracer
 
 
-__all__ = ['Mounter']
+__all__ = ['Mounter', 'device_spec']
 
 
-def _device_method(fn):
+def _find_device(self, device_or_path):
+    """Return the device object, ``None`` if it can not be found."""
+    if not isinstance(device_or_path, basestring):
+        return device_or_path
+    device = self.udisks.find(device_or_path)
+    if device:
+        self._log.debug(_('found device owning "{0}": "{1}"',
+                        device_or_path, device))
+    else:
+        self._log.error(_('no device found owning "{0}"', device_or_path))
+    return device
+
+
+def _device_query(fn):
     @wraps(fn)
     def wrapper(self, device_or_path, *args, **kwargs):
-        if isinstance(device_or_path, basestring):
-            device = self.udisks.find(device_or_path)
-            if device:
-                self._log.debug(_('found device owning "{0}": "{1}"',
-                                device_or_path, device))
-            else:
-                self._log.error(_('no device found owning "{0}"', device_or_path))
-                return False
-        else:
-            device = device_or_path
+        device = _find_device(self, device_or_path)
+        if not device:
+            return False
         try:
             return fn(self, device, *args, **kwargs)
         except device.Exception:
-            err = sys.exc_info()[1]
-            self._log.error(_('failed to {0} {1}: {2}',
-                            fn.__name__, device, err.message))
-            self._set_error(device, fn.__name__, err.message)
+            self._error(fn.__name__, device, sys.exc_info()[1])
             return False
     return wrapper
 
 
+def _device_method(fn):
+    @wraps(fn)
+    def wrapper(self, device_or_path, *args, **kwargs):
+        with self.tracer.span(fn.__name__, device_or_path) as span:
+            device = _find_device(self, device_or_path)
+            if not device:
+                span.outcome = 'failed'
+                return False
+            try:
+                result = fn(self, device, *args, **kwargs)
+            except device.Exception:
+                self._error(fn.__name__, device, sys.exc_info()[1])
+                span.outcome = 'error'
+                return False
+            span.set_result(result)
+            return result
+    return wrapper
+
+
+def device_spec(spec):
+    """
+    Create a predicate that matches devices by a user specification.
+
+    :param str spec: ``uuid=<UUID>``, ``label=<LABEL>`` or a device file
+                     or mount path
+    :returns: ``predicate(device) -> bool``
+    :rtype: callable
+
+    UUIDs are compared case insensitively.
+    """
+    if spec.startswith('uuid='):
+        uuid = spec[len('uuid='):].lower()
+        return lambda device: str(device.id_uuid).lower() == uuid
+    if spec.startswith('label='):
+        label = spec[len('label='):]
+        return lambda device: device.id_label == label
+    return lambda device: device.is_file(spec)
+
+
+def _parallel(func, items, callback=None):
+    """
+    Call the function for each item in a separate thread.
+
+    :param callable func: one-parameter function
+    :param list items: function arguments
+    :param callable callback: ``callback(results)`` is invoked from the
+                              main loop when all calls are finished. If
+                              given, this function returns immediately.
+    :returns: the results in the order of the items, ``None`` if a
+              callback is given
+    :rtype: list
+
+    Without callback, an exception raised by one of the calls is re-raised
+    after all calls are finished. With callback, there is nobody to raise
+    it to, so it is logged and the result of the item is ``False``.
+    """
+    if callback is None and len(items) <= 1:
+        return [func(item) for item in items]
+    from udiskie.dbus import threads_init
+    threads_init()
+    log = logging.getLogger(__name__)
+    results = [None] * len(items)
+    errors = []
+    def run(index, item):
+        try:
+            results[index] = func(item)
+        except Exception:
+            if callback is None:
+                errors.append(sys.exc_info()[1])
+            else:
+                log.exception(_('failed to process {0}', item))
+                results[index] = False
+    threads = [threading.Thread(target=run, args=(index, item))
+               for index, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    if callback is None:
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+    import gobject
+    from udiskie.common import _idle_add
+    gobject.threads_init()
+    def finish():
+        callback(results)
+        return False
+    def wait():
+        for thread in threads:
+            thread.join()
+        _idle_add(finish)
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+    return None
+
+
 class Mounter(object):
 
     """
@@ -46,27 +149,40 @@ class Mounter(object):
     across multiple mount operations.
 
     :ivar udisks: adapter to the udisks service
+    :ivar Tracer tracer: records the phases of all operations
 
     NOTE: The optional parameters are not guaranteed to keep their order and
     should always be passed as keyword arguments.
     """
 
-    def __init__(self, udisks, filter=None, prompt=None, browser=None):
+    def __init__(self, udisks, filter=None, prompt=None, browser=None,
+                 keyfiles=None, cache=None, tracer=None):
         """
         Initialize mounter with the given defaults.
 
         :param udisks: udisks service object. May be a Sniffer or a Daemon.
         :param FilterMatcher filter: customize mount options and handleability
-        :param callable prompt: retrieve passwords for devices
+        :param callable prompt: retrieve passwords for devices, see
+                                :func:`udiskie.prompt.password`
         :param callable browser: open devices
-
-        If prompt is None, device unlocking will not work.
+        :param dict keyfiles: keyfile paths for LUKS devices by UUID, see
+                              :attr:`udiskie.config.Config.keyfiles`
+        :param PasswordCache cache: remember passwords for a short time, see
+                                    :class:`udiskie.prompt.PasswordCache`
+        :param Tracer tracer: span recorder, see :mod:`udiskie.trace`
+
+        If prompt is None, device unlocking will not work unless a keyfile
+        or cached password is available.
         If browser is None, browse will not work.
         """
         self.udisks = udisks
         self._filter = filter
         self._prompt = prompt
         self._browser = browser
+        self._keyfiles = keyfiles or {}
+        self._cache = cache
+        self.tracer = tracer or Tracer()
+        self._prompting = set()
         self._log = logging.getLogger(__name__)
         try:
             # propagate error messages to UDisks1 daemon for 'Job failed'
@@ -75,6 +191,12 @@ class Mounter(object):
         except AttributeError:
             self._set_error = lambda device, action, message: None
 
+    def _error(self, action, device, err):
+        """Log and propagate the error of a failed operation."""
+        self._log.error(_('failed to {0} {1}: {2}',
+                        action, device, err.message))
+        self._set_error(device, action, err.message)
+
     @_device_method
     def browse(self, device):
         """
@@ -113,10 +235,13 @@ class Mounter(object):
             return True
         fstype = str(device.id_type)
         filter = self._filter
-        options = ','.join(filter.get_mount_options(device) if filter else [])
+        with self.tracer.span('filter', device):
+            options = ','.join(filter.get_mount_options(device)
+                               if filter else [])
         kwargs = dict(fstype=fstype, options=options)
         self._log.debug(_('mounting {0} with {1}', device, kwargs))
-        mount_path = device.mount(**kwargs)
+        with self.tracer.span('udisks.mount', device):
+            mount_path = device.mount(**kwargs)
         self._log.info(_('mounted {0} on {1}', device, mount_path))
         return True
 
@@ -136,7 +261,8 @@ class Mounter(object):
             self._log.info(_('not unmounting {0}: not mounted', device))
             return True
         self._log.debug(_('unmounting {0}', device))
-        device.unmount()
+        with self.tracer.span('udisks.unmount', device):
+            device.unmount()
         self._log.info(_('unmounted {0}', device))
         return True
 
@@ -147,8 +273,12 @@ class Mounter(object):
         Unlock the device if not already unlocked.
 
         :param device: device object, block device path or mount path
-        :returns: whether the device is unlocked
+        :returns: whether the device is unlocked, ``None`` if the password
+                  prompt is still pending
         :rtype: bool
+
+        With a non-blocking password prompt, the device is unlocked from
+        the main loop as soon as the password has been entered.
         """
         if not self.is_handleable(device) or not device.is_crypto:
             self._log.warn(_('not unlocking {0}: unhandled device', device))
@@ -156,18 +286,197 @@ class Mounter(object):
         if device.is_unlocked:
             self._log.info(_('not unlocking {0}: already unlocked', device))
             return True
+        if device.object_path in self._prompting:
+            self._log.info(_('not unlocking {0}: already prompting', device))
+            return None
+        if self._unlock_unattended(device):
+            return True
         if not self._prompt:
             self._log.error(_('not unlocking {0}: no password prompt', device))
             return False
-        password = self._prompt(device)
+        results = []
+        prompt_span = self.tracer.begin('prompt', device)
+        def unlock(password):
+            self._prompting.discard(device.object_path)
+            self.tracer.end(prompt_span,
+                            'cancelled' if password is None else 'ok')
+            results.append(self._unlock_with(device, password))
+        self._prompting.add(device.object_path)
+        try:
+            self._prompt(device, unlock)
+        except:
+            self._prompting.discard(device.object_path)
+            self.tracer.end(prompt_span, 'error')
+            raise
+        return results[0] if results else None
+
+    def _unlock_with(self, device, password):
+        """
+        Unlock the device with the password.
+
+        :param device: device object
+        :param str password: password, ``None`` if cancelled by the user
+        :returns: whether the device is unlocked
+        :rtype: bool
+        """
         if password is None:
             self._log.debug(_('not unlocking {0}: cancelled by user', device))
             return False
         self._log.debug(_('unlocking {0}', device))
-        device.unlock(password)
+        try:
+            with self.tracer.span('udisks.unlock', device):
+                device.unlock(password)
+        except device.Exception:
+            self._error('unlock', device, sys.exc_info()[1])
+            return False
+        self._log.info(_('unlocked {0}', device))
+        if self._cache:
+            self._cache.put(device, password)
+        return True
+
+    def _unlock_unattended(self, device):
+        """
+        Try to unlock the device without user interaction.
+
+        :param device: device object
+        :returns: whether the device is unlocked
+        :rtype: bool
+
+        A configured keyfile is tried first, then a cached password.
+        Failures are logged and ``False`` is returned, so the caller can
+        fall back to the password prompt.
+        """
+        keyfile = self._keyfiles.get(str(device.id_uuid).lower())
+        if keyfile:
+            if self._unlock_keyfile(device, keyfile):
+                return True
+        password = self._cache.get(device) if self._cache else None
+        if password is None:
+            return False
+        self._log.debug(_('unlocking {0} using cached password', device))
+        try:
+            with self.tracer.span('udisks.unlock', device):
+                device.unlock(password)
+        except device.Exception:
+            self._log.debug(_('cached password for {0} rejected', device))
+            self._cache.discard(device)
+            return False
         self._log.info(_('unlocked {0}', device))
         return True
 
+    def _unlock_keyfile(self, device, keyfile):
+        """
+        Unlock the device with the contents of the keyfile.
+
+        :param device: device object
+        :param str keyfile: keyfile path
+        :returns: whether the device is unlocked
+        :rtype: bool
+        """
+        unlock_keyfile = getattr(device, 'unlock_keyfile', None)
+        if unlock_keyfile is None:
+            self._log.warn(_('not unlocking {0} using keyfile: '
+                             'not supported by backend', device))
+            return False
+        try:
+            with open(keyfile, 'rb') as f:
+                keyfile_contents = f.read()
+        except IOError:
+            self._log.error(_('failed to read keyfile {0}: {1}',
+                              keyfile, sys.exc_info()[1]))
+            return False
+        self._log.debug(_('unlocking {0} using keyfile {1}', device, keyfile))
+        try:
+            with self.tracer.span('udisks.unlock_keyfile', device):
+                unlock_keyfile(keyfile_contents)
+        except device.Exception:
+            self._error('unlock', device, sys.exc_info()[1])
+            return False
+        self._log.info(_('unlocked {0} using keyfile', device))
+        return True
+
+    def unlock_all(self, devices=None):
+        """
+        Unlock multiple LUKS devices using a single password prompt.
+
+        :param list devices: devices to unlock, defaults to all handleable
+                             locked LUKS devices
+        :returns: whether all devices were unlocked, ``None`` if the
+                  password prompt is still pending
+        :rtype: bool
+
+        Devices with a configured keyfile or cached password are unlocked
+        without prompting. The password is tried on all other devices in
+        parallel. The user is prompted again for the devices that could not
+        be unlocked.
+        """
+        if devices is None:
+            devices = [device for device in self.get_all_handleable()
+                       if device.is_crypto and not device.is_unlocked]
+        pending = [device for device in devices
+                   if device.object_path in self._prompting]
+        devices = [device for device in devices
+                   if device.object_path not in self._prompting]
+        devices = [device for device in devices
+                   if not self._unlock_unattended(device)]
+        result = self._unlock_all_prompt(devices)
+        if result and pending:
+            # still waiting for the password of another request:
+            return None
+        return result
+
+    def _unlock_all_prompt(self, devices):
+        """
+        Unlock the devices using a single password prompt.
+
+        :param list devices: devices to unlock
+        :returns: whether all devices were unlocked, ``None`` if the
+                  password prompt is still pending
+        :rtype: bool
+        """
+        if not devices:
+            return True
+        if not self._prompt:
+            self._log.error(_('not unlocking {0}: no password prompt',
+                              ', '.join(map(str, devices))))
+            return False
+        object_paths = [device.object_path for device in devices]
+        results = []
+        # whether the prompt has returned, i.e. we are in the main loop:
+        returned = []
+        prompt_span = self.tracer.begin('prompt', ', '.join(object_paths))
+        def unlock(password):
+            self.tracer.end(prompt_span,
+                            'cancelled' if password is None else 'ok')
+            if password is None:
+                self._prompting.difference_update(object_paths)
+                self._log.debug(_('not unlocking {0}: cancelled by user',
+                                  ', '.join(object_paths)))
+                results.append(False)
+                return
+            def retry(unlocked):
+                self._prompting.difference_update(object_paths)
+                failed = [device
+                          for device, success in zip(devices, unlocked)
+                          if not success]
+                results.append(self._unlock_all_prompt(failed))
+            def try_unlock(device):
+                return self._unlock_with(device, password)
+            if returned:
+                # don't block the main loop while unlocking:
+                _parallel(try_unlock, devices, retry)
+            else:
+                retry(_parallel(try_unlock, devices))
+        self._prompting.update(object_paths)
+        try:
+            self._prompt(devices, unlock)
+        except:
+            self._prompting.difference_update(object_paths)
+            self.tracer.end(prompt_span, 'error')
+            raise
+        returned.append(True)
+        return results[0] if results else None
+
     @_device_method
     def lock(self, device):
         """
@@ -184,7 +493,8 @@ class Mounter(object):
             self._log.info(_('not locking {0}: not unlocked', device))
             return True
         self._log.debug(_('locking {0}', device))
-        device.lock()
+        with self.tracer.span('udisks.lock', device):
+            device.lock()
         self._log.info(_('locked {0}', device))
         return True
 
@@ -276,7 +586,8 @@ class Mounter(object):
         if force:
             self.remove(drive, force=True)
         self._log.debug(_('ejecting {0}', device))
-        device.eject()
+        with self.tracer.span('udisks.eject', device):
+            device.eject()
         self._log.info(_('ejected {0}', device))
         return True
 
@@ -300,7 +611,8 @@ class Mounter(object):
         if force:
             self.remove(drive, force=True)
         self._log.debug(_('detaching {0}', device))
-        device.detach()
+        with self.tracer.span('udisks.detach', device):
+            device.detach()
         self._log.info(_('detached {0}', device))
         return True
 
@@ -312,14 +624,106 @@ class Mounter(object):
         :param bool recursive: recursively mount and unlock child devices
         :returns: whether all attempted operations succeeded
         :rtype: bool
+
+        If there are multiple locked LUKS devices, the password is queried
+        only once for all of them (see :meth:`unlock_all`).
         """
         success = True
-        for device in self.get_all_handleable():
+        for result in self.iter_add_all(recursive=recursive):
+            success = result and success
+        return success
+
+    def iter_add_all(self, recursive=False):
+        """
+        Add all handleable devices one at a time.
+
+        :param bool recursive: recursively mount and unlock child devices
+        :returns: generator yielding the result of each operation
+        :rtype: iterable
+
+        This allows to interleave the operations with other work, e.g.
+        by advancing the generator from idle callbacks. See :meth:`add_all`.
+        """
+        devices = list(self.get_all_handleable())
+        locked = [device for device in devices
+                  if device.is_crypto and not device.is_unlocked]
+        if len(locked) > 1:
+            yield self.unlock_all(locked) is not False
+            # the device states are outdated now and the locked devices have
+            # been taken care of (unlocked, cancelled or still prompting):
+            handled = set(device.object_path for device in locked)
+            devices = [device for device in self.get_all_handleable()
+                       if device.object_path not in handled]
+        for device in devices:
             if (device.is_filesystem or
                 device.is_crypto or
                 recursive and device.is_partition_table):
-                success = self.add(device, recursive=recursive) and success
-        return success
+                yield self.add(device, recursive=recursive)
+
+    def run_batch(self, operations, report=None):
+        """
+        Execute multiple operations on devices specified by the user.
+
+        :param list operations: ``(method, spec)`` pairs, where method is
+                                the name of a device method of this class,
+                                and spec is passed to :func:`device_spec`
+        :param callable report: ``report(index, result)`` is invoked after
+                                each operation
+        :returns: the results in the order of the operations
+        :rtype: list
+
+        Operations are executed in stages. In each stage, the devices of
+        the pending operations are looked up in one enumeration of the
+        handleable devices (see :meth:`get_all_handleable`), and the next
+        operation of every drive is executed, different drives in parallel.
+        Thus, operations on the same drive are executed in order and see
+        the effects of the previous ones. If a device can't be found (e.g.
+        the cleartext device of a LUKS partition that is unlocked by a
+        previous operation), the following operations are deferred to the
+        next stage. The operation fails if there is no previous operation
+        left to wait for.
+
+        The worker threads only operate on the enumerated devices, the
+        state of the udisks service object is only accessed from the
+        calling thread.
+        """
+        results = [None] * len(operations)
+        lock = threading.Lock()
+        def finish(index, result):
+            results[index] = result
+            if report:
+                with lock:
+                    report(index, result)
+        def run(step):
+            index, method, device = step
+            finish(index, getattr(self, method)(device))
+        pending = list(enumerate(operations))
+        while pending:
+            devices = list(self.get_all_handleable())
+            stage = []
+            drives = set()
+            deferred = []
+            for position, (index, (method, spec)) in enumerate(pending):
+                match = device_spec(spec)
+                device = next((dev for dev in devices if match(dev)), None)
+                if device is None and stage:
+                    # may be created by an operation of this stage:
+                    deferred.extend(pending[position:])
+                    break
+                if device is None:
+                    self._log.error(_('no device found matching "{0}"', spec))
+                    finish(index, False)
+                    continue
+                drive = device.drive
+                key = drive.object_path if drive else device.object_path
+                if key in drives:
+                    deferred.append((index, (method, spec)))
+                else:
+                    drives.add(key)
+                    stage.append((index, method, device))
+            _parallel(run, stage)
+            pending = deferred
+        return results
 
     def remove_all(self, detach=False, eject=False, lock=False):
         """
@@ -394,7 +798,7 @@ class Mounter(object):
         return success
 
     # iterate devices
-    @_device_method
+    @_device_query
     def is_handleable(self, device):
         """
         Check whether this device should be handled by udiskie.
@@ -419,6 +823,9 @@ class Mounter(object):
         :rtype: iterable
 
         NOTE: returns only devices that are still valid. This protects from
-        race conditions inside udiskie.
+        race conditions inside udiskie. If supported by the udisks service
+        object, the devices are taken from a consistent snapshot.
         """
-        return filter(self.is_handleable, self.udisks)
+        snapshot = getattr(self.udisks, 'snapshot', None)
+        devices = snapshot() if snapshot else self.udisks
+        return filter(self.is_handleable, devices)
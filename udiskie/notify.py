@@ -2,9 +2,20 @@
 Notification utility.
 """
 
+from collections import namedtuple, OrderedDict
+
+from udiskie.common import Emitter, drive_key, _timeout_add
+from udiskie.trace import span
+
+
 __all__ = ['Notify']
 
 
+# notification waiting in the queue:
+Message = namedtuple('Message', ['drive', 'device', 'event', 'summary',
+                                 'text', 'actions'])
+
+
 class Notify(object):
 
     """
@@ -13,27 +24,47 @@ class Notify(object):
     Can be connected to udisks daemon in order to automatically issue
     notifications when system status has changed.
 
+    Notifications are not shown from within the event handlers. They are
+    queued and shown from the main loop after a short time window. Messages
+    for the same drive that arrive within this window are merged into a
+    single notification. A notification that is still open for the drive is
+    updated instead of creating a new one. The action buttons of merged
+    messages are kept, and labeled with their device if the messages are
+    about different devices.
+
     NOTE: the action buttons in the notifications don't work with all
     notification services.
     """
 
-    def __init__(self, notify, mounter, timeout=None):
+    def __init__(self, notify, mounter, timeout=None, window=0.5,
+                 schedule=None):
         """
         Initialize notifier and connect to service.
 
         :param notify: notification service module (pynotify or notify2)
         :param mounter: Mounter object
         :param dict timeout: timeouts
+        :param float window: time in seconds to collect messages before
+                             showing them
+        :param callable schedule: ``schedule(seconds, callback)`` runs the
+                                  callback after the given time. Defaults to
+                                  ``gobject.timeout_add``.
         """
         self._notify = notify
         self._mounter = mounter
+        self._tracer = getattr(mounter, 'tracer', None)
         self._timeout = timeout
-        # pynotify does not store hard references to the notification
-        # objects. When a signal is received and the notification does not
-        # exist anymore, no handller will be called. Therefore, we need to
-        # prevent these notifications from being destroyed by storing
-        # references (note, notify2 doesn't need this):
-        self._notifications = []
+        self._window = window
+        self._schedule = schedule or _timeout_add
+        self._queue = []
+        # Open notifications by drive. pynotify does not store hard
+        # references to the notification objects. When a signal is received
+        # and the notification does not exist anymore, no handler will be
+        # called. Therefore, we need to prevent these notifications from
+        # being destroyed by storing references (note, notify2 doesn't need
+        # this). The references are also used to update the notification
+        # instead of creating a new one:
+        self._notifications = {}
         # Subscribe all enabled events to the daemon:
         udisks = mounter.udisks
         for event in ['device_mounted', 'device_unmounted',
@@ -41,7 +72,13 @@ class Notify(object):
                       'device_added', 'device_removed',
                       'job_failed']:
             if self._enabled(event):
-                udisks.connect(event, getattr(self, event))
+                udisks.connect(event, getattr(self, event),
+                               Emitter.PRIORITY_LOW)
+
+    @property
+    def pending(self):
+        """Number of messages waiting to be shown."""
+        return len(self._queue)
 
     # event handlers:
     def device_mounted(self, device):
@@ -52,22 +89,18 @@ class Notify(object):
         """
         label = device.id_label
         mount_path = device.mount_paths[0]
-        notification = self._notification(
-            'device_mounted',
-            'Device mounted',
-            '%s mounted on %s' % (label, mount_path),
-            'drive-removable-media')
+        actions = []
         if self._mounter._browser:
             # Show a 'Browse directory' button in mount notifications.
             # Note, this only works with some libnotify services.
             def on_browse(notification, action):
                 self._mounter.browse(device)
-            notification.add_action('browse', "Browse directory", on_browse)
-            # Need to store a reference (see above) only if there is a
-            # signal connected:
-            notification.connect('closed', self._notifications.remove)
-            self._notifications.append(notification)
-        notification.show()
+            actions.append(('browse', "Browse directory", on_browse))
+        self._post(device,
+                   'device_mounted',
+                   'Device mounted',
+                   '%s mounted on %s' % (label, mount_path),
+                   actions)
 
     def device_unmounted(self, device):
         """
@@ -76,11 +109,10 @@ class Notify(object):
         :param device: device object
         """
         label = device.id_label
-        self._notification(
-            'device_unmounted',
-            'Device unmounted',
-            '%s unmounted' % (label,),
-            'drive-removable-media').show()
+        self._post(device,
+                   'device_unmounted',
+                   'Device unmounted',
+                   '%s unmounted' % (label,))
 
     def device_locked(self, device):
         """
@@ -89,11 +121,10 @@ class Notify(object):
         :param device: device object
         """
         device_file = device.device_presentation
-        self._notification(
-            'device_locked',
-            'Device locked',
-            '%s locked' % (device_file,),
-            'drive-removable-media').show()
+        self._post(device,
+                   'device_locked',
+                   'Device locked',
+                   '%s locked' % (device_file,))
 
     def device_unlocked(self, device):
         """
@@ -102,11 +133,10 @@ class Notify(object):
         :param device: device object
         """
         device_file = device.device_presentation
-        self._notification(
-            'device_unlocked',
-            'Device unlocked',
-            '%s unlocked' % (device_file,),
-            'drive-removable-media').show()
+        self._post(device,
+                   'device_unlocked',
+                   'Device unlocked',
+                   '%s unlocked' % (device_file,))
 
     def device_added(self, device):
         """
@@ -116,11 +146,10 @@ class Notify(object):
         """
         device_file = device.device_presentation
         if (device.is_drive or device.is_toplevel) and device_file:
-            self._notification(
-                'device_added',
-                'Device added',
-                'device appeared on %s' % (device_file,),
-                'drive-removable-media').show()
+            self._post(device,
+                       'device_added',
+                       'Device added',
+                       'device appeared on %s' % (device_file,))
 
     def device_removed(self, device):
         """
@@ -130,11 +159,10 @@ class Notify(object):
         """
         device_file = device.device_presentation
         if (device.is_drive or device.is_toplevel) and device_file:
-            self._notification(
-                'device_removed',
-                'Device removed',
-                'device disappeared on %s' % (device_file,),
-                'drive-removable-media').show()
+            self._post(device,
+                       'device_removed',
+                       'Device removed',
+                       'device disappeared on %s' % (device_file,))
 
     def job_failed(self, device, action, message):
         """
@@ -147,9 +175,7 @@ class Notify(object):
             text = 'failed to %s %s:\n%s' % (action, device_file, message)
         else:
             text = 'failed to %s device %s.' % (action, device_file,)
-        notification = self._notification('job_failed',
-                                          'Job failed', text,
-                                          'drive-removable-media')
+        actions = []
         try:
             retry = getattr(self._mounter, action)
         except AttributeError:
@@ -159,31 +185,101 @@ class Notify(object):
             # Note, this only works with some libnotify services.
             def on_retry(notification, action):
                 retry(device)
-            notification.add_action('retry', "Retry", on_retry)
-            # Need to store a reference (see above) only if there is a
-            # signal connected:
-            notification.connect('closed', self._notifications.remove)
-            self._notifications.append(notification)
-        notification.show()
+            actions.append(('retry', "Retry", on_retry))
+        self._post(device, 'job_failed', 'Job failed', text, actions)
 
-    def _notification(self, event, summary, message, icon):
+    def _post(self, device, event, summary, text, actions=()):
         """
-        Create a notification object.
+        Queue a message to be shown from the main loop.
 
+        :param device: device object
         :param str event: event name
         :param str summary: notification title
-        :param str message: notification body
-        :param str icon: icon name
-        :returns: notification object
+        :param str text: notification body
+        :param list actions: ``(name, label, callback)`` for action buttons
+        """
+        self._queue.append(Message(drive_key(device), device, event,
+                                   summary, text, list(actions)))
+        if len(self._queue) == 1:
+            self._schedule(self._window, self.flush)
 
-        This is just a small convenience method to get the timeouts
-        correct everywhere.
+    def flush(self):
+        """
+        Show all queued messages, at most one notification per drive.
+
+        :returns: ``False``, to be usable as one-shot main loop callback
+        :rtype: bool
         """
-        notification = self._notify.Notification(summary, message, icon)
-        timeout = self._get_timeout(event)
+        queue, self._queue = self._queue, []
+        drives = OrderedDict()
+        for message in queue:
+            drives.setdefault(message.drive, []).append(message)
+        for drive, messages in drives.items():
+            if len(messages) == 1:
+                message = messages[0]
+            else:
+                message = Message(
+                    drive,
+                    messages[-1].device,
+                    messages[-1].event,
+                    '%d device events' % (len(messages),),
+                    '\n'.join(message.text for message in messages),
+                    self._merge_actions(messages))
+            with span('notify', drive, self._tracer):
+                self._show(message)
+        return False
+
+    def _merge_actions(self, messages):
+        """
+        Combine the action buttons of multiple messages.
+
+        :param list messages: messages for the same drive
+        :returns: ``(name, label, callback)`` for action buttons
+        :rtype: list
+
+        If all actions belong to the same device, they are kept as they
+        are (the latest one wins for duplicate names). Otherwise, every
+        action is labeled with its device.
+        """
+        with_actions = [message for message in messages if message.actions]
+        devices = set(message.device.object_path for message in with_actions)
+        actions = OrderedDict()
+        for index, message in enumerate(with_actions):
+            for name, label, callback in message.actions:
+                if len(devices) > 1:
+                    name = '%s-%d' % (name, index)
+                    label = '%s %s' % (label, _device_label(message.device))
+                actions[name] = (name, label, callback)
+        return list(actions.values())
+
+    def _show(self, message):
+        """
+        Show the message, update the open notification for its drive.
+
+        :param Message message: notification content
+        """
+        icon = 'drive-removable-media'
+        notification = self._notifications.get(message.drive)
+        if notification is None:
+            notification = self._notify.Notification(message.summary,
+                                                     message.text,
+                                                     icon)
+            drive = message.drive
+            def on_closed(notification):
+                if self._notifications.get(drive) is notification:
+                    del self._notifications[drive]
+            notification.connect('closed', on_closed)
+            self._notifications[drive] = notification
+        else:
+            # keeps the replace-id, so the existing bubble is updated:
+            notification.update(message.summary, message.text, icon)
+            notification.clear_actions()
+        timeout = self._get_timeout(message.event)
         if timeout != -1:
             notification.set_timeout(int(timeout * 1000))
-        return notification
+        for name, label, callback in message.actions:
+            notification.add_action(name, label, callback)
+        notification.show()
 
     def _enabled(self, event):
         """
@@ -215,3 +311,8 @@ class Notify(object):
             return int(timeout)
         except ValueError:
             return float(timeout)
+
+
+def _device_label(device):
+    """Return a short name of the device for button labels."""
+    return device.id_label or device.device_presentation or device.object_path
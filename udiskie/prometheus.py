@@ -0,0 +1,304 @@
+"""
+Metrics export in the Prometheus text format.
+
+The :class:`TextfileExporter` periodically writes the metrics to a file
+that can be picked up by the textfile collector of the node_exporter.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from udiskie.common import _timeout_add
+
+
+__all__ = ['TextfileExporter', 'format_metric']
+
+
+def _escape(value):
+    """Escape a label value."""
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = '{' + ','.join('%s="%s"' % (key, _escape(val))
+                                    for key, val in labels) + '}'
+    else:
+        label_text = ''
+    return '%s%s %s' % (name, label_text, repr(float(value)))
+
+
+def format_metric(name, kind, help, samples):
+    """
+    Format a metric family.
+
+    :param str name: metric name
+    :param str kind: 'counter', 'gauge' or 'histogram'
+    :param str help: description
+    :param list samples: ``(labels, value)`` pairs, where labels is a list
+                         of ``(key, value)`` pairs. For histograms, value
+                         is a :class:`udiskie.common.Histogram`.
+    :returns: lines in the Prometheus text exposition format
+    :rtype: list
+    """
+    lines = ['# HELP %s %s' % (name, help),
+             '# TYPE %s %s' % (name, kind)]
+    for labels, value in samples:
+        labels = list(labels)
+        if kind != 'histogram':
+            lines.append(_sample(name, labels, value))
+            continue
+        cumulative = 0
+        for bound, count in zip(value.bounds, value.buckets):
+            cumulative += count
+            lines.append(_sample(name + '_bucket',
+                                 labels + [('le', repr(float(bound)))],
+                                 cumulative))
+        lines.append(_sample(name + '_bucket', labels + [('le', '+Inf')],
+                             value.count))
+        lines.append(_sample(name + '_sum', labels, value.total))
+        lines.append(_sample(name + '_count', labels, value.count))
+    return lines
+
+
+class TextfileExporter(object):
+
+    """
+    Periodically write metrics of the daemon to a ``.prom`` file.
+
+    The file is replaced atomically (write to a temporary file in the same
+    directory, then rename). If no metric except the process and main loop
+    metrics has changed, the file is rewritten only after ``refresh``
+    seconds, so an idle daemon does (almost) no work. Changes are detected
+    by comparing a few counters (device state version, number of finished
+    operations, signals, queue lengths, stalls and DBus calls); the
+    metrics are only collected if one of them has moved.
+
+    The main loop lag is measured as the delay of the periodic timer. The
+    maximum lag since the last write is exported, and a lag of at least
+    ``lag_threshold`` seconds counts as change.
+
+    :ivar Watchdog watchdog: if set, main loop stalls are exported as well
+    """
+
+    def __init__(self, path, mounter, notify=None, dbus_stats=None,
+                 interval=15, refresh=300, lag_threshold=1.0, schedule=None):
+        """
+        Write the file and start the timer.
+
+        :param str path: output file, should end with ``.prom``
+        :param Mounter mounter: mounter object of the daemon
+        :param Notify notify: notifier, for the queue depth
+        :param CallStats dbus_stats: DBus call statistics, see
+                                     :func:`udiskie.dbus.enable_stats`
+        :param float interval: time in seconds between updates
+        :param float refresh: maximum time in seconds between writes
+        :param float lag_threshold: main loop lag in seconds that triggers
+                                    a write
+        :param callable schedule: ``schedule(seconds, callback)`` runs the
+                                  callback periodically until it returns
+                                  False. Defaults to ``gobject.timeout_add``.
+        """
+        self._log = logging.getLogger(__name__)
+        self._path = path
+        self._mounter = mounter
+        self._notify = notify
+        self._dbus_stats = dbus_stats
+        self.watchdog = None
+        self._interval = interval
+        self._refresh = refresh
+        self._lag_threshold = lag_threshold
+        self._last_key = None
+        self._last_text = None
+        self._last_write = 0
+        self._last_tick = self._last_update = time.time()
+        self._last_signals = self._signal_count()
+        self._signal_rate = 0.0
+        self._max_lag = 0.0
+        self.update()
+        (schedule or _timeout_add)(interval, self._tick)
+
+    def _tick(self):
+        now = time.time()
+        lag = max(0.0, now - self._last_tick - self._interval)
+        self._max_lag = max(self._max_lag, lag)
+        self._last_tick = now
+        self.update()
+        return True
+
+    def update(self):
+        """
+        Write the metrics file if necessary.
+
+        :returns: whether the file was written
+        :rtype: bool
+        """
+        now = time.time()
+        outdated = now - self._last_write >= self._refresh
+        key = self._change_key()
+        if key is not None:
+            if (key == self._last_key and not outdated and
+                    self._max_lag < self._lag_threshold):
+                return False
+        signals = self._signal_count()
+        elapsed = now - self._last_update
+        if elapsed > 0:
+            self._signal_rate = (signals - self._last_signals) / elapsed
+        text = '\n'.join(self._collect()) + '\n'
+        if (key is None and text == self._last_text and not outdated and
+                self._max_lag < self._lag_threshold):
+            return False
+        self._last_signals = signals
+        self._last_update = now
+        volatile = '\n'.join(self._collect_volatile()) + '\n'
+        try:
+            self._write(text + volatile)
+        except (IOError, OSError):
+            self._log.error('failed to write metrics to %s: %s'
+                            % (self._path, sys.exc_info()[1]))
+            return False
+        self._last_key = key
+        self._last_text = text
+        self._last_write = now
+        self._max_lag = 0.0
+        return True
+
+    def _change_key(self):
+        """
+        Return counters that move whenever the collected metrics change.
+
+        :returns: tuple of counters, ``None`` if the device state of the
+                  udisks service object is not versioned
+        :rtype: tuple
+        """
+        snapshot = getattr(self._mounter.udisks, 'snapshot', None)
+        if snapshot is None:
+            return None
+        tracer = getattr(self._mounter, 'tracer', None)
+        throttle = getattr(self._mounter.udisks, 'throttle', None)
+        return (snapshot().version,
+                sum(tracer.counts.values()) if tracer else 0,
+                throttle.stats['signals'] if throttle else 0,
+                throttle.stats['dropped'] if throttle else 0,
+                len(throttle.dirty) if throttle else 0,
+                self._notify.pending if self._notify else 0,
+                sum(self.watchdog.stalls.values()) if self.watchdog else 0,
+                getattr(self._dbus_stats, 'num_calls', 0))
+
+    def _write(self, text):
+        """Replace the file atomically."""
+        dirname = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.udiskie-',
+                                   suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            # readable for the node_exporter:
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self._path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def _signal_count(self):
+        throttle = getattr(self._mounter.udisks, 'throttle', None)
+        return throttle.stats['signals'] if throttle else 0
+
+    def _collect(self):
+        """Return the metrics that change only when something happens."""
+        lines = []
+        states = {'mounted': 0, 'unmounted': 0, 'unlocked': 0, 'locked': 0}
+        for device in self._mounter.get_all_handleable():
+            if device.is_filesystem:
+                states['mounted' if device.is_mounted else 'unmounted'] += 1
+            elif device.is_crypto:
+                states['unlocked' if device.is_unlocked else 'locked'] += 1
+        lines += format_metric(
+            'udiskie_devices', 'gauge',
+            'Handleable devices by state.',
+            [([('state', state)], num)
+             for state, num in sorted(states.items())])
+        tracer = getattr(self._mounter, 'tracer', None)
+        if tracer:
+            lines += format_metric(
+                'udiskie_operations_total', 'counter',
+                'Operations and their phases by result.',
+                [([('operation', name), ('result', outcome)], num)
+                 for (name, outcome), num in sorted(tracer.counts.items(),
+                                                    key=str)])
+        queues = []
+        if self._notify:
+            queues.append(([('queue', 'notify')], self._notify.pending))
+        throttle = getattr(self._mounter.udisks, 'throttle', None)
+        if throttle:
+            queues.append(([('queue', 'reconcile')], len(throttle.dirty)))
+            lines += format_metric(
+                'udiskie_dbus_signals_total', 'counter',
+                'Received udisks signals.',
+                [([], throttle.stats['signals'])])
+            lines += format_metric(
+                'udiskie_dbus_signals_dropped_total', 'counter',
+                'Signals dropped during signal storms.',
+                [([], throttle.stats['dropped'])])
+            lines += format_metric(
+                'udiskie_dbus_signal_rate', 'gauge',
+                'Signals per second since the last write.',
+                [([], self._signal_rate)])
+        lines += format_metric(
+            'udiskie_event_queue_depth', 'gauge',
+            'Events waiting to be processed.', queues)
+        if self.watchdog:
+            lines += format_metric(
+                'udiskie_main_loop_stalls_total', 'counter',
+                'Main loop stalls by culprit.',
+                [([('culprit', culprit)], num)
+                 for culprit, num in sorted(self.watchdog.stalls.items())])
+        if self._dbus_stats is not None:
+            calls = self._dbus_stats.histograms()
+            lines += format_metric(
+                'udiskie_dbus_call_duration_seconds', 'histogram',
+                'Latency of DBus method calls and property reads.',
+                [([('interface', i), ('member', m)], hist)
+                 for (i, m), (errors, hist) in calls])
+            lines += format_metric(
+                'udiskie_dbus_call_errors_total', 'counter',
+                'Failed DBus method calls and property reads.',
+                [([('interface', i), ('member', m)], errors)
+                 for (i, m), (errors, hist) in calls])
+        return lines
+
+    def _collect_volatile(self):
+        """Return metrics that change all the time."""
+        times = os.times()
+        lines = []
+        lines += format_metric(
+            'udiskie_main_loop_lag_seconds', 'gauge',
+            'Maximum delay of the timer callback of the main loop since '
+            'the last write.',
+            [([], self._max_lag)])
+        lines += format_metric(
+            'process_resident_memory_bytes', 'gauge',
+            'Resident memory size in bytes.',
+            [([], _resident_memory())])
+        lines += format_metric(
+            'process_cpu_seconds_total', 'counter',
+            'Total user and system CPU time spent in seconds.',
+            [([], times[0] + times[1])])
+        return lines
+
+
+def _resident_memory():
+    """Return the resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        # peak usage, in kilobytes on linux:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -4,20 +4,33 @@ User prompt utility.
 
 from distutils.spawn import find_executable
 import logging
+import os
 import subprocess
+import time
 
+from udiskie.common import _timeout_add
 
-__all__ = ['password', 'browser']
 
+__all__ = ['password', 'PasswordCache', 'browser']
 
-def password(prompt_name='zenity'):
+
+def password(prompt_name='zenity', blocking=True):
 
     """
     Create a password prompt function.
 
     :param str prompt_name: password program name
-    :returns: one-parameter prompt function
+    :param bool blocking: wait for the password program to finish. If
+                          false, the program is run asynchronously from the
+                          gobject main loop.
+    :returns: two-parameter prompt function ``prompt(device, callback)``
     :rtype: callable
+
+    The device parameter may also be a list of devices that share the same
+    password. The callback is invoked with the entered password or with
+    ``None`` if the user cancelled. Non-blocking prompts return immediately
+    and invoke the callback from the main loop, so multiple prompts can be
+    pending at the same time.
     """
 
     if not prompt_name:
@@ -27,40 +40,165 @@ def password(prompt_name='zenity'):
     if executable is None:
         return None
 
-    text = 'Enter password for {0.device_presentation}:'
+    text = 'Enter password for {0}:'
+
+    def presentations(device):
+        devices = device if isinstance(device, (list, tuple)) else [device]
+        return [str(dev.device_presentation) for dev in devices]
 
     # builtin variant: enter password via zenity:
     if prompt_name == 'zenity':
-        def doprompt(device):
-            return subprocess.check_output([
-                executable,
-                '--entry', '--hide-text',
-                '--text', text.format(device),
-                '--title', 'Unlock encrypted device' ])
+        def command(device):
+            return [executable,
+                    '--entry', '--hide-text',
+                    '--text', text.format(', '.join(presentations(device))),
+                    '--title', 'Unlock encrypted device' ]
 
     # builtin variant: enter password via systemd-ask-password:
     elif prompt_name == 'systemd-ask-password':
-        def doprompt(device):
-            return subprocess.check_output([executable, text.format(device)])
+        def command(device):
+            return [executable,
+                    text.format(', '.join(presentations(device)))]
 
     # enter password via user supplied binary:
     else:
-        def doprompt(device):
-            return subprocess.check_output([executable,
-                                            device.device_presentation])
+        def command(device):
+            return [executable] + presentations(device)
 
-    def password_prompt(device):
-        try:
-            answer = doprompt(device).decode('utf-8')
-            # strip trailing newline from program output:
-            return answer.rstrip('\n')
-        except subprocess.CalledProcessError:
+    def parse(output):
+        if output is None:
             # usually this means the user cancelled
             return None
+        # strip trailing newline from program output:
+        return output.decode('utf-8').rstrip('\n')
+
+    if blocking:
+        def password_prompt(device, callback):
+            try:
+                output = subprocess.check_output(command(device))
+            except subprocess.CalledProcessError:
+                output = None
+            callback(parse(output))
+    else:
+        def password_prompt(device, callback):
+            _spawn_async(command(device),
+                         lambda output: callback(parse(output)))
 
     return password_prompt
 
 
+class PasswordCache(object):
+
+    """
+    Short-lived in-memory password cache.
+
+    Passwords are stored per device UUID and forgotten after the timeout
+    has expired. Expired passwords are purged on every access and by a
+    timer, so they don't stay in memory while the cache is not used.
+    """
+
+    def __init__(self, timeout, clock=time.time, schedule=None):
+        """
+        Initialize an empty cache.
+
+        :param float timeout: time in seconds to keep passwords
+        :param callable clock: returns the current time in seconds
+        :param callable schedule: ``schedule(seconds, callback)`` runs the
+                                  callback after the given time until it
+                                  returns False. Defaults to
+                                  ``gobject.timeout_add``.
+        """
+        self._timeout = timeout
+        self._clock = clock
+        self._schedule = schedule or _timeout_add
+        self._passwords = {}
+        self._timer = False
+
+    def get(self, device):
+        """
+        Get the cached password for the device.
+
+        :param device: device object
+        :returns: password, ``None`` if not cached or expired
+        """
+        self._purge()
+        try:
+            return self._passwords[device.id_uuid][0]
+        except KeyError:
+            return None
+
+    def put(self, device, password):
+        """Store the password for the device."""
+        self._purge()
+        self._passwords[device.id_uuid] = (password,
+                                           self._clock() + self._timeout)
+        if not self._timer:
+            self._timer = True
+            self._schedule(self._timeout, self._on_timer)
+
+    def discard(self, device):
+        """Forget the password for the device."""
+        self._passwords.pop(device.id_uuid, None)
+
+    def _purge(self):
+        """Forget all expired passwords."""
+        now = self._clock()
+        for key, (password, expiry) in list(self._passwords.items()):
+            if expiry <= now:
+                del self._passwords[key]
+
+    def _on_timer(self):
+        """Purge expired passwords and wait for the next expiry."""
+        self._purge()
+        self._timer = False
+        if self._passwords:
+            expiry = min(expiry for password, expiry in
+                         self._passwords.values())
+            self._timer = True
+            self._schedule(max(0, expiry - self._clock()), self._on_timer)
+        return False
+
+
+def _spawn_async(argv, callback):
+    """
+    Run a program without blocking the gobject main loop.
+
+    :param list argv: program and arguments
+    :param callable callback: invoked with the program output (bytes) when
+                              the program has finished, or with ``None`` if
+                              the program failed.
+    """
+    import gobject
+    pid, stdin, stdout, stderr = gobject.spawn_async(
+        argv,
+        flags=gobject.SPAWN_DO_NOT_REAP_CHILD,
+        standard_output=True)
+    chunks = []
+    watch = []
+    def on_output(fd, condition):
+        data = os.read(fd, 4096)
+        if data:
+            chunks.append(data)
+            return True
+        del watch[:]
+        return False
+    def on_exit(pid, status):
+        if watch:
+            gobject.source_remove(watch.pop())
+        # read remaining output:
+        while on_output(stdout, gobject.IO_IN):
+            pass
+        os.close(stdout)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            callback(b''.join(chunks))
+        else:
+            callback(None)
+    watch.append(gobject.io_add_watch(stdout,
+                                      gobject.IO_IN | gobject.IO_HUP,
+                                      on_output))
+    gobject.child_watch_add(pid, on_exit)
+
+
 def browser(browser_name='xdg-open'):
     """
     Create a browse-directory function.
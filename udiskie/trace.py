@@ -0,0 +1,203 @@
+"""
+Operation tracing.
+
+Mount operations are recorded as nested spans, e.g. an ``add`` span
+containing an ``unlock`` span containing the ``prompt`` and the
+``udisks.unlock`` phases. Finished spans are kept in a ring buffer and
+can be exported in the Chrome trace event format, which can be viewed in
+``chrome://tracing`` or similar trace viewers.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+import time
+
+
+__all__ = ['Span', 'Tracer', 'span']
+
+
+# stack of (tracer, span) for the spans open in the current thread:
+_local = threading.local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+class Span(object):
+
+    """
+    Time interval of an operation or one of its phases.
+
+    :ivar int id: unique span id
+    :ivar int parent: id of the enclosing span or ``None``
+    :ivar str name: operation or phase name
+    :ivar str device: device the operation applies to
+    :ivar float start: start time (seconds since the epoch)
+    :ivar float duration: duration in seconds, ``None`` while unfinished
+    :ivar str outcome: 'ok', 'failed', 'pending', 'cancelled' or 'error'
+    :ivar int thread: thread identifier
+    """
+
+    __slots__ = ['id', 'parent', 'name', 'device', 'start', 'duration',
+                 'outcome', 'thread']
+
+    def __init__(self, id, parent, name, device):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.device = device
+        self.start = time.time()
+        self.duration = None
+        self.outcome = None
+        self.thread = threading.current_thread().ident
+
+    def set_result(self, result):
+        """Set the outcome from the return value of a mount operation."""
+        if result is None:
+            self.outcome = 'pending'
+        else:
+            self.outcome = 'ok' if result else 'failed'
+
+
+class Tracer(object):
+
+    """
+    Record spans in a ring buffer.
+
+    :ivar deque spans: finished spans, oldest first
+    :ivar dict counts: number of all finished spans by (name, outcome)
+    """
+
+    def __init__(self, size=1000):
+        """
+        Initialize an empty buffer.
+
+        :param int size: maximum number of spans to keep
+        """
+        self.spans = deque(maxlen=size)
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def begin(self, name, device=None):
+        """
+        Start a span without making it current.
+
+        :param str name: span name
+        :param device: device object or path
+        :returns: the started span, to be passed to :meth:`end`
+        :rtype: Span
+
+        This is useful for phases that end in a different call stack, e.g.
+        a non-blocking password prompt. The span is a child of the current
+        span of this thread.
+        """
+        stack = _stack()
+        parent = stack[-1][1].id if stack else None
+        with self._lock:
+            id = next(self._ids)
+        return Span(id, parent, name, device and str(device))
+
+    def end(self, span, outcome=None):
+        """
+        Finish a span and store it in the buffer.
+
+        :param Span span: span returned by :meth:`begin`
+        :param str outcome: overrides the outcome of the span
+        """
+        span.duration = time.time() - span.start
+        if outcome is not None:
+            span.outcome = outcome
+        key = (span.name, span.outcome)
+        with self._lock:
+            self.spans.append(span)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    @contextmanager
+    def span(self, name, device=None):
+        """
+        Record a span for the enclosed block.
+
+        Spans started within the block (in the same thread) are nested.
+        The outcome is 'error' if the block raises an exception and it has
+        not been set otherwise.
+        """
+        span = self.begin(name, device)
+        stack = _stack()
+        stack.append((self, span))
+        try:
+            yield span
+        except BaseException:
+            if span.outcome is None:
+                span.outcome = 'error'
+            raise
+        finally:
+            stack.pop()
+            self.end(span)
+
+    def chrome_trace(self):
+        """
+        Return the finished spans as Chrome trace events.
+
+        :returns: JSON serializable trace object
+        :rtype: dict
+        """
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for span in spans:
+            args = {'id': span.id, 'parent': span.parent,
+                    'outcome': span.outcome}
+            if span.device:
+                args['device'] = span.device
+            events.append({'name': span.name,
+                           'cat': 'udiskie',
+                           'ph': 'X',
+                           'ts': int(span.start * 1e6),
+                           'dur': int(span.duration * 1e6),
+                           'pid': pid,
+                           'tid': span.thread,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, filename):
+        """Write the Chrome trace events to a file."""
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+@contextmanager
+def _null_span():
+    yield None
+
+
+def span(name, device=None, tracer=None):
+    """
+    Record a span for the enclosed block if tracing is active.
+
+    :param str name: span name
+    :param device: device object or path
+    :param Tracer tracer: tracer to use. Defaults to the tracer of the
+                          current span of this thread.
+    :returns: context manager yielding the :class:`Span` or ``None``
+
+    This allows to trace phases from code that does not know about the
+    tracer, e.g. the udisks backends. Outside of traced operations this
+    does nothing.
+    """
+    if tracer is None:
+        stack = _stack()
+        if not stack:
+            return _null_span()
+        tracer = stack[-1][0]
+    return tracer.span(name, device)
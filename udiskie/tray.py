@@ -8,7 +8,7 @@ from itertools import chain
 
 import gtk
 
-from udiskie.common import setdefault
+from udiskie.common import Emitter, setdefault
 
 
 __all__ = ['UdiskieMenu', 'SmartUdiskieMenu', 'TrayIcon']
@@ -26,6 +26,10 @@ class UdiskieMenu(object):
     Builder for udiskie menus.
 
     Objects of this class generate action menus when being called.
+
+    The menu is kept between calls and rebuilt only when the set of
+    handleable devices or their state has changed. Menu items of unchanged
+    devices are reused.
     """
 
     _menu_icons = {
@@ -48,6 +52,10 @@ class UdiskieMenu(object):
         'detach': 'Unpower %s',
         'quit': 'Quit', }
 
+    # maximum number of entries per menu group, the remaining entries are
+    # moved to a 'More' submenu:
+    _page_size = 20
+
     def __init__(self, mounter, actions={}):
         """
         Initialize a new menu maker.
@@ -83,33 +91,80 @@ class UdiskieMenu(object):
             'detach': partial(mounter.detach, force=True),
             'quit': gtk.main_quit, })
         self._actions = actions
+        # If supported by the daemon, the set of handleable devices is
+        # maintained incrementally from udisks events. The query replaces
+        # the device object whenever the device (or a related device) has
+        # changed, so cached data is valid as long as the device object is
+        # the same:
+        query = getattr(mounter.udisks, 'query', None)
+        self._devices = query(mounter.is_handleable) if query else None
+        self._nodes = {}
+        self._items = {}
+        self._next_items = {}
+        # items of submenus that are populated on demand, by submenu path,
+        # see _lazymenuitem:
+        self._submenu_items = {}
+        self._menu = None
+        self._menu_devices = []
 
     def __call__(self):
         """
         Create menu for udiskie mount operations.
 
-        :returns: a new menu
+        :returns: the menu, reused if nothing has changed
         :rtype: gtk.Menu
         """
+        devices = self._handleable()
+        if (self._menu is not None and
+                len(devices) == len(self._menu_devices) and
+                all(a is b for a, b in zip(devices, self._menu_devices))):
+            return self._menu
         # create actions items
+        self._next_items = {}
         menu = self._branchmenu(self._prepare_menu(self.detect()).groups)
         # append menu item for closing the application
         if self._actions.get('quit'):
             if len(menu) > 0:
                 menu.append(gtk.SeparatorMenuItem())
             menu.append(self._actionitem('quit'))
+        # keep only the items of the current menu:
+        self._items = self._next_items
+        self._next_items = {}
+        submenus = set((item.get_label(), index)
+                       for index, item in enumerate(menu.get_children())
+                       if item.get_submenu() is not None)
+        self._submenu_items = dict(
+            (path, items) for path, items in self._submenu_items.items()
+            if path[0] in submenus)
+        self._menu = menu
+        self._menu_devices = devices
         return menu
 
+    def _handleable(self):
+        """Get list of all handleable devices."""
+        if self._devices is not None:
+            return list(self._devices)
+        return list(self._mounter.get_all_handleable())
+
     def detect(self):
         """
         Detect all currently known devices.
 
         :returns: root of device hierarchy
         :rtype: Node
+
+        Nodes are cached and recreated only for changed devices.
         """
         root = Node(None, [], None, "", [])
-        device_nodes = dict(map(self._device_node,
-                                self._mounter.get_all_handleable()))
+        nodes = {}
+        for device in self._handleable():
+            node = self._nodes.get(device.object_path)
+            if node is None or node.device is not device:
+                node = self._device_node(device)[1]
+            nodes[device.object_path] = node
+        self._nodes = nodes
+        device_nodes = dict((object_path, node._replace(branches=[]))
+                            for object_path, node in nodes.items())
         # insert child devices as branches into their roots:
         for object_path, node in device_nodes.items():
             device_nodes.get(node.root, root).branches.append(node)
@@ -122,28 +177,72 @@ class UdiskieMenu(object):
         :param Branch groups: contains information about the menu
         :returns: a new menu object holding all groups of the node
         :rtype: gtk.Menu
+
+        Submenus are only populated when they are opened for the first
+        time.
         """
         menu = gtk.Menu()
+        self._populate(menu, groups)
+        return menu
+
+    def _populate(self, menu, groups, path=(), items=None, next_items=None):
+        """
+        Append the menu items for the given groups.
+
+        :param gtk.Menu menu: menu to be filled
+        :param list groups: contains information about the menu items
+        :param tuple path: path of the enclosing submenu
+        :param dict items: items of the previous menu to be reused
+        :param dict next_items: receives the items of this menu
+        """
         separate = False
         for group in groups:
             if len(group) > 0:
                 if separate:
                     menu.append(gtk.SeparatorMenuItem())
                 separate = True
+            if len(group) > self._page_size:
+                group = (list(group[:self._page_size]) +
+                         [Branch('More', [group[self._page_size:]])])
             for node in group:
                 if isinstance(node, Action):
                     menu.append(self._actionitem(
                         node.method,
                         feed=[node.label],
-                        bind=[node.device]))
+                        bind=[node.device],
+                        items=items,
+                        next_items=next_items))
                 elif isinstance(node, Branch):
-                    menu.append(self._menuitem(
-                        node.label,
-                        icon=None,
-                        onclick=self._branchmenu(node.groups)))
+                    menu.append(self._lazymenuitem(node, path, len(menu)))
                 else:
                     raise ValueError("Invalid node!")
-        return menu
+
+    def _lazymenuitem(self, branch, path=(), index=0):
+        """
+        Create a menu item with a submenu that is created on demand.
+
+        :param Branch branch: contains information about the submenu
+        :param tuple path: path of the enclosing submenu
+        :param int index: position of the item in the enclosing menu
+        :returns: the menu item object
+        :rtype: gtk.MenuItem
+
+        The items of the submenu are kept separately by submenu path, i.e.
+        the labels and positions of the item and its enclosing submenus,
+        so they can be reused when the submenu is opened in a later menu.
+        """
+        submenu = gtk.Menu()
+        item = self._menuitem(branch.label, icon=None, onclick=submenu)
+        path = path + ((branch.label, index),)
+        def populate(item):
+            item.disconnect(handler_id)
+            next_items = {}
+            self._populate(submenu, branch.groups, path,
+                           self._submenu_items.get(path, {}), next_items)
+            self._submenu_items[path] = next_items
+            submenu.show_all()
+        handler_id = item.connect('select', populate)
+        return item
 
     def _menuitem(self, label, icon, onclick):
         """
@@ -171,25 +270,70 @@ class UdiskieMenu(object):
             item.connect('activate', onclick)
         return item
 
-    def _actionitem(self, action, feed=(), bind=()):
+    def _actionitem(self, action, feed=(), bind=(), items=None,
+                    next_items=None):
         """
         Create a menu item for the specified action.
 
         :param str action: name of the action
         :param tuple feed: parameters for the label text
         :param tuple bind: parameters for the onclick handler
+        :param dict items: items of the previous menu, defaults to the
+                           items of the top level menu
+        :param dict next_items: receives the item, defaults to the items of
+                                the top level menu
         :returns: the menu item object
         :rtype: gtk.MenuItem
+
+        Items from the previous menu are reused if label and bound objects
+        are the same.
         """
-        return self._menuitem(
-            self._menu_labels[action] % tuple(feed),
-            self._get_icon(action),
-            lambda _: self._actions[action](*bind))
+        if items is None:
+            items = self._items
+        if next_items is None:
+            next_items = self._next_items
+        key = (action, tuple(feed), tuple(map(id, bind)), 0)
+        # the same action may appear multiple times in a menu:
+        while key in next_items:
+            key = key[:-1] + (key[-1] + 1,)
+        try:
+            item = items[key][0]
+        except KeyError:
+            item = self._menuitem(
+                self._menu_labels[action] % tuple(feed),
+                self._get_icon(action),
+                lambda _: self._actions[action](*bind))
+        else:
+            # detach from the previous menu:
+            parent = item.get_parent()
+            if parent is not None:
+                parent.remove(item)
+        # the bound objects are stored to keep their ids unique:
+        next_items[key] = (item, bind)
+        return item
 
     def _device_node(self, device):
         """Create an empty menu node for the specified device."""
         label = device.id_label or device.device_presentation
-        # determine available methods
+        methods = self._device_methods(device)
+        # find the root device:
+        if device.is_partition:
+            root = device.partition_slave.object_path
+        elif device.is_luks_cleartext:
+            root = device.luks_cleartext_slave.object_path
+        else:
+            root = None
+        # in this first step leave branches empty
+        return device.object_path, Node(root, [], device, label, methods)
+
+    def _device_methods(self, device):
+        """
+        Determine the available actions for the specified device.
+
+        :param device: device object
+        :returns: action names
+        :rtype: list
+        """
         methods = []
         def append(method):
             if self._actions[method]:
@@ -209,15 +353,7 @@ class UdiskieMenu(object):
             append('eject')
         if device.is_detachable:
             append('detach')
-        # find the root device:
-        if device.is_partition:
-            root = device.partition_slave.object_path
-        elif device.is_luks_cleartext:
-            root = device.luks_cleartext_slave.object_path
-        else:
-            root = None
-        # in this first step leave branches empty
-        return device.object_path, Node(root, [], device, label, methods)
+        return methods
 
     def _prepare_menu(self, node):
         """
@@ -287,10 +423,33 @@ class SmartUdiskieMenu(UdiskieMenu):
             return ()
 
     def _prepare_menu(self, node):
-        """Overrides UdiskieMenu._prepare_menu."""
+        """
+        Overrides UdiskieMenu._prepare_menu.
+
+        If there are too many devices for a single menu, the devices are
+        grouped into one submenu per drive.
+        """
+        drives = [(branch, list(self._leaves_group(branch, [], "")))
+                  for branch in node.branches]
+        leaves = list(chain.from_iterable(leaves for _, leaves in drives))
+        if len(leaves) > self._page_size:
+            leaves = list(chain.from_iterable(
+                self._drive_group(branch, leaves)
+                for branch, leaves in drives))
         return Branch(
             label=node.label,
-            groups=[list(self._leaves_group(node, [], ""))])
+            groups=[leaves])
+
+    def _drive_group(self, node, leaves):
+        """
+        Create the submenu for a top level device node.
+
+        :param Node node: device
+        :param list leaves: menu entries of the device and its children
+        """
+        if len(leaves) <= 1:
+            return leaves
+        return [Branch(label=node.label, groups=[leaves])]
 
 
 class TrayIcon(object):
@@ -384,6 +543,11 @@ class AutoTray(TrayIcon):
 
     The menu has no 'Quit' item, and the tray icon will automatically hide
     if there is no action available.
+
+    If supported by the daemon, the devices with available actions are
+    tracked by a query, so that visibility updates don't need to inspect
+    all devices. The icon is shown or hidden at most once per main loop
+    iteration.
     """
 
     def __init__(self, menumaker):
@@ -400,9 +564,19 @@ class AutoTray(TrayIcon):
         self._menu = menumaker
         self._conn_left = None
         self._conn_right = None
+        self._update_pending = False
         # Okay, the following is BAD:
         menumaker._actions['quit'] = None
-        menumaker._mounter.udisks.connect_all(self)
+        mounter = menumaker._mounter
+        query = getattr(mounter.udisks, 'query', None)
+        if query:
+            def has_actions(device):
+                return (mounter.is_handleable(device) and
+                        bool(menumaker._device_methods(device)))
+            self._actionable = query(has_actions, self._on_query_changed)
+        else:
+            self._actionable = None
+            mounter.udisks.connect_all(self, Emitter.PRIORITY_LOW)
         self.show(self.has_menu())
 
     def _show(self):
@@ -417,16 +591,35 @@ class AutoTray(TrayIcon):
 
     def has_menu(self):
         """Check if a menu action is available."""
+        if self._actionable is not None:
+            return len(self._actionable) > 0
         return any(self._menu._prepare_menu(self._menu.detect()).groups)
 
+    def _on_query_changed(self, device, matched):
+        """Update visibility."""
+        self._schedule_update()
+
     def device_changed(self, old_state, new_state):
         """Update visibility."""
-        self.show(self.has_menu())
+        self._schedule_update()
 
     def device_added(self, device):
         """Update visibility."""
-        self.show(self.has_menu())
+        self._schedule_update()
 
     def device_removed(self, device):
         """Update visibility."""
+        self._schedule_update()
+
+    def _schedule_update(self):
+        """Update visibility when the main loop is idle."""
+        if not self._update_pending:
+            import gobject
+            self._update_pending = True
+            gobject.idle_add(self._update)
+
+    def _update(self):
+        """Show or hide the icon, depending on the available actions."""
+        self._update_pending = False
         self.show(self.has_menu())
+        return False
@@ -23,12 +23,14 @@ from inspect import getmembers
 import logging
 import os.path
 
-from udiskie.common import Emitter, samefile
+from udiskie.common import (Emitter, SignalThrottle, PropertyDiff, Toggle,
+                            Changed, Query, samefile)
 from udiskie.compat import filter
-from udiskie.dbus import DBusProxy, DBusService
+from udiskie.dbus import DBusProxy, DBusService, add_signal_receiver
+from udiskie.trace import span
 
 
-__all__ = ['Sniffer', 'Daemon']
+__all__ = ['Sniffer', 'Snapshot', 'Daemon']
 
 
 def filter_opt(opt):
@@ -310,7 +312,10 @@ class OnlineDevice(DBusProxy, DeviceBase):
     # Encrypted methods
     def unlock(self, password):
         """Unlock Luks device."""
-        return self.udisks.update(self.method.LuksUnlock(password, []))
+        with span('LuksUnlock'):
+            object_path = self.method.LuksUnlock(password, [])
+        with span('cleartext'):
+            return self.udisks.update(object_path)
 
     def lock(self):
         """Lock Luks device."""
@@ -366,6 +371,9 @@ class CachedDevice(DeviceBase):
 
     def __getattr__(self, key):
         """Resolve unknown properties and methods via the online device."""
+        if key == '_device':
+            # not yet initialized, e.g. during copy():
+            raise AttributeError(key)
         return getattr(self._device, key)
 
     # Overload properties that return Device objects to return CachedDevice
@@ -399,6 +407,12 @@ class CachedDevice(DeviceBase):
         return CachedDevice(self._device.unlock(password))
 
 
+def _cached_state(device):
+    """Return the cached property values of a CachedDevice."""
+    return {key: value for key, value in vars(device).items()
+            if key not in ('_device', '_daemon')}
+
+
 class UDisks(DBusService):
 
     """
@@ -460,6 +474,59 @@ class Sniffer(UDisks):
                                                               object_path))
     update = get
 
+    def freeze(self):
+        """
+        Return a frozen view of the current state of all devices.
+
+        :rtype: Snapshot
+        """
+        return Snapshot({device.object_path: CachedDevice(device)
+                         for device in self}, 0)
+
+
+class Snapshot(UDisks):
+
+    """
+    Frozen view of all cached device states at a specific point in time.
+
+    Snapshots are obtained via :meth:`Daemon.snapshot` or
+    :meth:`Sniffer.freeze`. The daemon never modifies cached devices in
+    place, but replaces them on change. Thus, snapshots share all cached
+    devices with the daemon and are cheap to create. The devices are copied
+    on first access, so that related devices (drive, partition slave, etc)
+    are resolved within the snapshot as well.
+
+    :ivar int version: state version of the daemon at creation time
+    """
+
+    def __init__(self, devices, version):
+        """
+        Initialize snapshot.
+
+        :param dict devices: cached devices, must not be modified
+        :param int version: state version
+        """
+        self._devices = devices
+        self._bound = {}
+        self.version = version
+
+    def paths(self):
+        """Iterate over all valid cached devices."""
+        return (object_path
+                for object_path,device in self._devices.items()
+                if device)
+
+    def get(self, object_path):
+        """Return the cached state of the device."""
+        device = self._bound.get(object_path)
+        if device is None:
+            device = self._devices.get(object_path)
+            if device is not None:
+                device = copy(device)
+                device._daemon = self
+                self._bound[object_path] = device
+        return device
+
 
 class Job(object):
 
@@ -483,10 +550,18 @@ class Daemon(Emitter, UDisks):
         - device_mounted  / device_unmounted
         - media_added     / media_removed
         - device_changed  / job_failed
+        - label_changed   / size_changed
 
     A very primitive mechanism that gets along without external
     dependencies is used for event dispatching. The methods `connect` and
     `disconnect` can be used to add or remove event handlers.
+
+    The set of devices matching a predicate can be maintained
+    incrementally using :meth:`query`.
+
+    During signal storms (see :class:`SignalThrottle`) only the devices
+    that were signaled are periodically updated instead of handling each
+    signal individually.
     """
 
     mainloop = True
@@ -512,7 +587,9 @@ class Daemon(Emitter, UDisks):
                            'media_remov',
                            'device_unlock',
                            'device_lock',
-                           'device_chang', )] + ['job_failed']
+                           'device_chang', )] + ['label_changed',
+                                                 'size_changed',
+                                                 'job_failed']
         super(Daemon, self).__init__(event_names)
 
         sniffer = Sniffer(proxy or self.connect_service())
@@ -520,26 +597,34 @@ class Daemon(Emitter, UDisks):
         self._sniffer = sniffer
         self._jobs = {}
         self._devices = {}
+        self._children = {}
         self._errors = {'mount': {}, 'unmount': {},
                         'unlock': {}, 'lock': {},
                         'eject': {}, 'detach': {}}
+        self._version = 0
+        self._snapshot = None
+        self._queries = []
+        self.throttle = SignalThrottle(self._reconcile)
+
+        def object_path_key(object_path):
+            return object_path
 
         self.connect('device_changed', self._on_device_changed)
         bus = self._sniffer._proxy._bus
-        bus.add_signal_receiver(
-            self._device_added,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._device_added, object_path_key),
             signal_name='DeviceAdded',
             bus_name=self.BusName)
-        bus.add_signal_receiver(
-            self._device_removed,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._device_removed, object_path_key),
             signal_name='DeviceRemoved',
             bus_name=self.BusName)
-        bus.add_signal_receiver(
-            self._device_changed,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._device_changed, object_path_key),
             signal_name='DeviceChanged',
             bus_name=self.BusName)
-        bus.add_signal_receiver(
-            self._device_job_changed,
+        add_signal_receiver(
+            bus, self._device_job_changed,
             signal_name='DeviceJobChanged',
             bus_name=self.BusName)
         self._sync()
@@ -559,24 +644,62 @@ class Daemon(Emitter, UDisks):
         device = self._sniffer.get(object_path)
         cached = CachedDevice(device)
         if cached or object_path not in self._devices:
-            self._devices[object_path] = cached
+            self._set_state(object_path, cached)
         else:
             self._invalidate(object_path)
         return cached
 
+    def snapshot(self):
+        """
+        Return a frozen view of the current state of all devices.
+
+        :returns: the snapshot, reused until the state changes
+        :rtype: Snapshot
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self._version:
+            snapshot = Snapshot(dict(self._devices), self._version)
+            self._snapshot = snapshot
+        return snapshot
+
+    def query(self, predicate, callback=None):
+        """
+        Create an incrementally maintained query.
+
+        :param callable predicate: ``predicate(device) -> bool``
+        :param callable callback: ``callback(device, matched)`` is called
+                                  when a device enters or leaves the result
+        :returns: live result set
+        :rtype: Query
+        """
+        query = Query(self, predicate, callback)
+        self._queries.append(query)
+        return query
+
+    def cancel_query(self, query):
+        """Stop updating a query."""
+        self._queries.remove(query)
+
     # special methods
     def set_error(self, device, action, message):
         self._errors[action][device.object_path] = message
 
     # events
+    _diff = PropertyDiff([
+        ('has_media', Toggle('media_added', 'media_removed')),
+        ('id_label', Changed('label_changed')),
+    ])
+
     def _on_device_changed(self, old_state, new_state):
         """Detect type of event and trigger appropriate event handlers."""
-        d = {}
-        d['media_added'] = new_state.has_media and not old_state.has_media
-        d['media_removed'] = old_state.has_media and not new_state.has_media
-        for event in d:
-            if d[event]:
-                self.trigger(event, new_state)
+        def lookup(state):
+            return lambda key: getattr(state, key)
+        for change in self._diff(self._diff.keys(),
+                                 lookup(old_state), lookup(new_state)):
+            if change.signature == 'values':
+                self.trigger(change.event, new_state, change.old, change.new)
+            else:
+                self.trigger(change.event, new_state)
 
     # UDisks event listeners
     def _device_added(self, object_path):
@@ -612,6 +735,10 @@ class Daemon(Emitter, UDisks):
         """
         if not job_in_progress and object_path in self._jobs:
             job_id = self._jobs[object_path].job_id
+        if not job_in_progress and self.throttle.reconciling:
+            # DeviceChanged signals are being dropped, so the cached state
+            # may be outdated:
+            self._device_changed(object_path)
         try:
             action = self._action_mapping[job_id]
         except KeyError:
@@ -664,10 +791,108 @@ class Daemon(Emitter, UDisks):
         self._devices = {
             object_path: CachedDevice(device)
             for object_path,device in self._devices.items() }
+        self._children = {}
+        for object_path, device in self._devices.items():
+            self._update_links(object_path, None, device)
+        self._version += 1
+
+    def _reconcile(self, dirty):
+        """
+        Synchronize the state of added, removed and dirty devices.
+
+        Used instead of the individual signal handlers during signal
+        storms. Only devices that were signaled while signals were being
+        dropped are queried again and ``device_changed`` is triggered only
+        for devices whose cached state actually differs.
+        """
+        paths = set(self._sniffer.paths())
+        for object_path, device in list(self._devices.items()):
+            if device and object_path not in paths:
+                self._device_removed(object_path)
+        for object_path in paths:
+            if not self[object_path]:
+                self._device_added(object_path)
+            elif object_path in dirty:
+                old_state = self[object_path]
+                new_state = self.update(object_path)
+                if _cached_state(old_state) != _cached_state(new_state):
+                    self.trigger('device_changed', old_state, new_state)
 
     def _invalidate(self, object_path):
         """Flag the device invalid. This removes it from the iteration."""
         if object_path in self._devices:
             update = copy(self._devices[object_path])
             update.is_valid = False
-            self._devices[object_path] = update
+            self._set_state(object_path, update)
+
+    def _set_state(self, object_path, cached):
+        """
+        Replace the cached state of a device.
+
+        Cached devices must never be modified in place, since they are
+        shared with snapshots.
+        """
+        old_state = self._devices.get(object_path)
+        self._devices[object_path] = cached
+        self._update_links(object_path, old_state, cached)
+        self._version += 1
+        if self._queries:
+            related = self._related_paths(object_path, old_state, cached)
+            for query in list(self._queries):
+                query.update(related)
+
+    # attributes that link a cached device to the devices it depends on:
+    _links = ('_partition_slave', '_luks_cleartext_slave', '_drive')
+
+    def _parents(self, state):
+        """Return the object paths a cached device links to."""
+        return set(getattr(state, link, None) for link in self._links)
+
+    def _update_links(self, object_path, old_state, new_state):
+        """
+        Maintain the index of the devices that depend on a device.
+
+        :param str object_path: object path of the changed device
+        :param CachedDevice old_state: previous state or ``None``
+        :param CachedDevice new_state: current state or ``None``
+        """
+        old_parents = self._parents(old_state)
+        new_parents = self._parents(new_state)
+        for parent in old_parents - new_parents:
+            children = self._children.get(parent)
+            if children is not None:
+                children.discard(object_path)
+                if not children:
+                    del self._children[parent]
+        for parent in new_parents - old_parents:
+            if parent and parent != object_path:
+                self._children.setdefault(parent, set()).add(object_path)
+
+    def _related_paths(self, object_path, *states):
+        """
+        Return the devices whose properties may depend on a device.
+
+        :param str object_path: object path of the changed device
+        :param CachedDevice states: states of the device to get the
+                                    ancestors from
+        :returns: the device itself, its ancestors and its descendants
+        :rtype: set
+
+        Only the ancestors and descendants are visited, using the index of
+        links maintained by :meth:`_set_state`.
+        """
+        related = set([object_path])
+        pending = [parent for state in states
+                   for parent in self._parents(state)]
+        while pending:
+            path = pending.pop()
+            if path in self._devices and path not in related:
+                related.add(path)
+                pending.extend(self._parents(self._devices[path]))
+        pending = [object_path]
+        while pending:
+            for child in self._children.get(pending.pop(), ()):
+                if child not in related:
+                    related.add(child)
+                    pending.append(child)
+        return related
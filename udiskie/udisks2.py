@@ -10,15 +10,18 @@ This wraps the DBus API of Udisks2 providing a common interface with the
 udisks1 module.
 """
 
-from copy import copy, deepcopy
+from itertools import chain
 import logging
 import os.path
 
-from udiskie.common import Emitter, samefile
+from udiskie.common import (Emitter, SignalThrottle, PropertyDiff, Toggle,
+                            Changed, Query, samefile)
 from udiskie.compat import filter
-from udiskie.dbus import DBusProxy, DBusProperties, DBusException, DBusService
+from udiskie.dbus import (ByteArray, DBusProxy, DBusProperties, DBusException,
+                          DBusService, add_signal_receiver)
+from udiskie.trace import span
 
-__all__ = ['Sniffer', 'Daemon']
+__all__ = ['Sniffer', 'Snapshot', 'Daemon']
 
 
 def object_kind(object_path):
@@ -522,13 +525,26 @@ class Device(object):
     # Encrypted methods
     def unlock(self, password, auth_no_user_interaction=None):
         """Unlock Luks device."""
-        object_path = self._I.Encrypted.method.Unlock(password, filter_opt({
+        return self._unlock(password, filter_opt({
             'auth.no_user_interaction': auth_no_user_interaction
         }))
+
+    def unlock_keyfile(self, keyfile_contents, auth_no_user_interaction=None):
+        """Unlock Luks device using the contents of a keyfile."""
+        return self._unlock('', filter_opt({
+            'keyfile_contents': ByteArray(keyfile_contents),
+            'auth.no_user_interaction': auth_no_user_interaction
+        }))
+
+    def _unlock(self, password, options):
+        """Unlock Luks device and return the cleartext device."""
+        with span('Encrypted.Unlock'):
+            object_path = self._I.Encrypted.method.Unlock(password, options)
         # UDisks2 may not have processed the InterfacesAdded signal yet.
         # Therefore it is necessary to query the interface data directly
         # from the DBus service:
-        return self._udisks.update(object_path)
+        with span('cleartext'):
+            return self._udisks.update(object_path)
 
     def lock(self, auth_no_user_interaction=None):
         """Lock Luks device."""
@@ -627,6 +643,62 @@ class Sniffer(UDisks2):
 
     update = get
 
+    def freeze(self):
+        """
+        Return a frozen view of the current state of all devices.
+
+        All states are retrieved with a single DBus call.
+
+        :rtype: Snapshot
+        """
+        return Snapshot(self._proxy, self._proxy.method.GetManagedObjects(), 0)
+
+
+class Snapshot(UDisks2):
+
+    """
+    Frozen view of all device states at a specific point in time.
+
+    Snapshots are obtained via :meth:`Daemon.snapshot` or
+    :meth:`Sniffer.freeze`. The daemon never modifies object states in
+    place, but replaces them on change. Thus, snapshots share all object
+    states with the daemon and are cheap to create. Device properties are
+    resolved via table lookup within the snapshot, so a snapshot provides a
+    consistent view of multiple devices and can be used from worker threads.
+
+    :ivar int version: state version of the daemon at creation time
+    """
+
+    def __init__(self, proxy, objects, version):
+        """
+        Initialize snapshot.
+
+        :param common.DBusProxy proxy: proxy to udisks object
+        :param dict objects: object states a{oa{sa{sv}}}, must not be modified
+        :param int version: state version
+        """
+        self._proxy = proxy
+        self._objects = objects
+        self.version = version
+
+    def paths(self):
+        return self._objects.keys()
+
+    def get(self, object_path, interfaces_and_properties=None):
+        """Create a Device instance from object path."""
+        if not interfaces_and_properties:
+            interfaces_and_properties = self._objects.get(object_path)
+            if not interfaces_and_properties:
+                return None
+        interface_service = OfflineInterfaceService(
+            self._proxy._bus.get_object(self.BusName, object_path),
+            interfaces_and_properties)
+        return Device(self, object_path, interface_service)
+
+    def update(self, object_path):
+        return self.get(object_path,
+                        self._proxy.method.GetManagedObjects()[object_path])
+
 
 class Daemon(Emitter, UDisks2):
 
@@ -641,6 +713,18 @@ class Daemon(Emitter, UDisks2):
         - device_mounted  / device_unmounted
         - media_added     / media_removed
         - device_changed  / job_failed
+        - label_changed   / size_changed
+
+    Property changes are translated to events using a declarative diff
+    table (see :class:`PropertyDiff`). ``device_changed`` is triggered for
+    changes of properties that may affect the handleability of a device.
+
+    The set of devices matching a predicate can be maintained
+    incrementally using :meth:`query`.
+
+    During signal storms (see :class:`SignalThrottle`) the state is
+    periodically reconciled with a snapshot of the UDisks2 state instead of
+    handling each signal individually.
     """
 
     mainloop = True
@@ -663,32 +747,39 @@ class Daemon(Emitter, UDisks2):
                                  'device_chang', ))
                        + ('object_added',
                           'object_removed',
+                          'label_changed',
+                          'size_changed',
                           'job_failed'))
         super(Daemon, self).__init__(event_names)
 
         self._proxy = proxy or self.connect_service()
         self._log = logging.getLogger(__name__)
         self._objects = {}
+        self._children = {}
+        self._version = 0
+        self._snapshot = None
+        self._queries = []
+        self.throttle = SignalThrottle(self._reconcile)
 
         bus = self._proxy._bus
-        bus.add_signal_receiver(
-            self._interfaces_added,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._interfaces_added),
             signal_name='InterfacesAdded',
             dbus_interface=Interface['ObjectManager'],
             bus_name=self.BusName)
-        bus.add_signal_receiver(
-            self._interfaces_removed,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._interfaces_removed),
             signal_name='InterfacesRemoved',
             dbus_interface=Interface['ObjectManager'],
             bus_name=self.BusName)
-        bus.add_signal_receiver(
-            self._properties_changed,
+        add_signal_receiver(
+            bus, self.throttle.wrap(self._properties_changed),
             signal_name='PropertiesChanged',
             dbus_interface=Interface['Properties'],
             bus_name=self.BusName,
             path_keyword='object_path')
-        bus.add_signal_receiver(
-            self._job_completed,
+        add_signal_receiver(
+            bus, self._job_completed,
             signal_name='Completed',
             dbus_interface=Interface['Job'],
             bus_name=self.BusName,
@@ -700,6 +791,172 @@ class Daemon(Emitter, UDisks2):
     def _sync(self):
         """Synchronize state."""
         self._objects = self._proxy.method.GetManagedObjects()
+        self._children = {}
+        for object_path, state in self._objects.items():
+            self._update_links(object_path, {}, state)
+        self._version += 1
+
+    def _set_state(self, object_path, state):
+        """
+        Replace the state of an object.
+
+        :param str object_path: object path
+        :param dict state: new interfaces and properties, ``None`` to remove
+
+        Object states must never be modified in place, since they are
+        shared with snapshots.
+        """
+        old_state = self._objects.get(object_path, {})
+        if state is None:
+            del self._objects[object_path]
+        else:
+            self._objects[object_path] = state
+        self._update_links(object_path, old_state, state or {})
+        self._version += 1
+        if self._queries:
+            related = self._related_paths(object_path, old_state, state or {})
+            for query in list(self._queries):
+                query.update(related)
+
+    # links from an object to the objects it depends on:
+    _links = ((Interface['Block'], 'Drive'),
+              (Interface['Block'], 'CryptoBackingDevice'),
+              (Interface['Partition'], 'Table'))
+
+    def _parents(self, state):
+        """Return the object paths an object state links to."""
+        return set(state.get(interface, {}).get(property_name)
+                   for interface, property_name in self._links)
+
+    def _update_links(self, object_path, old_state, new_state):
+        """
+        Maintain the index of the objects that depend on an object.
+
+        :param str object_path: object path of the changed object
+        :param dict old_state: previous state, ``{}`` if new
+        :param dict new_state: current state, ``{}`` if removed
+        """
+        old_parents = self._parents(old_state)
+        new_parents = self._parents(new_state)
+        for parent in old_parents - new_parents:
+            children = self._children.get(parent)
+            if children is not None:
+                children.discard(object_path)
+                if not children:
+                    del self._children[parent]
+        for parent in new_parents - old_parents:
+            if parent and parent != object_path:
+                self._children.setdefault(parent, set()).add(object_path)
+
+    def _related_paths(self, object_path, *states):
+        """
+        Return the objects whose device properties may depend on an object.
+
+        :param str object_path: object path of the changed object
+        :param dict states: states of the object to get the ancestors from
+        :returns: the object itself, its ancestors and its descendants
+        :rtype: set
+
+        Only the ancestors and descendants are visited, using the index of
+        links maintained by :meth:`_set_state`.
+        """
+        related = set([object_path])
+        pending = [parent for state in states
+                   for parent in self._parents(state)]
+        while pending:
+            path = pending.pop()
+            if path in self._objects and path not in related:
+                related.add(path)
+                pending.extend(self._parents(self._objects[path]))
+        pending = [object_path]
+        while pending:
+            for child in self._children.get(pending.pop(), ()):
+                if child not in related:
+                    related.add(child)
+                    pending.append(child)
+        return related
+
+    def query(self, predicate, callback=None):
+        """
+        Create an incrementally maintained query.
+
+        :param callable predicate: ``predicate(device) -> bool``
+        :param callable callback: ``callback(device, matched)`` is called
+                                  when a device enters or leaves the result
+        :returns: live result set
+        :rtype: Query
+        """
+        query = Query(self, predicate, callback)
+        self._queries.append(query)
+        return query
+
+    def cancel_query(self, query):
+        """Stop updating a query."""
+        self._queries.remove(query)
+
+    def snapshot(self):
+        """
+        Return a frozen view of the current state of all devices.
+
+        :returns: the snapshot, reused until the state changes
+        :rtype: Snapshot
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self._version:
+            snapshot = Snapshot(self._proxy, dict(self._objects),
+                                self._version)
+            self._snapshot = snapshot
+        return snapshot
+
+    def _reconcile(self, dirty):
+        """
+        Synchronize state by comparing with a fresh snapshot.
+
+        Used instead of the individual signal handlers during signal
+        storms. The differences are fed into the regular signal handlers,
+        so the same events are triggered.
+        """
+        new_objects = self._proxy.method.GetManagedObjects()
+        removed = [object_path for object_path in self._objects
+                   if object_path not in new_objects]
+        for object_path in removed:
+            self._interfaces_removed(object_path,
+                                     list(self._objects[object_path]))
+        for object_path, new_state in new_objects.items():
+            old_state = self._objects.get(object_path)
+            if old_state is None:
+                self._interfaces_added(object_path, new_state)
+                continue
+            added = {interface: properties
+                     for interface, properties in new_state.items()
+                     if interface not in old_state}
+            removed = [interface for interface in old_state
+                       if interface not in new_state]
+            changed = []
+            for interface, old_properties in old_state.items():
+                new_properties = new_state.get(interface)
+                if new_properties is None:
+                    continue
+                changed_properties = {
+                    key: value for key, value in new_properties.items()
+                    if key not in old_properties
+                    or old_properties[key] != value}
+                invalidated_properties = [
+                    key for key in old_properties
+                    if key not in new_properties]
+                if changed_properties or invalidated_properties:
+                    changed.append((interface,
+                                    changed_properties,
+                                    invalidated_properties))
+            if added:
+                self._interfaces_added(object_path, added)
+            for interface, changed_properties, invalidated_properties in changed:
+                self._properties_changed(interface,
+                                         changed_properties,
+                                         invalidated_properties,
+                                         object_path)
+            if removed:
+                self._interfaces_removed(object_path, removed)
 
     # UDisks2 interface
     def paths(self):
@@ -730,7 +987,9 @@ class Daemon(Emitter, UDisks2):
     def _interfaces_added(self, object_path, interfaces_and_properties):
         """Internal method."""
         added = object_path not in self._objects
-        self._objects[object_path] = interfaces_and_properties
+        new_state = dict(self._objects.get(object_path, {}))
+        new_state.update(interfaces_and_properties)
+        self._set_state(object_path, new_state)
         if added:
             self.trigger('object_added', object_path)
 
@@ -742,31 +1001,68 @@ class Daemon(Emitter, UDisks2):
         elif kind == 'job':
             self._job_changed(object_path, False)
 
-    # remove objects / interfaces
-    def _detect_toggle(self, property_name, old, new, add_name, del_name):
-        old_valid = old and bool(getattr(old, property_name))
-        new_valid = new and bool(getattr(new, property_name))
-        if add_name and new_valid and not old_valid:
-            self.trigger(add_name, new)
-        elif del_name and old_valid and not new_valid:
-            self.trigger(del_name, new)
+    # detect changes
+    _diff = PropertyDiff([
+        ((Interface['Drive'], 'MediaAvailable'),
+         Toggle('media_added', 'media_removed')),
+        ((Interface['Filesystem'], 'MountPoints'),
+         Toggle('device_mounted', None)),
+        ((Interface['Block'], 'IdLabel'), Changed('label_changed')),
+        ((Interface['Block'], 'Size'), Changed('size_changed')),
+    ] + [
+        # properties that may change the handleability of a device:
+        ((Interface[interface], property_name),
+         Changed('device_changed', 'states'))
+        for interface, property_name in (
+            ('Block', 'HintSystem'),
+            ('Block', 'HintIgnore'),
+            ('Block', 'IdUsage'),
+            ('Block', 'IdType'),
+            ('Block', 'IdUUID'),
+            ('Block', 'CryptoBackingDevice'),
+            ('Partition', 'Table'),
+        )
+    ])
+
+    def _trigger_diff(self, object_path, old_state, new_state, keys):
+        """
+        Trigger events for changed properties.
 
+        :param str object_path: object path of the changed object
+        :param dict old_state: interfaces and properties before the change
+        :param dict new_state: interfaces and properties after the change
+        :param iterable keys: changed (interface, property) pairs
+
+        Device objects are created only for events that have handlers.
+        """
+        def lookup(state):
+            return lambda key: state.get(key[0], {}).get(key[1])
+        for change in self._diff(keys, lookup(old_state), lookup(new_state)):
+            if not self._event_handlers[change.event]:
+                continue
+            new_device = self.get(object_path, new_state)
+            if change.signature == 'states':
+                args = (self.get(object_path, old_state), new_device)
+            elif change.signature == 'values':
+                args = (new_device, change.old, change.new)
+            else:
+                args = (new_device,)
+            self.trigger(change.event, *args)
+
+    # remove objects / interfaces
     def _interfaces_removed(self, object_path, interfaces):
         """Internal method."""
-        old_state = copy(self._objects[object_path])
-        for interface in interfaces:
-            del self._objects[object_path][interface]
-        new_state = self._objects[object_path]
+        old_state = self._objects[object_path]
+        new_state = {interface: properties
+                     for interface, properties in old_state.items()
+                     if interface not in interfaces}
+        self._set_state(object_path, new_state or None)
 
         if Interface['Drive'] in interfaces:
-            self._detect_toggle(
-                'has_media',
-                self.get(object_path, old_state),
-                self.get(object_path, new_state),
-                None, 'media_removed')
+            self._trigger_diff(object_path, old_state, new_state,
+                               [(Interface['Drive'], 'MediaAvailable')])
 
-        if not self._objects[object_path]:
-            del self._objects[object_path]
+        if not new_state:
             if object_kind(object_path) in ('device', 'drive'):
                 self.trigger(
                     'device_removed',
@@ -784,25 +1080,20 @@ class Daemon(Emitter, UDisks2):
         Called when a DBusProperty of any managed object changes.
         """
         # update device state:
-        old_state = deepcopy(self._objects[object_path])
+        old_state = self._objects[object_path]
+        properties = dict(old_state[interface_name])
         for property_name in invalidated_properties:
-            del self._objects[object_path][interface_name][property_name]
-        for key,value in changed_properties.items():
-            self._objects[object_path][interface_name][key] = value
-        new_state = self._objects[object_path]
+            del properties[property_name]
+        properties.update(changed_properties)
+        new_state = dict(old_state)
+        new_state[interface_name] = properties
+        self._set_state(object_path, new_state)
         # detect changes and trigger events:
-        if interface_name == Interface['Drive']:
-            self._detect_toggle(
-                'has_media',
-                self.get(object_path, old_state),
-                self.get(object_path, new_state),
-                'media_added', 'media_removed')
-        elif interface_name == Interface['Filesystem']:
-            self._detect_toggle(
-                'is_mounted',
-                self.get(object_path, old_state),
-                self.get(object_path, new_state),
-                'device_mounted', None)
+        self._trigger_diff(
+            object_path, old_state, new_state,
+            [(interface_name, property_name)
+             for property_name in chain(changed_properties,
+                                        invalidated_properties)])
 
     # jobs
     _action_mapping = {
@@ -843,6 +1134,11 @@ class Daemon(Emitter, UDisks2):
 
         Called when a job of a long running task completes.
         """
+        if job_name not in self._objects:
+            # the job was created while signals were being dropped:
+            self._log.debug('ignoring completion of unknown job: %s'
+                            % (job_name,))
+            return
         if success:
             self._job_changed(job_name, True)
         else:
@@ -0,0 +1,177 @@
+"""
+Main loop stall detection.
+
+Blocking calls in the main loop (e.g. synchronous DBus calls in event
+handlers) freeze the whole daemon. The :class:`Watchdog` detects such
+stalls from a separate thread and logs what the main thread was doing.
+"""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from udiskie.common import Emitter, _timeout_add
+
+
+__all__ = ['Watchdog', 'blame']
+
+
+# immune to clock steps, if available (python 3.3+):
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def _frame_name(frame):
+    """Return 'module.Class.function' for the function of the frame."""
+    name = frame.f_code.co_name
+    self = frame.f_locals.get('self')
+    if self is not None:
+        name = type(self).__name__ + '.' + name
+    return frame.f_globals.get('__name__', '?') + '.' + name
+
+
+def _dbus_call(frame):
+    """Return 'interface.member' if the frame is a dbus-python method call."""
+    self = frame.f_locals.get('self')
+    if self is None or type(self).__module__ != 'dbus.proxies':
+        return None
+    # don't use getattr, this might trigger DBus calls from this thread:
+    attrs = getattr(self, '__dict__', {})
+    member = attrs.get('_method_name')
+    if member is None:
+        return None
+    return '%s.%s' % (attrs.get('_dbus_interface') or '?', member)
+
+
+def blame(frame):
+    """
+    Find the culprit for a stall of the main thread.
+
+    :param frame: innermost frame of the main thread
+    :returns: culprit, e.g. ``'udiskie.notify.Notify.device_mounted >
+              dbus:org.freedesktop.Notifications.Notify'``
+    :rtype: str
+
+    The culprit consists of the outermost :class:`Emitter` handler and the
+    innermost DBus method call on the stack. If neither is found, the
+    innermost frame is blamed.
+    """
+    call_handler = Emitter._call_handler
+    call_handler = getattr(call_handler, '__func__', call_handler).__code__
+    handler = None
+    dbus_call = None
+    inner = None
+    current = frame
+    while current is not None:
+        if dbus_call is None:
+            dbus_call = _dbus_call(current)
+        if current.f_code is call_handler and inner is not None:
+            handler = _frame_name(inner)
+        inner = current
+        current = current.f_back
+    parts = []
+    if handler:
+        parts.append(handler)
+    if dbus_call:
+        parts.append('dbus:' + dbus_call)
+    if not parts:
+        parts.append('%s (%s:%d)' % (_frame_name(frame),
+                                     frame.f_code.co_filename,
+                                     frame.f_lineno))
+    return ' > '.join(parts)
+
+
+class Watchdog(object):
+
+    """
+    Detect main loop stalls and attribute them to their culprit.
+
+    A heartbeat timer in the main loop records when the main loop was last
+    responsive. A background thread checks the heartbeat periodically. If
+    the lag exceeds the threshold, the stack of the main thread is logged
+    and the stall is counted by culprit (see :func:`blame`).
+
+    Lags while the main thread is waiting for events in the main loop are
+    ignored. These happen if the heartbeat is delayed by other means than
+    a busy main loop, e.g. by suspend/resume.
+
+    :ivar dict stalls: number of stalls by culprit
+    :ivar float max_lag: longest stall seen so far (seconds)
+    """
+
+    def __init__(self, threshold=1.0, interval=None, schedule=None):
+        """
+        Start the heartbeat and the watchdog thread.
+
+        Must be called from the main thread.
+
+        :param float threshold: lag in seconds that counts as stall
+        :param float interval: heartbeat period in seconds, defaults to
+                               half the threshold
+        :param callable schedule: ``schedule(seconds, callback)`` runs the
+                                  callback periodically until it returns
+                                  False. Defaults to ``gobject.timeout_add``.
+        """
+        if schedule is None:
+            import gobject
+            gobject.threads_init()
+            schedule = _timeout_add
+        if interval is None:
+            interval = threshold / 2.0
+        self._log = logging.getLogger(__name__)
+        self._threshold = threshold
+        self._interval = interval
+        self._main_thread = threading.current_thread().ident
+        self._beat = _clock()
+        # the frame that runs the main loop:
+        self._loop_frame = None
+        self._stalled = False
+        self._stop = threading.Event()
+        self.stalls = {}
+        self.max_lag = 0.0
+        schedule(interval, self._heartbeat)
+        self._thread = threading.Thread(target=self._run,
+                                        name='udiskie-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the watchdog thread."""
+        self._stop.set()
+
+    def _heartbeat(self):
+        self._beat = _clock()
+        self._loop_frame = sys._getframe().f_back
+        return not self._stop.is_set()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.check()
+
+    def check(self):
+        """Check the heartbeat and report a new stall."""
+        lag = _clock() - self._beat - self._interval
+        if lag < self._threshold:
+            if self._stalled:
+                self._stalled = False
+                self._log.info('main loop responsive again')
+            return
+        frame = sys._current_frames().get(self._main_thread)
+        if frame is None or frame is self._loop_frame:
+            # waiting for events, not stalled:
+            return
+        self.max_lag = max(self.max_lag, lag)
+        if self._stalled:
+            return
+        self._stalled = True
+        culprit = blame(frame)
+        self.stalls[culprit] = self.stalls.get(culprit, 0) + 1
+        self._log.warning('main loop stalled for %.1fs in %s:\n%s'
+                          % (lag, culprit,
+                             ''.join(traceback.format_stack(frame))))
+
+    def as_dict(self):
+        """Return the stall statistics."""
+        return {'stalls': dict(self.stalls),
+                'max_lag': self.max_lag}